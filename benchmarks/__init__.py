@@ -0,0 +1 @@
+"""Benchmarks for the debian package stats helpers"""
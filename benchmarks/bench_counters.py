@@ -0,0 +1,96 @@
+###################################################################
+"""
+Benchmark of the count representations of an all-architecture run.
+Compares the memory of the counts kept before PackageMatrix, one
+defaultdict(int) per architecture filled by its own run, with the
+interned PackageMatrix, measured with tracemalloc, and the size of the
+serialized matrix. Both are built from the same parsed Contents blocks,
+decoded the way a run decodes them, so package names are fresh str
+objects in every architecture.
+
+$ python3 -m benchmarks.bench_counters [architectures] [packages]
+"""
+###################################################################
+
+from collections import Counter, defaultdict
+import pickle
+import sys
+import time
+import tracemalloc
+from helpers.counters import PackageMatrix
+from helpers.parser import count_block, decode_counts
+
+
+def architecture_block(packages, arch_index):
+    """
+    Generate a Contents block of one architecture, most packages exist on all of them.
+    """
+    lines = []
+    for i in range(packages):
+        if (i + arch_index) % 10:
+            for j in range((i * 7 + arch_index) % 5 + 1):
+                lines.append(f"usr/share/doc/package{i}/file{j} section{i % 20}/package{i}\n")
+    return "".join(lines).encode()
+
+
+def parse_counts(block):
+    """
+    Count a block and decode it as a worker does, into a str Counter.
+    """
+    counts = Counter()
+    count_block(block, counts)
+    return decode_counts(counts)
+
+
+def measure(build):
+    """
+    Build a representation and return it with its allocated bytes and build time.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    size, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size, elapsed
+
+
+def main():
+    """
+    Benchmark the dict per architecture and the matrix and check they agree.
+    """
+    archs = int(sys.argv[1]) if len(sys.argv) > 1 else 12
+    packages = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    columns = [f"arch{i}" for i in range(archs)]
+    blocks = [architecture_block(packages, i) for i in range(archs)]
+
+    def build_dicts():
+        # One run per architecture, each decoding into its own defaultdict(int)
+        dicts = {}
+        for arch, block in zip(columns, blocks):
+            counts = Counter()
+            count_block(block, counts)
+            dicts[arch] = decode_counts(counts, defaultdict(int))
+        return dicts
+
+    def build_matrix():
+        # Workers send str Counters, the parent interns them into the matrix
+        matrix = PackageMatrix(columns)
+        for arch, block in zip(columns, blocks):
+            matrix.add(arch, parse_counts(block))
+        return matrix
+
+    dicts, dict_size, dict_time = measure(build_dicts)
+    matrix, matrix_size, matrix_time = measure(build_matrix)
+    for arch in columns:
+        assert matrix.column_counts(arch) == dicts[arch], f"{arch} does not match"
+    print(f"{archs} architectures, {len(matrix)} packages")
+    print(f"{'dict per arch':20} {dict_size / 2**20:8.1f} MB {dict_time:8.3f} s "
+          f"{len(pickle.dumps(dicts)) / 2**20:8.1f} MB pickled")
+    print(f"{'PackageMatrix':20} {matrix_size / 2**20:8.1f} MB {matrix_time:8.3f} s "
+          f"{len(matrix.to_bytes()) / 2**20:8.1f} MB serialized")
+    print(f"{'':20} {dict_size / matrix_size:.2f}x less memory")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+###################################################################
+"""
+Benchmark of the Contents line parsers.
+Compares the str mapper with the bytes level parsers on a decompressed
+Contents file, or on synthetic data when no file is given.
+
+$ python3 -m benchmarks.bench_parser [Contents-amd64.gz]
+"""
+###################################################################
+
+from collections import Counter
+import gzip
+import sys
+import time
+from benchmarks.contents_generator import generate_contents
+from helpers.package_stats_helper_async import mapper
+from helpers.parser import count_block, count_lines_bytes, decode_counts
+
+
+def synthetic_contents(lines=500000, seed=0):
+    """
+    Generate a decompressed Contents file with random paths and packages.
+
+    Args:
+        lines (int): Number of lines to generate.
+        seed (int): Random seed.
+
+    Returns:
+        bytes: Contents file data.
+
+    """
+    return generate_contents(lines, seed=seed)
+
+
+def time_parser(name, func, data, size_mb):
+    """
+    Run a parser once, print its throughput and return its result.
+    """
+    start = time.perf_counter()
+    result = func(data)
+    elapsed = time.perf_counter() - start
+    print(f"{name:20} {elapsed:8.3f} s {size_mb / elapsed:8.1f} MB/s")
+    return result, elapsed
+
+
+def run_mapper(data):
+    """
+    Count with the str mapper, as the parser did before the bytes parser.
+    """
+    stats = Counter()
+    mapper([line for line in data.decode().split("\n") if line], stats)
+    return stats
+
+
+def run_lines_bytes(data):
+    """
+    Count with the line by line bytes parser.
+    """
+    counts = Counter()
+    count_lines_bytes(data, counts)
+    return decode_counts(counts)
+
+
+def run_block(data):
+    """
+    Count with the vectorized bytes parser.
+    """
+    counts = Counter()
+    count_block(data, counts)
+    return decode_counts(counts)
+
+
+def main():
+    """
+    Benchmark all parsers and check they agree.
+    """
+    if len(sys.argv) > 1:
+        with gzip.open(sys.argv[1], 'rb') as f:
+            data = f.read()
+    else:
+        data = synthetic_contents()
+    size_mb = len(data) / (1024 * 1024)
+    print(f"Input: {size_mb:.1f} MB")
+    expected, baseline = time_parser("mapper (str)", run_mapper, data, size_mb)
+    for name, func in (("bytes lines", run_lines_bytes), ("bytes block", run_block)):
+        result, elapsed = time_parser(name, func, data, size_mb)
+        assert result == expected, f"{name} does not match mapper"
+        print(f"{'':20} speedup {baseline / elapsed:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
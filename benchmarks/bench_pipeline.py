@@ -0,0 +1,332 @@
+###################################################################
+"""
+Stage by stage benchmark of the synchronous and asynchronous pipelines.
+Generates synthetic Contents files, serves them from a local mirror and
+times discovery, download, decompress, parse, merge and top-K separately
+for package_stats_helper and package_stats_helper_async, plus a full run
+of each, and the throughput of every installed decompression backend.
+Results are written as JSON with the commit they were measured on;
+--compare prints the speedup of every stage against an earlier result.
+
+$ python3 -m benchmarks.bench_pipeline [--lines N] [--archs A B ...]
+      [--repeat R] [--output results.json] [--compare old.json]
+"""
+###################################################################
+
+import argparse
+import asyncio
+from collections import Counter, defaultdict
+import gzip
+import json
+import lzma
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from benchmarks.contents_generator import write_contents_files
+from benchmarks.local_mirror import LocalMirror
+from helpers import package_stats_helper
+from helpers import package_stats_helper_async as helper_async
+from helpers.common_utils import (
+    filter_files, get_contents_file_list, merge_counts, process_contents_file_list,
+    return_stats, top_packages)
+from helpers.decompress import available_backends, open_contents
+from helpers.http_client import DownloadClient
+from helpers.parser import count_block, decode_counts
+from helpers.release import file_checksums
+from helpers.streaming import read_line_blocks
+
+STAGES = ("discovery", "download", "decompress", "parse", "merge", "top_k", "end_to_end")
+
+
+def git_revision():
+    """
+    Return the commit hash of the working tree and whether it has local changes.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                                text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+
+def measure(func, repeat, setup=None):
+    """
+    Run a stage repeat times and return its timings and last result.
+    setup runs before every repetition and is not timed, its result is passed to func.
+    """
+    runs = []
+    result = None
+    for _ in range(repeat):
+        argument = setup() if setup else None
+        start = time.perf_counter()
+        result = func(argument) if setup else func()
+        runs.append(time.perf_counter() - start)
+    return runs, result
+
+
+def stage_result(runs, size=None):
+    """
+    Summarize the timings of a stage, with throughput when the stage processes bytes.
+    """
+    result = {"seconds": min(runs), "median": statistics.median(runs), "runs": runs}
+    if size:
+        result["mb_per_s"] = size / (1 << 20) / min(runs)
+    return result
+
+
+def bench_sync(mirror, work_dir, repeat, arch, limit):
+    """
+    Time every stage of package_stats_helper.
+    """
+    results = {}
+    runs, files = measure(lambda: process_contents_file_list(
+        mirror.mirror_url, get_contents_file_list(mirror.mirror_url)), repeat)
+    results["discovery"] = stage_result(runs)
+    urls = filter_files(files, None, True, all_files=True)
+
+    runs, paths = measure(lambda out: package_stats_helper.download_files(urls, out),
+                          repeat, lambda: tempfile.mkdtemp(dir=work_dir))
+    compressed = sum(os.path.getsize(path) for path in paths)
+    results["download"] = stage_result(runs, compressed)
+
+    def decompress():
+        return {path: list(package_stats_helper.decompress_file(path)) for path in paths}
+    runs, lines = measure(decompress, repeat)
+    decompressed = sum(len(line) + 1 for file_lines in lines.values() for line in file_lines)
+    results["decompress"] = stage_result(runs, decompressed)
+
+    def parse():
+        partials = []
+        for file_lines in lines.values():
+            partial = defaultdict(int)
+            for line in file_lines:
+                for package in package_stats_helper.process_data(line):
+                    partial[package] += 1
+            partials.append(partial)
+        return partials
+    runs, partials = measure(parse, repeat)
+    results["parse"] = stage_result(runs, decompressed)
+
+    def merge():
+        total = defaultdict(int)
+        for partial in partials:
+            merge_counts(total, partial)
+        return total
+    runs, total = measure(merge, repeat)
+    results["merge"] = stage_result(runs)
+    runs, _stats = measure(lambda: return_stats(total, True, limit), repeat)
+    results["top_k"] = stage_result(runs)
+
+    runs, _stats = measure(lambda out: package_stats_helper.download_and_process_files(
+        files, arch, True, out), repeat, lambda: tempfile.mkdtemp(dir=work_dir))
+    results["end_to_end"] = stage_result(runs)
+    return results, total
+
+
+def bench_backends(paths, work_dir, repeat, size):
+    """
+    Time every installed decompression backend, and xz on recompressed copies of the files.
+    """
+    def read_all(files, backend):
+        for path in files:
+            with open_contents(path, backend) as f:
+                for _block in read_line_blocks(f):
+                    pass
+
+    xz_paths = []
+    for path in paths:
+        xz_path = os.path.join(work_dir, os.path.basename(path)[:-len(".gz")] + ".xz")
+        with gzip.open(path, 'rb') as source, lzma.open(xz_path, 'wb') as target:
+            target.write(source.read())
+        xz_paths.append(xz_path)
+    variants = [(backend, paths, backend) for backend in available_backends()]
+    # open_contents reads .xz with lzma, or with the xz tool for the subprocess backend
+    variants += [("xz-lzma", xz_paths, "gzip"), ("xz-pipe", xz_paths, "pigz")]
+    results = {}
+    for name, files, backend in variants:
+        try:
+            runs, _result = measure(lambda files=files, backend=backend: read_all(
+                files, backend), repeat)
+        except OSError as e:
+            print(f"Skipping {name}: {e}")
+            continue
+        results[name] = stage_result(runs, size)
+    return results
+
+
+def bench_async(mirror, work_dir, repeat, arch, limit):
+    """
+    Time every stage of package_stats_helper_async.
+    """
+    results = {}
+    for discovery in ("release", "html"):
+        runs, files = measure(lambda discovery=discovery: helper_async.discover_contents_files(
+            mirror.mirror_url, discovery), repeat)
+        results[f"discovery_{discovery}"] = stage_result(runs)
+    results["discovery"] = results["discovery_release"]
+    urls = filter_files(files, None, True, all_files=True)
+    checksums = file_checksums(files)
+
+    async def download_all(out):
+        async with DownloadClient() as client:
+            return await asyncio.gather(*(helper_async.download_file(
+                url, out, 0, client, expected=checksums.get(url)) for url in urls))
+    runs, paths = measure(lambda out: asyncio.run(download_all(out)),
+                          repeat, lambda: tempfile.mkdtemp(dir=work_dir))
+    compressed = sum(os.path.getsize(path) for path in paths)
+    results["download"] = stage_result(runs, compressed)
+
+    def decompress():
+        blocks = {}
+        for path in paths:
+            with gzip.open(path, 'rb') as f:
+                blocks[path] = list(read_line_blocks(f))
+        return blocks
+    runs, blocks = measure(decompress, repeat)
+    decompressed = sum(len(block) for file_blocks in blocks.values() for block in file_blocks)
+    results["decompress"] = stage_result(runs, decompressed)
+    results["decompress_backends"] = bench_backends(paths, work_dir, repeat, decompressed)
+
+    def parse():
+        partials = []
+        for file_blocks in blocks.values():
+            counts = Counter()
+            for block in file_blocks:
+                count_block(block, counts)
+            partials.append(decode_counts(counts))
+        return partials
+    runs, partials = measure(parse, repeat)
+    results["parse"] = stage_result(runs, decompressed)
+
+    def merge():
+        total = {}
+        for partial in partials:
+            merge_counts(total, partial)
+        return total
+    runs, total = measure(merge, repeat)
+    results["merge"] = stage_result(runs)
+    runs, _rows = measure(lambda: top_packages(total, True, limit), repeat)
+    results["top_k"] = stage_result(runs)
+
+    arch_urls = filter_files(files, arch, True)
+
+    def end_to_end(out):
+        counts = {}
+        asyncio.run(helper_async.download_and_process_files(
+            arch_urls, out, 0, checksums=checksums, counts=counts))
+        return top_packages(counts, True, limit)
+    runs, _rows = measure(end_to_end, repeat, lambda: tempfile.mkdtemp(dir=work_dir))
+    results["end_to_end"] = stage_result(runs)
+    return results, total
+
+
+def compare(current, previous):
+    """
+    Print the speedup of every stage over an earlier result file.
+    """
+    print(f"Compared with {previous.get('commit') or 'unknown commit'}")
+    for mode in ("sync", "async"):
+        for stage in STAGES:
+            old = previous["results"].get(mode, {}).get(stage)
+            new = current["results"][mode].get(stage)
+            if old and new:
+                print(f"{mode:6} {stage:12} {old['seconds']:8.3f} s -> "
+                      f"{new['seconds']:8.3f} s {old['seconds'] / new['seconds']:6.2f}x")
+    old_backends = previous["results"]["async"].get("decompress_backends", {})
+    for name, new in current["results"]["async"]["decompress_backends"].items():
+        if name in old_backends:
+            print(f"{'backend':6} {name:12} {old_backends[name]['mb_per_s']:8.1f} MB/s -> "
+                  f"{new['mb_per_s']:8.1f} MB/s")
+
+
+def print_results(result):
+    """
+    Print the timings of every stage side by side.
+    """
+    print(f"{'Stage':12} {'sync (s)':>10} {'async (s)':>10} {'async MB/s':>11}")
+    for stage in STAGES:
+        sync = result["results"]["sync"][stage]
+        async_ = result["results"]["async"][stage]
+        throughput = f"{async_['mb_per_s']:11.1f}" if "mb_per_s" in async_ else f"{'':11}"
+        print(f"{stage:12} {sync['seconds']:10.3f} {async_['seconds']:10.3f} {throughput}")
+    print(f"{'Backend':12} {'(s)':>10} {'MB/s':>10}")
+    for name, backend in result["results"]["async"]["decompress_backends"].items():
+        print(f"{name:12} {backend['seconds']:10.3f} {backend['mb_per_s']:10.1f}")
+
+
+def main(argv=None):
+    """
+    Generate the data, run both pipelines and write the results.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", 1)[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=200000,
+                        help="Lines per Contents file. DEFAULT: 200000")
+    parser.add_argument("--packages", type=int, default=30000,
+                        help="Distinct packages per file. DEFAULT: 30000")
+    parser.add_argument("--archs", nargs="+", default=["amd64", "arm64", "i386"],
+                        help="Architectures to generate. DEFAULT: amd64 arm64 i386")
+    parser.add_argument("--multi-package-ratio", type=float, default=0.02,
+                        help="Share of lines listing several packages. DEFAULT: 0.02")
+    parser.add_argument("--empty-package-ratio", type=float, default=0.00001,
+                        help="Share of EMPTY_PACKAGE lines. DEFAULT: 0.00001")
+    parser.add_argument("--max-depth", type=int, default=6,
+                        help="Maximum directory depth of paths. DEFAULT: 6")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed. DEFAULT: 0")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Repetitions of every stage, the fastest is kept. DEFAULT: 3")
+    parser.add_argument("--limit", type=int, default=10, help="Top-K size. DEFAULT: 10")
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="Earlier JSON results to compare with.")
+    args = parser.parse_args(argv)
+
+    commit, dirty = git_revision()
+    config = {key: value for key, value in vars(args).items()
+              if key not in ("output", "compare")}
+    with tempfile.TemporaryDirectory() as work_dir:
+        data_dir = os.path.join(work_dir, "mirror")
+        start = time.perf_counter()
+        sizes = write_contents_files(
+            data_dir, args.archs, udeb=True, lines=args.lines, packages=args.packages,
+            seed=args.seed, multi_package_ratio=args.multi_package_ratio,
+            empty_package_ratio=args.empty_package_ratio, max_depth=args.max_depth)
+        print(f"Generated {len(sizes)} files, {sum(sizes.values()) / (1 << 20):.1f} MB "
+              f"in {time.perf_counter() - start:.1f} s")
+        with LocalMirror(data_dir) as mirror:
+            sync, sync_total = bench_sync(mirror, work_dir, args.repeat, args.archs[0],
+                                          args.limit)
+            async_, async_total = bench_async(mirror, work_dir, args.repeat, args.archs[0],
+                                              args.limit)
+        compressed = sum(os.path.getsize(os.path.join(data_dir, name)) for name in sizes)
+    assert dict(sync_total) == async_total, "sync and async counts differ"
+
+    result = {
+        "commit": commit,
+        "dirty": dirty,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": config,
+        "input": {"files": len(sizes), "compressed_bytes": compressed,
+                  "decompressed_bytes": sum(sizes.values())},
+        "results": {"sync": sync, "async": async_},
+    }
+    print_results(result)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(result, json.load(f))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+###################################################################
+"""
+Startup time benchmark of package_statistics.py.
+Runs the command line in fresh interpreters with python -X importtime for
+--help, a bare import of the helpers and a run answered from the cache,
+and reports the wall time, the total import time and the slowest imports
+of each. The run fails if a network library is imported on a path that
+must not need it, if --help or the cached run loads the event loop, the
+parse executors or, for --help, SQLite, or if an import time budget is
+exceeded, so it can guard against startup regressions.
+
+$ python3 -m benchmarks.bench_startup [--repeat R] [--max-import-ms MS]
+      [--output results.json]
+"""
+###################################################################
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from benchmarks.contents_generator import write_contents_files
+from benchmarks.local_mirror import LocalMirror
+from benchmarks.bench_pipeline import git_revision
+from helpers.cli import cli
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_POINT = os.path.join(ROOT, "package_statistics.py")
+# Imported only when a request is sent or a directory listing is scraped
+NETWORK_MODULES = ("aiohttp", "aiofiles", "requests", "bs4")
+# Imported only when a run downloads or parses files, asyncio loads concurrent.futures
+RUN_MODULES = ("asyncio", "concurrent.futures", "multiprocessing", "helpers.parallel",
+               "helpers.pdiff", "helpers.path_index", "helpers.engine",
+               "helpers.package_stats_helper_async")
+# Imported only when the count index is read, never by --help
+INDEX_MODULES = ("sqlite3", "helpers.count_index")
+TOP_IMPORTS = 5
+
+
+def import_times(argv):
+    """
+    Run python -X importtime with arguments in a fresh interpreter.
+
+    Args:
+        argv (list): Interpreter arguments, e.g. ["-c", "import helpers"].
+
+    Returns:
+        tuple: Module name to (self, cumulative) import time in microseconds,
+            and the standard output of the run.
+
+    """
+    process = subprocess.run([sys.executable, "-X", "importtime", *argv], cwd=ROOT,
+                             capture_output=True, text=True, check=True)
+    modules = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = (int(own), int(cumulative))
+    return modules, process.stdout
+
+
+def bench_scenario(argv, repeat, forbidden=NETWORK_MODULES):
+    """
+    Time a command line in fresh interpreters and list its imports.
+    Modules in forbidden that the command imports are reported.
+    """
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *argv], cwd=ROOT, capture_output=True, check=True)
+        runs.append(time.perf_counter() - start)
+    modules, _output = import_times(argv)
+    slowest = sorted(((cumulative, name) for name, (_own, cumulative) in modules.items()
+                      if "." not in name), reverse=True)[:TOP_IMPORTS]
+    return {
+        "seconds": min(runs),
+        "median": statistics.median(runs),
+        "import_ms": sum(own for own, _cumulative in modules.values()) / 1000,
+        "slowest": [[name, cumulative / 1000] for cumulative, name in slowest],
+        "forbidden_modules": [name for name in forbidden if name in modules],
+    }
+
+
+def cached_command(work_dir):
+    """
+    Download and index a small mirror, then return the command line answered
+    from the cache. The mirror is stopped, the command cannot reach it.
+    """
+    mirror_dir = os.path.join(work_dir, "mirror")
+    output_dir = os.path.join(work_dir, "downloads")
+    write_contents_files(mirror_dir, ["amd64"], lines=2000)
+    with LocalMirror(mirror_dir) as mirror:
+        argv = ["amd64", "-m", mirror.mirror_url, "-o", output_dir, "-s", "10"]
+        with contextlib.redirect_stdout(io.StringIO()):
+            cli(argv)
+    return [ENTRY_POINT, *argv]
+
+
+def main(argv=None):
+    """
+    Time every startup scenario and check the network imports and the budget.
+    """
+    argparser = argparse.ArgumentParser(description=__doc__.split("\n", 2)[1])
+    argparser.add_argument("--repeat", type=int, default=5,
+                           help="Runs of every scenario, the fastest is kept. DEFAULT: 5")
+    argparser.add_argument("--max-import-ms", type=float, default=None,
+                           help="Fail if a scenario spends longer importing modules.")
+    argparser.add_argument("--output", type=str, default=None,
+                           help="Write the results to this JSON file.")
+    args = argparser.parse_args(argv)
+    with tempfile.TemporaryDirectory() as work_dir:
+        scenarios = {
+            "help": ([ENTRY_POINT, "--help"],
+                     NETWORK_MODULES + RUN_MODULES + INDEX_MODULES),
+            "import": (["-c", "import helpers.package_stats_helper_async"], NETWORK_MODULES),
+            "cached": (cached_command(work_dir), NETWORK_MODULES + RUN_MODULES),
+        }
+        results = {name: bench_scenario(command, args.repeat, forbidden)
+                   for name, (command, forbidden) in scenarios.items()}
+    failures = []
+    print(f"{'Scenario':10} {'Wall (ms)':>10} {'Imports (ms)':>12}  Slowest imports (ms)")
+    for name, result in results.items():
+        slowest = ", ".join(f"{module} {ms:.1f}" for module, ms in result["slowest"])
+        print(f"{name:10} {result['seconds'] * 1000:10.1f} {result['import_ms']:12.1f}  "
+              f"{slowest}")
+        if result["forbidden_modules"]:
+            failures.append(f"{name} imports {', '.join(result['forbidden_modules'])}")
+        if args.max_import_ms and result["import_ms"] > args.max_import_ms:
+            failures.append(f"{name} spends {result['import_ms']:.1f} ms importing")
+    if args.output:
+        commit, dirty = git_revision()
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"commit": commit, "dirty": dirty, "python": sys.version,
+                       "results": results}, f, indent=2)
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+###################################################################
+"""
+Generator of realistic synthetic Contents files.
+Files per package follow a Zipf like distribution, path depth and name
+lengths are random, and a configurable share of lines list several
+packages or are EMPTY_PACKAGE lines. Generation is seeded, so the same
+options always produce the same bytes.
+Functions:
+
+    generate_contents:
+        Generate a decompressed Contents file.
+
+    write_contents_files:
+        Write gzipped Contents files of several architectures to a directory.
+"""
+###################################################################
+
+import gzip
+import os
+import random
+import string
+
+SECTIONS = ("admin", "devel", "doc", "games", "libdevel", "libs", "math",
+            "net", "python", "science", "text", "utils", "x11")
+TOP_DIRECTORIES = ("usr/share/doc", "usr/share", "usr/lib", "usr/include",
+                   "usr/bin", "etc", "usr/share/locale", "usr/lib/python3/dist-packages")
+
+
+def _word(rng, length):
+    return "".join(rng.choices(string.ascii_lowercase + string.digits + "-_", k=length))
+
+
+def generate_contents(lines=500000, packages=30000, seed=0, zipf=1.2,
+                      multi_package_ratio=0.02, empty_package_ratio=0.00001,
+                      max_depth=6, name_length=(3, 16)):
+    """
+    Generate a decompressed Contents file.
+
+    Args:
+        lines (int): Number of lines to generate.
+        packages (int): Number of distinct packages.
+        seed (int): Random seed.
+        zipf (float): Exponent of the files per package distribution,
+            larger values concentrate files in fewer packages.
+        multi_package_ratio (float): Share of lines listing two to four packages.
+        empty_package_ratio (float): Share of EMPTY_PACKAGE lines.
+        max_depth (int): Maximum number of directories below the top directory.
+        name_length (tuple): Minimum and maximum length of a path component.
+
+    Returns:
+        bytes: Contents file data.
+
+    """
+    rng = random.Random(seed)
+    names = [f"{SECTIONS[i % len(SECTIONS)]}/{_word(rng, rng.randint(*name_length))}{i}"
+             for i in range(packages)]
+    # Precomputed cumulative weights make each draw a bisection
+    weights = [1 / (rank + 1) ** zipf for rank in range(packages)]
+    cum_weights = []
+    total = 0
+    for weight in weights:
+        total += weight
+        cum_weights.append(total)
+    output = []
+    for i in range(lines):
+        draw = rng.random()
+        if draw < empty_package_ratio:
+            output.append(f"EMPTY_PACKAGE{' ' * 47}{rng.choice(names)}\n")
+            continue
+        width = rng.randint(2, 4) if draw < empty_package_ratio + multi_package_ratio else 1
+        owners = rng.choices(names, cum_weights=cum_weights, k=width)
+        directories = [_word(rng, rng.randint(*name_length))
+                       for _ in range(rng.randint(0, max_depth))]
+        path = "/".join([rng.choice(TOP_DIRECTORIES), *directories,
+                         f"{_word(rng, rng.randint(*name_length))}.{i}"])
+        output.append(f"{path:60} {','.join(owners)}\n")
+    return "".join(output).encode()
+
+
+def write_contents_files(directory, archs, udeb=False, **options):
+    """
+    Write gzipped Contents files of several architectures to a directory.
+    Each architecture gets its own seed so the files differ.
+
+    Args:
+        directory (str): Directory to write the files to.
+        archs (list): Architecture names.
+        udeb (bool): Also write a smaller Contents-udeb-<arch>.gz per architecture.
+        **options: Options of generate_contents.
+
+    Returns:
+        dict: File name to size of the decompressed data in bytes.
+
+    """
+    os.makedirs(directory, exist_ok=True)
+    seed = options.pop("seed", 0)
+    lines = options.pop("lines", 500000)
+    files = {}
+    for index, arch in enumerate(archs):
+        variants = [(f"Contents-{arch}.gz", lines)]
+        if udeb:
+            variants.append((f"Contents-udeb-{arch}.gz", max(1, lines // 50)))
+        for offset, (name, count) in enumerate(variants):
+            data = generate_contents(count, seed=seed + 2 * index + offset, **options)
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write(gzip.compress(data, compresslevel=6))
+            files[name] = len(data)
+    return files
@@ -0,0 +1,121 @@
+###################################################################
+"""
+Local Debian mirror serving a directory of Contents files.
+The files are served under dists/<suite>/<component>/ with an HTML
+directory listing, and dists/<suite>/Release lists their SHA256, so both
+discovery modes work against it. Files are sent with aiohttp's
+FileResponse, which supports HEAD, conditional and Range requests.
+Classes:
+
+    LocalMirror:
+        Mirror served by aiohttp from a background thread.
+"""
+###################################################################
+
+import asyncio
+import os
+import threading
+from aiohttp import web
+from helpers.download_cache import file_sha256
+
+
+class LocalMirror:
+    """
+    Mirror served by aiohttp from a background thread.
+    Use as a context manager, the server stops on exit.
+
+    Args:
+        directory (str): Directory holding the Contents files.
+        suite (str): Suite name in the URLs. DEFAULT: stable
+        component (str): Component name in the URLs. DEFAULT: main
+
+    """
+    def __init__(self, directory, suite="stable", component="main"):
+        self.directory = directory
+        self.suite = suite
+        self.component = component
+        self.base_url = None
+        self._loop = None
+        self._thread = None
+        self._runner = None
+
+    @property
+    def archive_url(self):
+        """
+        URL of the archive root holding the dists directory.
+        """
+        return self.base_url + "debian/"
+
+    @property
+    def mirror_url(self):
+        """
+        URL of the component, as given to package_statistics.py -m.
+        """
+        return f"{self.archive_url}dists/{self.suite}/{self.component}/"
+
+    def release(self):
+        """
+        Build the Release file of the suite from the files on disk.
+
+        Returns:
+            bytes: Release file listing the SHA256 of every file.
+
+        """
+        lines = [f"Suite: {self.suite}", f"Components: {self.component}", "SHA256:"]
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            lines.append(f" {file_sha256(path)} {os.path.getsize(path)} {self.component}/{name}")
+        return ("\n".join(lines) + "\n").encode()
+
+    def listing(self):
+        """
+        Build the HTML directory listing of the component.
+        """
+        links = "".join(f'<a href="{name}">{name}</a>\n'
+                        for name in sorted(os.listdir(self.directory)))
+        return f"<html><body><pre>\n{links}</pre></body></html>".encode()
+
+    def _app(self):
+        suite_path = f"/debian/dists/{self.suite}/"
+        component_path = f"{suite_path}{self.component}/"
+
+        async def release(_request):
+            return web.Response(body=self.release())
+
+        async def listing(_request):
+            return web.Response(body=self.listing(), content_type="text/html")
+
+        async def contents(request):
+            path = os.path.join(self.directory, os.path.basename(request.match_info["name"]))
+            if not os.path.isfile(path):
+                raise web.HTTPNotFound()
+            # Debian mirrors send .gz files as data, not with Content-Encoding: gzip
+            return web.FileResponse(path, headers={"Content-Type": "application/gzip"})
+
+        app = web.Application()
+        app.router.add_get(suite_path + "Release", release)
+        app.router.add_get(component_path, listing)
+        app.router.add_get(component_path + "{name}", contents)
+        return app
+
+    def __enter__(self):
+        self._loop = asyncio.new_event_loop()
+
+        async def start():
+            self._runner = web.AppRunner(self._app())
+            await self._runner.setup()
+            site = web.TCPSite(self._runner, "127.0.0.1", 0)
+            await site.start()
+            port = self._runner.addresses[0][1]
+            self.base_url = f"http://127.0.0.1:{port}/"
+
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(start(), self._loop).result(10)
+        return self
+
+    def __exit__(self, *exc_info):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result(10)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
@@ -0,0 +1,242 @@
+############################################################
+"""
+Batch subcommand, counting several suites, components and architectures
+in one run. All downloads share one client and all parses one executor,
+and files shared by several cells are downloaded and parsed once.
+Functions:
+
+    batch_contents_files:
+        Find the Contents files of every cell of a suite, component and architecture matrix.
+
+    batch_stats:
+        Count the packages of every cell of a batch in one run.
+
+    batch_cli:
+        Command-line interface of the batch subcommand.
+"""
+############################################################
+
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sys
+from .exceptions import DownloadError
+from .common_utils import filter_files, top_packages, format_stats
+from .parallel import process_pool
+from .download_cache import CacheManifest, file_sha256, atomic_write_bytes
+from .count_index import CountIndex, INDEX_NAME
+from .release import get_release, contents_files_from_release, file_checksums
+from .http_client import DownloadClient
+from .cli_options import run_options, download_options, client_options
+from .package_stats_helper_async import (
+    ARCHIVE, discover_contents_files, download_and_process_files)
+
+
+def batch_contents_files(archive, suites, components, archs, include_udeb,
+                         discovery="release"):
+    """
+    Find the Contents files of every cell of a suite, component and architecture matrix.
+    The Release index of each suite is downloaded once. Files with the same
+    SHA256 in several suites, e.g. an unchanged udeb Contents file, are
+    downloaded and parsed once.
+
+    Args:
+        archive (str): Archive URL holding the dists directory, e.g. http://deb.debian.org/debian/
+        suites (list): Suite names, e.g. stable.
+        components (list): Component names, e.g. main.
+        archs (list): Architectures.
+        include_udeb (bool): Flag to include udeb files.
+        discovery (str): Find Contents files from the "release" index or "html" listing.
+
+    Returns:
+        tuple: Groups as (suite, component) to {"urls", "checksums"} of the files to
+            download, and cells as (suite, component, arch) to the URLs of their files.
+
+    """
+    groups = {}
+    cells = {}
+    # Canonical URL of every SHA256 seen so far
+    canonical = {}
+    for suite in suites:
+        suite_url = f"{archive.rstrip('/')}/dists/{suite}/"
+        release = None
+        if discovery == "release":
+            try:
+                release = get_release(suite_url)
+            except DownloadError as e:
+                print(f"Release index unavailable, scraping directory listings: {e}", file=sys.stderr)
+        for component in components:
+            files = contents_files_from_release(suite_url, release, component) if release else {}
+            if not files:
+                try:
+                    files = discover_contents_files(f"{suite_url}{component}/", "html")
+                except DownloadError as e:
+                    print(f"Skipping {suite}/{component}: {e}", file=sys.stderr)
+                    continue
+            checksums = file_checksums(files)
+            urls = []
+            for arch in archs:
+                cell_urls = []
+                for url in filter_files(files, arch, include_udeb) if arch in files else []:
+                    sha256 = checksums.get(url, {}).get("sha256")
+                    if sha256:
+                        url = canonical.setdefault(sha256, url)
+                    cell_urls.append(url)
+                    if url.startswith(suite_url + component + "/") and url not in urls:
+                        urls.append(url)
+                cells[(suite, component, arch)] = cell_urls
+            groups[(suite, component)] = {"urls": urls, "checksums": checksums}
+    return groups, cells
+
+
+def batch_stats(archive, suites, components, archs, include_udeb, limit, output_dir,
+                skip_download, workers=0, client_options=None, discovery="release",
+                use_index=True):
+    """
+    Count the packages of every cell of a batch in one run.
+    All downloads share one client and all parses one executor. Files are stored
+    in output_dir/suite/component and their counts in one count index, from
+    which the counts of every cell are summed.
+
+    Args:
+        archive (str): Archive URL holding the dists directory.
+        suites (list): Suite names.
+        components (list): Component names.
+        archs (list): Architectures.
+        include_udeb (bool): Flag to include udeb files.
+        limit (int): Number of top packages of every cell and of the aggregate.
+        output_dir (str): Download location for content files.
+        skip_download (int): Skip download if files are already present and newer than 's' days.
+        workers (int): Number of worker processes parsing files, 0 parses in a thread.
+        client_options (dict): Keyword arguments of the DownloadClient shared by the run.
+        discovery (str): Find Contents files from the "release" index or "html" listing.
+        use_index (bool): Reuse and store package counts in the index in output_dir,
+            otherwise the index only lives for the run.
+
+    Returns:
+        dict: "cells" with the suite, component, architecture, files and top
+            packages of every cell, and "aggregate" with the top packages of all
+            distinct files.
+
+    Raises:
+        DownloadError: If a Contents file of a cell could not be counted.
+
+    """
+    groups, cells = batch_contents_files(
+        archive, suites, components, archs, include_udeb, discovery)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    aggregate = {}
+
+    def group_dir(suite, component):
+        return os.path.join(output_dir, suite, component)
+
+    async def run():
+        async with DownloadClient(**(client_options or {})) as client:
+            with process_pool(workers) if workers else ThreadPoolExecutor() as executor:
+                await asyncio.gather(*(
+                    download_and_process_files(
+                        group["urls"], group_dir(*key), skip_download, workers=workers,
+                        client=client, checksums=group["checksums"], count_index=count_index,
+                        counts=aggregate, executor=executor)
+                    for key, group in groups.items()))
+
+    # Group downloading every URL, a URL shared by several suites is in one group only
+    owners = {url: key for key, group in groups.items() for url in group["urls"]}
+
+    def indexed_sha256(url):
+        # SHA256 the counts of a file are indexed under, from the Release index or the manifest
+        key = owners.get(url)
+        if key is None:
+            return None
+        name = os.path.basename(url)
+        entry = manifests[key].get(name)
+        expected = groups[key]["checksums"].get(url)
+        if expected:
+            return CacheManifest.release_match(entry, expected) or expected["sha256"]
+        if entry:
+            return entry["sha256"]
+        path = os.path.join(group_dir(*key), name)
+        return file_sha256(path) if os.path.exists(path) else None
+
+    count_index = CountIndex(os.path.join(output_dir, INDEX_NAME) if use_index else ":memory:")
+    try:
+        asyncio.run(run())
+        manifests = {key: CacheManifest.load(group_dir(*key)) for key in groups}
+        results = {"cells": [], "aggregate": {}}
+        failed = []
+        for (suite, component, arch), urls in cells.items():
+            sha256s = [indexed_sha256(url) for url in urls]
+            # A failed download is not indexed, its cell would be undercounted
+            failed.extend(url for url, sha256 in zip(urls, sha256s)
+                          if sha256 is None or not count_index.has(sha256))
+            counts = count_index.union(sha256 for sha256 in sha256s if sha256)
+            results["cells"].append({
+                "suite": suite,
+                "component": component,
+                "architecture": arch,
+                "files": [os.path.basename(url) for url in urls],
+                "top": top_packages(counts, True, limit),
+            })
+    finally:
+        count_index.close()
+    if failed:
+        raise DownloadError(", ".join(dict.fromkeys(failed)), "not counted, no batch results")
+    results["aggregate"] = {
+        "files": sum(len(group["urls"]) for group in groups.values()),
+        "top": top_packages(aggregate, True, limit),
+    }
+    return results
+
+
+def batch_cli(argv):
+    """
+    Command-line interface of the batch subcommand.
+
+    Args:
+        argv (list): Arguments after the subcommand name.
+
+    """
+    argparser = argparse.ArgumentParser(
+        prog="package_statistics.py batch",
+        description=("Package statistics of every suite, component and architecture "
+                     "combination, downloaded and parsed in one run."),
+        parents=[run_options(per_suite=True), download_options()]
+    )
+    argparser.add_argument(
+        "--suites", nargs="+", default=["stable"],
+        help="Suites of the batch. DEFAULT: stable")
+    argparser.add_argument(
+        "--components", nargs="+", default=["main"],
+        help="Components of the batch. DEFAULT: main")
+    argparser.add_argument(
+        "-a", "--architectures", nargs="+", required=True,
+        help="Architectures of the batch.")
+    argparser.add_argument(
+        "-m", "--archive", type=str, default=ARCHIVE,
+        help=f"Archive URL holding the dists directory. DEFAULT: {ARCHIVE}")
+    argparser.add_argument(
+        "-u", "--udeb", action="store_true",
+        help="Include udeb files. DEFAULT: False")
+    argparser.add_argument(
+        "-l", "--limit", type=int, default=10,
+        help="Top 'l' packages of every cell and of the aggregate. DEFAULT: 10")
+    argparser.add_argument(
+        "--json", type=str, default=None,
+        help="Also write the combined results to this JSON file.")
+    args = argparser.parse_args(argv)
+    results = batch_stats(
+        args.archive, args.suites, args.components, args.architectures, args.udeb,
+        args.limit, args.output_dir, args.skip_download, workers=args.workers,
+        client_options=client_options(args), discovery=args.discovery,
+        use_index=not args.no_index)
+    for cell in results["cells"]:
+        print(f"\n{cell['suite']}/{cell['component']} {cell['architecture']} "
+              f"({len(cell['files'])} files)")
+        print(format_stats(cell["top"]))
+    print(f"\nAggregate ({results['aggregate']['files']} distinct files)")
+    print(format_stats(results["aggregate"]["top"]))
+    if args.json:
+        atomic_write_bytes(args.json, json.dumps(results, indent=1).encode())
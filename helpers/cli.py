@@ -0,0 +1,268 @@
+############################################################
+"""
+Command line of the package statistics. The statistics of an architecture
+are printed by default, other commands are subcommands whose modules are
+only imported when they run.
+Functions:
+
+    package_stats:
+        Calculate and print package statistics based on given parameters.
+
+    cli:
+        Command-line interface function to get package statistics.
+"""
+############################################################
+
+import argparse
+import importlib
+import sys
+from .common_utils import peak_memory_mb, format_stats
+from .decompress import AUTO, BACKENDS
+from .download_cache import atomic_write_bytes
+from .defaults import ALL_ARCHITECTURES, APPROXIMATE_BUDGET, HEDGE_DELAY
+from .profiling import Profiler, CAPTURES
+from .cli_options import run_options, download_options, client_options
+
+# Subcommand name to the module and function of its command-line interface
+SUBCOMMANDS = {
+    "lookup": ("lookup", "lookup_cli"),
+    "batch": ("batch", "batch_cli"),
+    "serve": ("server", "server_cli"),
+    "map": ("shards", "map_cli"),
+    "reduce": ("shards", "reduce_cli"),
+    "diff": ("diff", "diff_cli"),
+}
+
+
+def package_stats(arch, mirror, include_udeb, limit, output_dir, skip_download,
+                  report_memory=False, pipeline=False, tee=True, workers=0,
+                  split_files=False, client_options=None, discovery="release",
+                  use_index=True, build_path_index=False, save_matrix=None,
+                  approximate_budget=None, incremental=False, hedge_delay=HEDGE_DELAY,
+                  profiler=None, decompressor=AUTO):
+    """
+    Calculate and print package statistics based on given parameters.
+
+    Args:
+        arch (str): Architecture of the packages to parse.
+        mirror (str or list): Mirror URL for contents files, or several mirrors
+            of the same component ranked by latency before downloading.
+        include_udeb (bool): Flag to include udeb files for architecture.
+        limit (int): Top 'limit' number of packages with maximum count of files.
+        output_dir (str): Download location for content files.
+        skip_download (int): Skip download if files are already present and newer than 's' days.
+        report_memory (bool): Print the peak resident memory of the run.
+        pipeline (bool): Parse files while they are downloading, workers are not used.
+        tee (bool): Store downloaded files in output_dir when pipelining.
+        workers (int): Number of worker processes parsing files, 0 parses in a thread.
+        split_files (bool): Split each file into blocks counted by all workers.
+        client_options (dict): Keyword arguments of the DownloadClient shared by the run.
+        discovery (str): Find Contents files from the "release" index or "html" listing.
+        use_index (bool): Reuse and store package counts in the index in output_dir.
+        build_path_index (bool): Build the path index used by the lookup subcommand.
+        save_matrix (str): Write the package by architecture matrix of an
+            all-architecture run to this path.
+        approximate_budget (float): Count with a Space-Saving sketch using about
+            this many MB instead of exact counts. DEFAULT: exact counts
+        incremental (bool): Update cached files and their indexed counts from pdiffs.
+        hedge_delay (float): Seconds before a download is hedged on the next
+            mirror, None to only fail over.
+        profiler (Profiler): Record every stage of the run, e.g. with a capture.
+            DEFAULT: a new profiler
+        decompressor (str): Decompression backend, "auto" picks the fastest installed.
+
+    Returns:
+        StatsResult: Counts, top packages, per-file statistics and timings of the run.
+
+    """
+    # Imported for a run only, --help and cached runs never load asyncio or the executors
+    import asyncio  # pylint: disable=import-outside-toplevel
+    from .engine import PackageStatsEngine  # pylint: disable=import-outside-toplevel
+    engine = PackageStatsEngine(
+        mirror, output_dir, skip_download, workers=workers, split_files=split_files,
+        pipeline=pipeline, tee=tee, client_options=client_options, discovery=discovery,
+        use_index=use_index, build_path_index=build_path_index, incremental=incremental,
+        hedge_delay=hedge_delay, decompressor=decompressor)
+
+    async def run():
+        # The pooled session must be created inside the running event loop
+        async with engine:
+            return await engine.stats(arch, include_udeb, limit, approximate_budget,
+                                      profiler)
+
+    result = asyncio.run(run())
+    print(result.format())
+    if result.matrix is not None and save_matrix:
+        atomic_write_bytes(save_matrix, result.matrix.to_bytes())
+    if report_memory:
+        print("Peak memory (MB):", peak_memory_mb())
+        if result.matrix is not None:
+            print("Count matrix (MB):", result.matrix.nbytes() / (1 << 20))
+    return result
+
+
+def cli(argv=None):
+    """
+    Command-line interface function to get package statistics.
+
+    Args:
+        argv (list): Command line arguments. DEFAULT: sys.argv[1:]
+
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in SUBCOMMANDS:
+        # Only the module of the subcommand is imported, e.g. --help never loads the server
+        module, function = SUBCOMMANDS[argv[0]]
+        getattr(importlib.import_module(f".{module}", __package__), function)(argv[1:])
+        return
+    argparser = argparse.ArgumentParser(
+        description=("CLI tool to get the package statistics of debian packages given "
+                     "architecture. Runs whose files are all skipped with -s and indexed "
+                     "are answered without contacting the mirror."),
+        epilog=("Subcommands: 'lookup' finds the packages shipping a file, 'batch' "
+                "counts several suites, components and architectures in one run, "
+                "'serve' answers queries over HTTP from counts kept in memory, 'map' "
+                "and 'reduce' split a count across machines, 'diff' compares suites "
+                "and architectures, see "
+                "'package_statistics.py <subcommand> --help'."),
+        parents=[run_options(), download_options()]
+    )
+    argparser.add_argument(
+        "architecture", type=str,
+        help=f"Architecture of the packages to parse, '{ALL_ARCHITECTURES}' for every architecture.")
+    argparser.add_argument(
+        "-m", "--mirror_url", type=str, nargs="+",
+        default=["http://ftp.uk.debian.org/debian/dists/stable/main/"],
+        help=(
+            "Mirror URL for contents files. Several mirrors of the same component "
+            "are ranked by latency, downloads are hedged and fail over between them. "
+            "DEFAULT: http://ftp.uk.debian.org/debian/dists/stable/main/")
+    )
+    argparser.add_argument(
+        "-u", "--udeb",
+        help=("Include udeb file for architecture. \n"
+              "DEFAULT: False"),
+        action="store_true"
+    )
+    argparser.add_argument(
+        "-l", "--limit", type=int, default=10,
+        help=("Top 'l' number of packages with maximum count of files. \n"
+              "DEFAULT: 10"
+              )
+    )
+    argparser.add_argument(
+        "--report-memory",
+        help=("Print peak resident memory after the run. \n"
+              "DEFAULT: False"),
+        action="store_true"
+    )
+    argparser.add_argument(
+        "-p", "--pipeline",
+        help=("Decompress and parse files while they are downloading, in threads of "
+              "the main process, so it cannot be combined with --workers. \n"
+              "DEFAULT: False"),
+        action="store_true"
+    )
+    argparser.add_argument(
+        "--no-cache",
+        help=("Do not store downloaded files in output-dir when pipelining. \n"
+              "DEFAULT: False"),
+        action="store_true"
+    )
+    argparser.add_argument(
+        "--split-files",
+        help=("Split each file into blocks parsed by all workers, "
+              "speeds up single architecture runs. \n"
+              "DEFAULT: False"),
+        action="store_true"
+    )
+    argparser.add_argument(
+        "--build-path-index",
+        help=("Build the file to package index used by the lookup subcommand "
+              "while parsing. \n"
+              "DEFAULT: False"),
+        action="store_true"
+    )
+    argparser.add_argument(
+        "--save-matrix", type=str, default=None,
+        help=(f"With architecture '{ALL_ARCHITECTURES}', write the package by architecture "
+              "count matrix to this file. \n"
+              "DEFAULT: None"),
+    )
+    argparser.add_argument(
+        "--approximate", type=float, nargs="?", const=APPROXIMATE_BUDGET, default=None,
+        metavar="MB",
+        help=("Count with bounded memory Space-Saving sketches of about MB megabytes, "
+              "one for the run and one per file being parsed, and print the error "
+              "bound of each count. \n"
+              f"DEFAULT: exact counts, {APPROXIMATE_BUDGET} MB without a value"),
+    )
+    argparser.add_argument(
+        "--incremental",
+        help=("Update cached Contents files and their indexed counts from the mirror's "
+              "pdiffs instead of downloading them again. \n"
+              "DEFAULT: False"),
+        action="store_true"
+    )
+    argparser.add_argument(
+        "--hedge-delay", type=float, default=HEDGE_DELAY,
+        help=("With several mirrors, seconds before a download is also started on the "
+              "next mirror, a negative value only fails over. \n"
+              f"DEFAULT: {HEDGE_DELAY}"),
+    )
+    argparser.add_argument(
+        "--profile",
+        help=("Print the time, bytes, lines per second and executor queue wait of "
+              "every stage and file after the run. \n"
+              "DEFAULT: False"),
+        action="store_true"
+    )
+    argparser.add_argument(
+        "--profile-json", type=str, default=None,
+        help=("Also write the profile report to this JSON file, implies --profile. \n"
+              "DEFAULT: None"),
+    )
+    argparser.add_argument(
+        "--profile-capture", choices=CAPTURES, default=None,
+        help=("Capture the parse of every file with cProfile or tracemalloc, "
+              "implies --profile. \n"
+              "DEFAULT: None"),
+    )
+    argparser.add_argument(
+        "--decompressor", choices=(AUTO, *BACKENDS), default=AUTO,
+        help=("Decompression backend of gzipped files: the isal or zlib-ng bindings, "
+              "a pigz subprocess or the stdlib gzip module. \n"
+              f"DEFAULT: {AUTO}, the fastest installed"),
+    )
+    args = argparser.parse_args(argv)
+    if args.pipeline and args.workers:
+        argparser.error("--pipeline parses in the main process, --workers has no effect with it")
+    profiler = None
+    if args.profile or args.profile_json or args.profile_capture:
+        profiler = Profiler(args.profile_capture)
+    elif not (args.no_index or args.build_path_index or args.approximate
+              or args.incremental):
+        # Every file cached and indexed: answer without discovery or network imports
+        from .count_index import cached_stats  # pylint: disable=import-outside-toplevel
+        top = cached_stats(args.architecture, args.mirror_url, args.udeb, args.limit,
+                           args.output_dir, args.skip_download)
+        if top is not None:
+            print(format_stats(top))
+            if args.report_memory:
+                print("Peak memory (MB):", peak_memory_mb())
+            return
+    result = package_stats(
+        arch=args.architecture, mirror=args.mirror_url, include_udeb=args.udeb,
+        limit=args.limit, output_dir=args.output_dir, skip_download=args.skip_download,
+        report_memory=args.report_memory, pipeline=args.pipeline, tee=not args.no_cache,
+        workers=args.workers, split_files=args.split_files,
+        client_options=client_options(args),
+        discovery=args.discovery, use_index=not args.no_index,
+        build_path_index=args.build_path_index, save_matrix=args.save_matrix,
+        approximate_budget=args.approximate, incremental=args.incremental,
+        hedge_delay=args.hedge_delay if args.hedge_delay >= 0 else None,
+        profiler=profiler, decompressor=args.decompressor)
+    if profiler is not None:
+        print(result.profile.report())
+        if args.profile_json:
+            result.profile.write_json(args.profile_json)
@@ -0,0 +1,120 @@
+############################################################
+"""
+Command line options shared by the package statistics commands.
+Functions:
+
+    run_options:
+        Parent parser of the options of the commands counting packages.
+
+    download_options:
+        Parent parser of the options of the shared download client.
+
+    client_options:
+        Return the DownloadClient keyword arguments of parsed download options.
+"""
+############################################################
+
+import argparse
+import os
+from .defaults import CONNECTIONS, CONNECTIONS_PER_HOST, MAX_DOWNLOADS, RETRIES
+
+
+def run_options(per_suite=False, skip_download=True, use_index=True):
+    """
+    Parent parser of the options of the commands counting packages.
+
+    Args:
+        per_suite (bool): Files are stored in one directory per suite and component.
+        skip_download (bool): Add -s/--skip-download.
+        use_index (bool): Add --no-index.
+
+    Returns:
+        argparse.ArgumentParser: Parser without help, to pass in parents.
+
+    """
+    argparser = argparse.ArgumentParser(add_help=False)
+    argparser.add_argument(
+        "-o", "--output-dir", type=str, default=os.path.join(os.getcwd(), "downloads"),
+        help=("Download location for content files"
+              f"{', one directory per suite and component' if per_suite else ''}. \n"
+              "DEFAULT: current-working-directory/downloads"),
+    )
+    if skip_download:
+        argparser.add_argument(
+            "-s", "--skip-download", type=int, default=0,
+            help=("Skip download if files are already present and newer than 's' days, "
+                  "otherwise cached files are revalidated with a conditional request. \n"
+                  "DEFAULT: 0"),
+        )
+    argparser.add_argument(
+        "-w", "--workers", type=int, default=0,
+        help=("Number of worker processes parsing files in parallel, "
+              "0 parses in a thread of the main process. \n"
+              "DEFAULT: 0"),
+    )
+    argparser.add_argument(
+        "--discovery", choices=("release", "html"), default="release",
+        help=("Find Contents files from the suite's Release index, or by scraping "
+              "the mirror's directory listing. \n"
+              "DEFAULT: release"),
+    )
+    if use_index:
+        argparser.add_argument(
+            "--no-index",
+            help=("Do not reuse or store parsed package counts in the count index "
+                  "in output-dir. \n"
+                  "DEFAULT: False"),
+            action="store_true"
+        )
+    return argparser
+
+
+def download_options():
+    """
+    Parent parser of the options of the shared download client.
+
+    Returns:
+        argparse.ArgumentParser: Parser without help, to pass in parents.
+
+    """
+    argparser = argparse.ArgumentParser(add_help=False)
+    argparser.add_argument(
+        "--connections", type=int, default=CONNECTIONS,
+        help=("Maximum number of open connections, 0 for no limit. \n"
+              f"DEFAULT: {CONNECTIONS}"),
+    )
+    argparser.add_argument(
+        "--connections-per-host", type=int, default=CONNECTIONS_PER_HOST,
+        help=("Maximum number of open connections to one mirror, 0 for no limit. \n"
+              f"DEFAULT: {CONNECTIONS_PER_HOST}"),
+    )
+    argparser.add_argument(
+        "--max-downloads", type=int, default=MAX_DOWNLOADS,
+        help=("Maximum number of downloads in flight. \n"
+              f"DEFAULT: {MAX_DOWNLOADS}"),
+    )
+    argparser.add_argument(
+        "--retries", type=int, default=RETRIES,
+        help=("Number of retries with backoff on transient download errors. \n"
+              f"DEFAULT: {RETRIES}"),
+    )
+    return argparser
+
+
+def client_options(args):
+    """
+    Return the DownloadClient keyword arguments of parsed download options.
+
+    Args:
+        args (argparse.Namespace): Arguments parsed with download_options as a parent.
+
+    Returns:
+        dict: Keyword arguments of DownloadClient.
+
+    """
+    return {
+        "connections": args.connections,
+        "connections_per_host": args.connections_per_host,
+        "max_downloads": args.max_downloads,
+        "retries": args.retries,
+    }
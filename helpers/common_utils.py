@@ -8,22 +8,38 @@ Functions:
     process_contents_file_list:
         Process the list of file links and organize them by architecture.
 
+    contents_arch:
+        Return the architecture and udeb flag of a Contents file name.
+
     filter_files:
         Filter files based on architecture and include_udeb flag.
 
+    filter_all_files:
+        Return the files of every architecture, honouring the include_udeb flag.
+
+    top_packages:
+        Select the top packages by file count with a bounded heap.
+
+    format_stats:
+        Format rows of package statistics as a table.
+
     return_stats:
         Return formatted package statistics.
 
-    write_a_file_with_unit_tests:
-        Placeholder for writing unit tests (not implemented in the provided code).
+    merge_counts:
+        Merge partial package counts into a target dictionary.
+
+    peak_memory_mb:
+        Return the peak resident memory of the current process in MB.
 """
 ###########################################################
 
 from collections import defaultdict
+import heapq
 import os
-import requests
-from bs4 import BeautifulSoup
+import sys
 from .exceptions import DownloadError
+from .release import CONTENTS_EXTENSIONS
 
 def get_contents_file_list(url):
     """
@@ -36,6 +52,10 @@ def get_contents_file_list(url):
         list: List of file links.
 
     """
+    # Imported here so runs discovering files from the Release index never load
+    # bs4, and runs answered from the count index never load requests
+    import requests  # pylint: disable=import-outside-toplevel
+    from bs4 import BeautifulSoup  # pylint: disable=import-outside-toplevel
     try:
         response = requests.get(url, timeout=10)
         response.raise_for_status()  # Check for errors in the HTTP response
@@ -61,25 +81,45 @@ def process_contents_file_list(url, file_links):
 
     """
     files = defaultdict(list)
+    # Keep one compression of each file, following CONTENTS_EXTENSIONS
+    chosen = {}
     for link in file_links:
-        file_url = link['href']
-        if file_url.endswith(".gz"):
-            file_name = link.text
-            # split file name by extionsion and get architecture
-            file_name_wo_ext, _ext = os.path.splitext(file_name)
-            file_name_split = file_name_wo_ext.split("-")
-            arch = file_name_split[-1]
-            # construct dictionary indexed by architecture
-            files[arch].append(
-                {
-                    "name": link['href'],
-                    "link": os.path.join(url, link.text),
-                    "udeb": "udeb" in file_name_split
-                }
-            )
+        stem, ext = os.path.splitext(link['href'])
+        if ext in CONTENTS_EXTENSIONS and (
+                stem not in chosen or CONTENTS_EXTENSIONS.index(ext) <
+                CONTENTS_EXTENSIONS.index(os.path.splitext(chosen[stem]['href'])[1])):
+            chosen[stem] = link
+    for link in chosen.values():
+        file_name = link.text
+        arch, udeb = contents_arch(file_name)
+        # construct dictionary indexed by architecture
+        files[arch].append(
+            {
+                "name": link['href'],
+                "link": os.path.join(url, link.text),
+                "udeb": udeb
+            }
+        )
     return files
 
 
+def contents_arch(file_name):
+    """
+    Return the architecture and udeb flag of a Contents file name.
+
+    Args:
+        file_name (str): File name or URL, e.g. Contents-udeb-amd64.gz
+
+    Returns:
+        tuple: Architecture and True for udeb files.
+
+    """
+    # split file name by extension and get architecture
+    file_name_wo_ext, _ext = os.path.splitext(os.path.basename(file_name))
+    file_name_split = file_name_wo_ext.split("-")
+    return file_name_split[-1], "udeb" in file_name_split
+
+
 def filter_files(files, arch, include_udeb, all_files=False):
     """
     Filter files based on architecture and include_udeb flag.
@@ -105,7 +145,75 @@ def filter_files(files, arch, include_udeb, all_files=False):
     return urls
 
 
-def return_stats(package_stats, descending=True, count=10):
+def filter_all_files(files, include_udeb):
+    """
+    Return the files of every architecture, honouring the include_udeb flag.
+
+    Args:
+        files (dict): Dictionary containing files organized by architecture.
+        include_udeb (bool): Flag to include udeb files.
+
+    Returns:
+        list: URLs of the files of every architecture.
+
+    """
+    urls = []
+    for arch in files:
+        urls.extend(filter_files(files, arch, include_udeb))
+    return urls
+
+
+def _rank_key(descending):
+    """
+    Return the sort key ranking (package, count) items, ties broken by package name.
+    """
+    if descending:
+        return lambda item: (-item[1], item[0])
+    return lambda item: (item[1], item[0])
+
+
+def top_packages(package_stats, descending=True, count=10):
+    """
+    Select the top packages by file count with a bounded heap.
+    Runs in O(n log count) instead of sorting every package.
+
+    Args:
+        package_stats (dict): Dictionary containing package statistics.
+        descending (bool): Flag to indicate sorting order.
+        count (int): Number of top packages to select.
+
+    Returns:
+        list: (package, count) tuples in rank order, ties ordered by package name.
+
+    """
+    return heapq.nsmallest(max(count, 0), package_stats.items(), key=_rank_key(descending))
+
+
+def format_stats(rows, errors=None):
+    """
+    Format rows of package statistics as a table.
+
+    Args:
+        rows (list): (package, count) tuples in display order.
+        errors (callable): Return the error bound of an approximate count,
+            shown in an extra column. DEFAULT: exact counts
+
+    Returns:
+        str: Formatted package statistics.
+
+    """
+    if errors is None:
+        output = [f"{'Package':50} \t File Count"]
+        for package, count in rows:
+            output.append(f"{package:50} \t {count}")
+        return "\n".join(output)
+    output = [f"{'Package':50} \t File Count \t Error"]
+    for package, count in rows:
+        output.append(f"{package:50} \t {count} \t +0/-{errors(package)}")
+    return "\n".join(output)
+
+
+def return_stats(package_stats, descending=True, count=10, errors=None):
     """
     Return formatted package statistics.
 
@@ -113,14 +221,48 @@ def return_stats(package_stats, descending=True, count=10):
         package_stats (dict): Dictionary containing package statistics.
         descending (bool): Flag to indicate sorting order.
         count (int): Number of top packages to display.
+        errors (callable): Return the error bound of an approximate count,
+            e.g. SpaceSaving.error. DEFAULT: exact counts
 
     Returns:
         str: Formatted package statistics.
 
     """
-    sorted_stats = sorted(package_stats.items(),
-                          key=lambda x: x[1], reverse=descending)
-    output = [f"{'Package':50} \t File Count"]
-    for line in range(min(count, len(sorted_stats))):
-        output.append(f"{sorted_stats[line][0]:50} \t {sorted_stats[line][1]}")
-    return "\n".join(output)
+    return format_stats(top_packages(package_stats, descending, count), errors)
+
+
+def merge_counts(target, partial):
+    """
+    Merge partial package counts into a target dictionary.
+
+    Args:
+        target (dict): Package counts to update in place.
+        partial (dict): Package counts to add.
+
+    Returns:
+        dict: The updated target.
+
+    """
+    for package, count in partial.items():
+        target[package] = target.get(package, 0) + count
+    return target
+
+
+def peak_memory_mb():
+    """
+    Return the peak resident memory of the current process in MB.
+
+    Returns:
+        float: Peak resident set size in MB, or 0.0 where unsupported.
+
+    """
+    try:
+        import resource  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        # resource is unavailable on Windows
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and kilobytes elsewhere
+    if sys.platform == "darwin":
+        return round(peak / (1024 * 1024), 2)
+    return round(peak / 1024, 2)
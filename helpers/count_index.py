@@ -0,0 +1,224 @@
+############################################################
+"""
+Persistent index of package counts of parsed Contents files.
+Counts are stored in SQLite keyed by the SHA256 of the Contents file,
+so an unchanged file never has to be parsed again.
+Functions:
+
+    cached_counts:
+        Read the counts of an architecture from the count index when every file is cached.
+
+    cached_stats:
+        Answer from the count index when every file of an architecture is cached.
+
+Classes:
+
+    CountIndex:
+        SQLite store of package counts per Contents file.
+"""
+############################################################
+
+import os
+import sqlite3
+import time
+from collections import Counter
+from .common_utils import contents_arch, top_packages
+from .defaults import ALL_ARCHITECTURES
+from .download_cache import CacheManifest, SEC_IN_DAY, is_recent_download
+
+INDEX_NAME = "counts.sqlite3"
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    sha256 TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counts (
+    sha256 TEXT NOT NULL,
+    package TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (sha256, package)
+) WITHOUT ROWID;
+"""
+
+
+class CountIndex:
+    """
+    SQLite store of package counts per Contents file.
+
+    Args:
+        path (str): Path of the SQLite database, created if missing.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        """
+        Close the database.
+        """
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def has(self, sha256):
+        """
+        Check if the counts of a Contents file are stored.
+
+        Args:
+            sha256 (str): SHA256 of the Contents file.
+
+        Returns:
+            bool: True if the counts are stored.
+
+        """
+        row = self.connection.execute(
+            "SELECT 1 FROM sources WHERE sha256 = ?", (sha256,)).fetchone()
+        return row is not None
+
+    def get(self, sha256):
+        """
+        Load the counts of a Contents file.
+
+        Args:
+            sha256 (str): SHA256 of the Contents file.
+
+        Returns:
+            dict: Package name to file count, None if not stored.
+
+        """
+        if not self.has(sha256):
+            return None
+        return dict(self.connection.execute(
+            "SELECT package, count FROM counts WHERE sha256 = ?", (sha256,)))
+
+    def iter_counts(self, sha256):
+        """
+        Iterate over the counts of a Contents file without loading them all.
+
+        Args:
+            sha256 (str): SHA256 of the Contents file.
+
+        Yields:
+            tuple: Package name and file count.
+
+        """
+        yield from self.connection.execute(
+            "SELECT package, count FROM counts WHERE sha256 = ?", (sha256,))
+
+    def put(self, sha256, name, counts):
+        """
+        Store the counts of a Contents file, replacing previous counts.
+
+        Args:
+            sha256 (str): SHA256 of the Contents file.
+            name (str): File name, for reference.
+            counts (dict): Package name to file count.
+
+        """
+        with self.connection:
+            self.connection.execute("DELETE FROM counts WHERE sha256 = ?", (sha256,))
+            self.connection.executemany(
+                "INSERT INTO counts (sha256, package, count) VALUES (?, ?, ?)",
+                ((sha256, package, count) for package, count in counts.items()))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO sources (sha256, name, created) VALUES (?, ?, ?)",
+                (sha256, name, time.time()))
+
+    def union(self, sha256s):
+        """
+        Sum the counts of several Contents files, e.g. all architectures or
+        udeb and non-udeb files, without loading them one by one.
+        Like parsing, every listed file counts, so two files with the same
+        content, e.g. an architecture identical to another, count twice.
+
+        Args:
+            sha256s (iterable): SHA256 of the Contents files.
+
+        Returns:
+            dict: Package name to total file count.
+
+        """
+        times = Counter(sha256s)
+        if not times:
+            return {}
+        values = ",".join(["(?, ?)"] * len(times))
+        return dict(self.connection.execute(
+            f"WITH wanted (sha256, times) AS (VALUES {values}) "
+            "SELECT package, SUM(count * times) FROM counts JOIN wanted USING (sha256) "
+            "GROUP BY package", [x for item in times.items() for x in item]))
+
+
+def cached_counts(arch, mirror, include_udeb, output_dir, skip_download):
+    """
+    Read the counts of an architecture from the count index when every file is cached.
+    The files are the ones the last discovery of the mirror recorded in the
+    cache manifest, so the run sends no request and never imports the network
+    libraries. Only a listing and files newer than skip_download days are
+    used, as a normal run would.
+
+    Args:
+        arch (str): Architecture of the packages to parse.
+        mirror (str or list): Mirror URL the files were downloaded from, or several mirrors.
+        include_udeb (bool): Flag to include udeb files for architecture.
+        output_dir (str): Download location for content files.
+        skip_download (int): Number of days a cached file is used without asking the mirror.
+
+    Returns:
+        dict: Package name to file count, None if the mirror was not discovered
+            recently, or a file is missing, older than skip_download days or
+            not in the count index.
+
+    """
+    index_file = os.path.join(output_dir, INDEX_NAME)
+    if not skip_download or arch == ALL_ARCHITECTURES or not os.path.exists(index_file):
+        return None
+    mirrors = [mirror] if isinstance(mirror, str) else list(mirror)
+    prefixes = tuple(url if url.endswith("/") else url + "/" for url in mirrors)
+    manifest = CacheManifest.load(output_dir)
+    listing = next((names for names in (manifest.listing(url, skip_download * SEC_IN_DAY)
+                                        for url in mirrors) if names is not None), None)
+    if listing is None:
+        return None
+    # Every file a normal run would count, e.g. udeb files never downloaded make it a miss
+    names = [name for name in listing if contents_arch(name)[0] == arch
+             and (include_udeb or not contents_arch(name)[1])]
+    entries = [manifest.get(name) for name in names]
+    if not names or not all(
+            entry and entry["url"].startswith(prefixes)
+            and is_recent_download(os.path.join(output_dir, name), skip_download)
+            for name, entry in zip(names, entries)):
+        return None
+    with CountIndex(index_file) as count_index:
+        sha256s = [entry["sha256"] for entry in entries]
+        if not all(count_index.has(sha256) for sha256 in sha256s):
+            return None
+        return count_index.union(sha256s)
+
+
+def cached_stats(arch, mirror, include_udeb, limit, output_dir, skip_download):
+    """
+    Answer from the count index when every file of an architecture is cached,
+    see cached_counts.
+
+    Args:
+        arch (str): Architecture of the packages to parse.
+        mirror (str or list): Mirror URL the files were downloaded from, or several mirrors.
+        include_udeb (bool): Flag to include udeb files for architecture.
+        limit (int): Top 'limit' number of packages with maximum count of files.
+        output_dir (str): Download location for content files.
+        skip_download (int): Number of days a cached file is used without asking the mirror.
+
+    Returns:
+        list: (package, count) tuples of the top packages, None if the counts
+            are not all cached.
+
+    """
+    counts = cached_counts(arch, mirror, include_udeb, output_dir, skip_download)
+    return None if counts is None else top_packages(counts, True, limit)
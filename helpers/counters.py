@@ -0,0 +1,226 @@
+############################################################
+"""
+Compact package counters for runs over many Contents files.
+Every package name is interned once to an integer id and the counts of
+all architectures are kept in one flat array('Q'), row major with one
+column per architecture, instead of one dictionary per file.
+Functions:
+
+    dict_memory:
+        Estimate the memory used by a dictionary of package counts.
+
+Classes:
+
+    PackageMatrix:
+        Package by column matrix of file counts.
+"""
+############################################################
+
+from array import array
+import json
+import struct
+import sys
+
+MAGIC = b"DPSMATRX"
+HEADER_LENGTH = struct.Struct("<Q")
+
+
+def dict_memory(counts):
+    """
+    Estimate the memory used by a dictionary of package counts.
+
+    Args:
+        counts (dict): Package name to count.
+
+    Returns:
+        int: Bytes used by the dictionary, its keys and values.
+
+    """
+    return sys.getsizeof(counts) + sum(
+        sys.getsizeof(package) + sys.getsizeof(count) for package, count in counts.items())
+
+
+class PackageMatrix:
+    """
+    Package by column matrix of file counts.
+    Columns are usually architectures. Behaves like a read only mapping of
+    package name to the total count over all columns, so it can be passed
+    to return_stats.
+
+    Args:
+        columns (iterable): Column names known in advance.
+
+    """
+    def __init__(self, columns=()):
+        self.columns = []
+        self.column_ids = {}
+        self.names = []
+        self.ids = {}
+        self.counts = array('Q')
+        for column in columns:
+            self.column(column)
+
+    def intern(self, name):
+        """
+        Return the id of a package name, adding a row if it is new.
+
+        Args:
+            name (str): Package name.
+
+        Returns:
+            int: Row of the package.
+
+        """
+        package_id = self.ids.get(name)
+        if package_id is None:
+            package_id = self.ids[name] = len(self.names)
+            self.names.append(sys.intern(name))
+            self.counts.frombytes(bytes(self.counts.itemsize * len(self.columns)))
+        return package_id
+
+    def column(self, name):
+        """
+        Return the index of a column, adding it if it is new.
+
+        Args:
+            name (str): Column name, e.g. an architecture.
+
+        Returns:
+            int: Index of the column.
+
+        """
+        index = self.column_ids.get(name)
+        if index is not None:
+            return index
+        index = self.column_ids[name] = len(self.columns)
+        self.columns.append(name)
+        if self.names:
+            # Widen every row by one column
+            width = len(self.columns)
+            widened = array('Q', bytes(self.counts.itemsize * width * len(self.names)))
+            for row in range(len(self.names)):
+                widened[row * width:row * width + width - 1] = \
+                    self.counts[row * (width - 1):(row + 1) * (width - 1)]
+            self.counts = widened
+        return index
+
+    def add(self, column, counts):
+        """
+        Add package counts to a column.
+
+        Args:
+            column (str): Column name.
+            counts (dict): Package name to count.
+
+        """
+        index = self.column(column)
+        width = len(self.columns)
+        for name, count in counts.items():
+            self.counts[self.intern(name) * width + index] += count
+
+    def column_counts(self, column):
+        """
+        Return the counts of one column.
+
+        Args:
+            column (str): Column name.
+
+        Returns:
+            dict: Package name to count, without zero counts.
+
+        """
+        index = self.column_ids[column]
+        width = len(self.columns)
+        values = self.counts[index::width]
+        return {name: count for name, count in zip(self.names, values) if count}
+
+    def row(self, name):
+        """
+        Return the counts of one package per column.
+
+        Args:
+            name (str): Package name.
+
+        Returns:
+            dict: Column name to count.
+
+        """
+        width = len(self.columns)
+        start = self.ids[name] * width
+        return dict(zip(self.columns, self.counts[start:start + width]))
+
+    def items(self):
+        """
+        Yield package names with their total count over all columns.
+        """
+        width = len(self.columns)
+        if width == 1:
+            yield from zip(self.names, self.counts)
+            return
+        for package_id, name in enumerate(self.names):
+            yield name, sum(self.counts[package_id * width:(package_id + 1) * width])
+
+    def __getitem__(self, name):
+        return sum(self.row(name).values())
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def nbytes(self):
+        """
+        Estimate the memory used by the matrix.
+
+        Returns:
+            int: Bytes used by the names, the id map and the counts.
+
+        """
+        return (sys.getsizeof(self.ids) + sys.getsizeof(self.names) +
+                sum(sys.getsizeof(name) for name in self.names) +
+                self.counts.itemsize * len(self.counts) + sys.getsizeof(self.counts))
+
+    def to_bytes(self):
+        """
+        Serialize the matrix.
+
+        Returns:
+            bytes: Magic, JSON header with columns and names, and the raw counts.
+
+        """
+        header = json.dumps({
+            "columns": self.columns,
+            "names": self.names,
+            "byteorder": sys.byteorder,
+        }).encode()
+        return MAGIC + HEADER_LENGTH.pack(len(header)) + header + self.counts.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Deserialize a matrix written by to_bytes.
+
+        Args:
+            data (bytes): Serialized matrix.
+
+        Returns:
+            PackageMatrix: The matrix.
+
+        """
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a package matrix")
+        offset = len(MAGIC) + HEADER_LENGTH.size
+        (length,) = HEADER_LENGTH.unpack_from(data, len(MAGIC))
+        header = json.loads(data[offset:offset + length])
+        matrix = cls(header["columns"])
+        matrix.names = [sys.intern(name) for name in header["names"]]
+        matrix.ids = {name: package_id for package_id, name in enumerate(matrix.names)}
+        matrix.counts = array('Q')
+        matrix.counts.frombytes(data[offset + length:])
+        if header["byteorder"] != sys.byteorder:
+            matrix.counts.byteswap()
+        return matrix
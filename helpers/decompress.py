@@ -0,0 +1,165 @@
+############################################################
+"""
+Pluggable decompression backends for Contents files.
+Gzipped files are read with the fastest backend available: the isal or
+zlib-ng bindings when installed, a pigz subprocess decompressing on another
+core, or the stdlib gzip module. Files compressed with xz are read with the
+xz tool when the subprocess backend is selected, with lzma otherwise.
+Functions:
+
+    available_backends:
+        List the decompression backends usable on this system.
+
+    select_backend:
+        Resolve a backend name, picking the fastest available for "auto".
+
+    open_contents:
+        Open a compressed Contents file for reading with a backend.
+
+Classes:
+
+    PipeReader:
+        Binary file object reading the output of a decompressor subprocess.
+"""
+############################################################
+
+import gzip
+import importlib
+import lzma
+import os
+import shutil
+import subprocess
+from .streaming import BLOCK_SIZE
+
+AUTO = "auto"
+# Gzip backends from fastest to slowest, "auto" picks the first available
+BACKENDS = ("isal", "zlib-ng", "pigz", "gzip")
+BACKEND_MODULES = {"isal": "isal.igzip_threaded", "zlib-ng": "zlib_ng.gzip_ng_threaded"}
+PIPE_COMMANDS = {".gz": ("pigz", "-dc"), ".xz": ("xz", "-dc", "-T0")}
+
+
+class PipeReader:
+    """
+    Binary file object reading the output of a decompressor subprocess.
+    The subprocess inflates on another core while the caller parses, its
+    exit status is checked on close so a corrupt file is not silently truncated.
+
+    Args:
+        command (tuple): Decompressor command, the path is appended.
+        path (str): Path of the compressed file.
+
+    """
+    def __init__(self, command, path):
+        self.path = path
+        # pylint: disable-next=consider-using-with
+        self._process = subprocess.Popen(
+            [*command, path], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            bufsize=BLOCK_SIZE)
+
+    def read(self, size=-1):
+        """
+        Read up to size decompressed bytes, all remaining bytes if size is negative.
+        """
+        return self._process.stdout.read(size)
+
+    def close(self):
+        """
+        Wait for the subprocess and check it succeeded.
+
+        Raises:
+            OSError: If the decompressor failed, e.g. on a corrupt file.
+
+        """
+        if self._process.returncode is not None:
+            return
+        stdout_left = self._process.stdout.read(1)
+        self._process.stdout.close()
+        if stdout_left:
+            # Closed before the end of the data, stop the decompressor
+            self._process.kill()
+            self._process.wait()
+            self._process.stderr.close()
+            return
+        stderr = self._process.stderr.read()
+        self._process.stderr.close()
+        if self._process.wait():
+            raise OSError(f"{os.path.basename(self.path)}: {stderr.decode().strip()}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _is_available(backend):
+    if backend in BACKEND_MODULES:
+        try:
+            importlib.import_module(BACKEND_MODULES[backend])
+        except ImportError:
+            return False
+        return True
+    if backend == "pigz":
+        return shutil.which("pigz") is not None
+    return backend == "gzip"
+
+
+def available_backends():
+    """
+    List the decompression backends usable on this system.
+
+    Returns:
+        list: Backend names from fastest to slowest, always ending with gzip.
+
+    """
+    return [backend for backend in BACKENDS if _is_available(backend)]
+
+
+def select_backend(name=AUTO):
+    """
+    Resolve a backend name, picking the fastest available for "auto".
+
+    Args:
+        name (str): Backend name or "auto".
+
+    Returns:
+        str: Name of an available backend.
+
+    Raises:
+        ValueError: If the backend is unknown or not installed.
+
+    """
+    if name in (None, AUTO):
+        return available_backends()[0]
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown decompression backend {name}, expected one of {BACKENDS}")
+    if not _is_available(name):
+        raise ValueError(f"Decompression backend {name} is not installed")
+    return name
+
+
+def open_contents(path, backend="gzip"):
+    """
+    Open a compressed Contents file for reading with a backend.
+    The compression is taken from the file extension.
+
+    Args:
+        path (str): Path of a .gz or .xz file.
+        backend (str): Backend from select_backend. DEFAULT: gzip
+
+    Returns:
+        Binary file object of the decompressed data, usable as a context manager.
+
+    """
+    ext = os.path.splitext(path)[1]
+    if ext == ".xz":
+        if backend == "pigz" and shutil.which("xz"):
+            return PipeReader(PIPE_COMMANDS[ext], path)
+        return lzma.open(path, 'rb')
+    if backend == "pigz":
+        return PipeReader(PIPE_COMMANDS[".gz"], path)
+    if backend in BACKEND_MODULES:
+        # The threaded readers inflate in a thread that releases the GIL
+        module = importlib.import_module(BACKEND_MODULES[backend])
+        return module.open(path, 'rb', threads=1)
+    return gzip.open(path, 'rb')
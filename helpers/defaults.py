@@ -0,0 +1,16 @@
+############################################################
+"""
+Default settings shown in the help of the command line.
+The modules using them import asyncio, the parse executors or SQLite,
+the command line imports them from here so --help and runs answered
+from the count index load none of those.
+"""
+############################################################
+
+ALL_ARCHITECTURES = "any"
+APPROXIMATE_BUDGET = 8  # MB of the Space-Saving sketch of --approximate
+CONNECTIONS = 8
+CONNECTIONS_PER_HOST = 4
+MAX_DOWNLOADS = 8
+RETRIES = 3
+HEDGE_DELAY = 2.0  # Seconds before a download is also started on the next mirror
@@ -0,0 +1,270 @@
+############################################################
+"""
+Differences of package counts between sources, e.g. two suites or two
+architectures. The counts of every source are aligned in one PackageMatrix
+with one column per source, so each package name is interned once and a
+comparison walks two columns by package id.
+Functions:
+
+    diff_columns:
+        Compare one column of a count matrix to a base column.
+
+    diff_counts:
+        Compare the counts of several sources to the first one.
+
+    format_diff:
+        Format a comparison as the tables printed by the command line.
+
+    diff_stats:
+        Compare the package counts of several suites and architectures.
+
+    diff_cli:
+        Command-line interface of the diff subcommand.
+"""
+############################################################
+
+import argparse
+import asyncio
+from contextlib import AsyncExitStack
+import heapq
+import json
+import os
+from .exceptions import DownloadError
+from .counters import PackageMatrix
+from .download_cache import atomic_write_bytes
+from .cli_options import run_options
+from .engine import PackageStatsEngine
+from .count_index import cached_counts
+from .package_stats_helper_async import ARCHIVE
+
+
+def diff_columns(matrix, base, other, limit=10):
+    """
+    Compare one column of a count matrix to a base column.
+
+    Args:
+        matrix (PackageMatrix): Counts with one column per source.
+        base (str): Column compared against.
+        other (str): Column compared to the base.
+        limit (int): Number of packages of every ranking.
+
+    Returns:
+        dict: The "base" and "other" column names, "packages" with the number of
+            packages of each column and of "added", "removed" and "changed" ones,
+            "absolute" and "relative" with (package, before, after, change) tuples
+            of the largest changes of packages in both columns, and "added" and
+            "removed" with (package, count) tuples of the largest new and gone packages.
+
+    """
+    width = len(matrix.columns)
+    before = matrix.counts[matrix.column_ids[base]::width]
+    after = matrix.counts[matrix.column_ids[other]::width]
+    changed, added, removed = [], [], []
+    for package, old, new in zip(matrix.names, before, after):
+        if old == new:
+            continue
+        if not old:
+            added.append((package, new))
+        elif not new:
+            removed.append((package, old))
+        else:
+            changed.append((package, old, new, new - old))
+    limit = max(limit, 0)
+    return {
+        "base": base,
+        "other": other,
+        "packages": {
+            "base": sum(1 for count in before if count),
+            "other": sum(1 for count in after if count),
+            "added": len(added),
+            "removed": len(removed),
+            "changed": len(changed),
+        },
+        # Ties are broken by package name, like top_packages
+        "absolute": heapq.nsmallest(limit, changed, key=lambda row: (-abs(row[3]), row[0])),
+        "relative": heapq.nsmallest(
+            limit, changed, key=lambda row: (-abs(row[3]) / row[1], -abs(row[3]), row[0])),
+        "added": heapq.nsmallest(limit, added, key=lambda row: (-row[1], row[0])),
+        "removed": heapq.nsmallest(limit, removed, key=lambda row: (-row[1], row[0])),
+    }
+
+
+def diff_counts(sources, limit=10):
+    """
+    Compare the counts of several sources to the first one.
+
+    Args:
+        sources (dict): Source name to package counts, in order, the first being the base.
+            Counts can be any mapping with items(), e.g. a PackageMatrix.
+        limit (int): Number of packages of every ranking.
+
+    Returns:
+        list: diff_columns result of every source after the first.
+
+    Raises:
+        ValueError: If there are fewer than two sources.
+
+    """
+    if len(sources) < 2:
+        raise ValueError("At least two sources are needed for a comparison")
+    matrix = PackageMatrix(sources)
+    for name, counts in sources.items():
+        matrix.add(name, counts)
+    base, *others = matrix.columns
+    return [diff_columns(matrix, base, other, limit) for other in others]
+
+
+def format_diff(comparison):
+    """
+    Format a comparison as the tables printed by the command line.
+
+    Args:
+        comparison (dict): Result of diff_columns.
+
+    Returns:
+        str: Summary line and one table per ranking.
+
+    """
+    packages = comparison["packages"]
+    output = [f"{comparison['base']} -> {comparison['other']}: {packages['base']} -> "
+              f"{packages['other']} packages, {packages['added']} added, "
+              f"{packages['removed']} removed, {packages['changed']} changed"]
+    for key, title in (("absolute", "Largest changes"), ("relative", "Largest relative changes")):
+        output.append(f"\n{title}\n{'Package':50} \t Before \t After \t Change")
+        for package, old, new, change in comparison[key]:
+            output.append(f"{package:50} \t {old} \t {new} \t {change:+} ({change / old:+.1%})")
+    for key, title in (("added", "Added"), ("removed", "Removed")):
+        output.append(f"\n{title}\n{'Package':50} \t File Count")
+        for package, count in comparison[key]:
+            output.append(f"{package:50} \t {count}")
+    return "\n".join(output)
+
+
+def diff_stats(archive, sources, component, include_udeb, limit, output_dir, skip_download,
+               workers=0, discovery="release", use_index=True):
+    """
+    Compare the package counts of several suites and architectures.
+    Sources answered from the count index, see cached_counts, send no request.
+    The others are counted concurrently with one engine per suite, storing
+    files in output_dir/suite/component like the batch and serve subcommands,
+    so a repeated comparison only reads indexed counts.
+
+    Args:
+        archive (str): Archive URL holding the dists directory.
+        sources (list): (suite, architecture) tuples, the first being the base.
+        component (str): Component of the suites.
+        include_udeb (bool): Flag to include udeb files.
+        limit (int): Number of packages of every ranking.
+        output_dir (str): Download location for content files.
+        skip_download (int): Skip download if files are already present and newer than 's' days.
+        workers (int): Number of worker processes parsing files, 0 parses in threads.
+        discovery (str): Find Contents files from the "release" index or "html" listing.
+        use_index (bool): Reuse and store package counts in the index in output_dir.
+
+    Returns:
+        dict: "sources" with the name, suite, architecture and whether the counts
+            were "cached" of every source, and "comparisons" with the diff_columns
+            result of every source against the first.
+
+    Raises:
+        DownloadError: If a Contents file of a source could not be counted.
+        ValueError: If a source has no Contents files.
+
+    """
+    sources = list(dict.fromkeys(sources))
+    archive = archive if archive.endswith("/") else archive + "/"
+
+    def mirror(suite):
+        return f"{archive}dists/{suite}/{component}/"
+
+    def suite_dir(suite):
+        return os.path.join(output_dir, suite, component)
+
+    counts = {}
+    for suite, arch in sources:
+        if use_index:
+            counts[suite, arch] = cached_counts(
+                arch, mirror(suite), include_udeb, suite_dir(suite), skip_download)
+    missing = [source for source in sources if counts.get(source) is None]
+
+    async def run():
+        async with AsyncExitStack() as stack:
+            engines = {}
+            for suite in dict.fromkeys(suite for suite, _arch in missing):
+                engines[suite] = await stack.enter_async_context(PackageStatsEngine(
+                    mirror(suite), suite_dir(suite), skip_download, workers=workers,
+                    discovery=discovery, use_index=use_index))
+            return await asyncio.gather(*(
+                engines[suite].stats(arch, include_udeb, limit=0) for suite, arch in missing))
+
+    if missing:
+        results = asyncio.run(run())
+        failed = [stats.name for result in results for stats in result.files if stats.error]
+        if failed:
+            # A missing file would show up as removed packages
+            raise DownloadError(", ".join(failed), "not counted, no comparison made")
+        empty = [f"{suite}/{arch}" for (suite, arch), result in zip(missing, results)
+                 if not result.files]
+        if empty:
+            raise ValueError(f"No Contents files for {', '.join(empty)}")
+        for source, result in zip(missing, results):
+            counts[source] = result.counts
+    comparisons = diff_counts(
+        {f"{suite}/{arch}": counts[suite, arch] for suite, arch in sources}, limit)
+    return {
+        "sources": [{"name": f"{suite}/{arch}", "suite": suite, "architecture": arch,
+                     "cached": (suite, arch) not in missing} for suite, arch in sources],
+        "comparisons": comparisons,
+    }
+
+
+def diff_cli(argv):
+    """
+    Command-line interface of the diff subcommand.
+
+    Args:
+        argv (list): Arguments after the subcommand name.
+
+    """
+    argparser = argparse.ArgumentParser(
+        prog="package_statistics.py diff",
+        description=("Compare the package counts of suites and architectures: the largest "
+                     "absolute and relative changes, added and removed packages of every "
+                     "source against the first one. Sources whose files are all skipped "
+                     "with -s and indexed are compared without contacting the mirror."),
+        parents=[run_options(per_suite=True)]
+    )
+    argparser.add_argument(
+        "sources", nargs="+",
+        help=("Sources as suite/architecture, or an architecture of --suite, e.g. "
+              "bookworm/amd64 trixie/amd64 or amd64 arm64. The first is the base."))
+    argparser.add_argument(
+        "--suite", type=str, default="stable",
+        help="Suite of sources given as an architecture only. DEFAULT: stable")
+    argparser.add_argument(
+        "--component", type=str, default="main",
+        help="Component of the suites. DEFAULT: main")
+    argparser.add_argument(
+        "-m", "--archive", type=str, default=ARCHIVE,
+        help=f"Archive URL holding the dists directory. DEFAULT: {ARCHIVE}")
+    argparser.add_argument(
+        "-u", "--udeb", action="store_true",
+        help="Include udeb files. DEFAULT: False")
+    argparser.add_argument(
+        "-l", "--limit", type=int, default=10,
+        help="Top 'l' packages of every ranking. DEFAULT: 10")
+    argparser.add_argument(
+        "--json", type=str, default=None,
+        help="Also write the comparisons to this JSON file.")
+    args = argparser.parse_args(argv)
+    sources = [tuple(source.split("/", 1)) if "/" in source else (args.suite, source)
+               for source in args.sources]
+    if len(set(sources)) < 2:
+        argparser.error("at least two different sources are needed")
+    results = diff_stats(
+        args.archive, sources, args.component, args.udeb, args.limit, args.output_dir,
+        args.skip_download, workers=args.workers, discovery=args.discovery,
+        use_index=not args.no_index)
+    print("\n\n".join(format_diff(comparison) for comparison in results["comparisons"]))
+    if args.json:
+        atomic_write_bytes(args.json, json.dumps(results, indent=1).encode())
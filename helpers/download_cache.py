@@ -0,0 +1,389 @@
+############################################################
+"""
+Validated cache of downloaded Contents files.
+A manifest in the download directory records the ETag, Last-Modified,
+size and SHA256 of every downloaded file, so downloads can be sent as
+conditional requests and a 304 response reuses the cached file.
+Functions:
+
+    file_sha256:
+        Compute the SHA256 of a file.
+
+    temp_path:
+        Return a temporary path next to a file for atomic writes.
+
+    atomic_write_bytes:
+        Write data to a file through a temporary file and rename.
+
+    is_recent_download:
+        Check if a downloaded file exists and is newer than skip_download days.
+
+Classes:
+
+    CacheManifest:
+        Manifest of the downloaded files of a directory.
+
+    CacheFileWriter:
+        Asynchronous writer hashing a download into a temporary file and renaming it on success.
+"""
+############################################################
+
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+import time
+import uuid
+try:
+    import fcntl
+except ImportError:  # Windows, saves of concurrent runs are not serialized
+    fcntl = None
+
+MANIFEST_NAME = ".contents-manifest.json"
+HASH_BUF_SIZE = 1 << 20
+SEC_IN_DAY = 86400
+
+
+def file_sha256(path):
+    """
+    Compute the SHA256 of a file.
+
+    Args:
+        path (str): Path of the file.
+
+    Returns:
+        str: Hex digest of the file.
+
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BUF_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def temp_path(path):
+    """
+    Return a temporary path next to a file for atomic writes.
+    The temporary file is in the same directory so os.replace is atomic.
+
+    Args:
+        path (str): Final path of the file.
+
+    Returns:
+        str: Unique temporary path.
+
+    """
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".{name}.{uuid.uuid4().hex}.part")
+
+
+def atomic_write_bytes(path, data):
+    """
+    Write data to a file through a temporary file and rename.
+
+    Args:
+        path (str): Path of the file.
+        data (bytes): Content of the file.
+
+    """
+    tmp_path = temp_path(path)
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def is_recent_download(output_path, skip_download):
+    """
+    Check if a downloaded file exists and is newer than skip_download days.
+
+    Args:
+        output_path (str): Path of the downloaded file.
+        skip_download (int): Number of days a download is considered recent.
+
+    Returns:
+        bool: True if the download can be skipped.
+
+    """
+    if not skip_download or not os.path.exists(output_path):
+        return False
+    time_since_download = time.time() - os.path.getmtime(output_path)
+    return time_since_download < skip_download * SEC_IN_DAY
+
+
+class CacheManifest:
+    """
+    Manifest of the downloaded files of a directory.
+    Entries are keyed by file name and hold the url, etag, last_modified,
+    size and sha256 of the file. Listings are keyed by mirror URL and hold
+    the names of the Contents files last discovered on the mirror.
+    Saving merges the entries updated here into the manifest on disk, so
+    runs and engines sharing a directory keep each other's entries.
+
+    Args:
+        directory (str): Download directory holding the manifest.
+
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        self.entries = {}
+        self.listings = {}
+        # Names and mirrors updated since the last save
+        self._updated_entries = set()
+        self._updated_listings = set()
+
+    @classmethod
+    def load(cls, directory):
+        """
+        Load the manifest of a directory, empty if missing or unreadable.
+
+        Args:
+            directory (str): Download directory holding the manifest.
+
+        Returns:
+            CacheManifest: Loaded manifest.
+
+        """
+        manifest = cls(directory)
+        try:
+            with open(manifest.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return manifest
+        if not isinstance(data, dict):
+            return manifest
+        if isinstance(data.get("files"), dict) and isinstance(data.get("listings"), dict):
+            manifest.entries, manifest.listings = data["files"], data["listings"]
+        else:
+            # Manifests written before listings were recorded only hold the entries
+            manifest.entries = data
+        return manifest
+
+    @contextmanager
+    def _locked(self):
+        """
+        Hold an exclusive lock on the directory, the manifest itself is replaced on save.
+        """
+        if fcntl is None:
+            yield
+            return
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def save(self):
+        """
+        Write the manifest atomically, merged with the manifest on disk.
+        The manifest is read again under a lock and only the entries and
+        listings updated here replace its ones, entries saved meanwhile by
+        another run are kept and loaded.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with self._locked():
+            saved = self.load(self.directory)
+            for name in self._updated_entries:
+                saved.entries[name] = self.entries[name]
+            for mirror in self._updated_listings:
+                saved.listings[mirror] = self.listings[mirror]
+            data = {"files": saved.entries, "listings": saved.listings}
+            atomic_write_bytes(self.path, json.dumps(data, indent=1, sort_keys=True).encode())
+        self.entries, self.listings = saved.entries, saved.listings
+        self._updated_entries.clear()
+        self._updated_listings.clear()
+
+    def get(self, name, verify=False):
+        """
+        Return the entry of a cached file if the file on disk matches it.
+
+        Args:
+            name (str): File name in the download directory.
+            verify (bool): Also check the SHA256, not only the size.
+
+        Returns:
+            dict: Entry of the file or None if missing or not matching.
+
+        """
+        entry = self.entries.get(name)
+        path = os.path.join(self.directory, name)
+        if not entry or not os.path.exists(path):
+            return None
+        if os.path.getsize(path) != entry.get("size"):
+            return None
+        if verify and file_sha256(path) != entry.get("sha256"):
+            return None
+        return entry
+
+    def update(self, name, url, headers, size, sha256, content_sha256=None, release_sha256=None):
+        """
+        Record a downloaded file and save the manifest.
+
+        Args:
+            name (str): File name in the download directory.
+            url (str): URL the file was downloaded from.
+            headers (Mapping): Response headers of the download.
+            size (int): Size of the file in bytes.
+            sha256 (str): Hex digest of the file.
+            content_sha256 (str): Hex digest of the decompressed file, if known.
+            release_sha256 (str): Hex digest listed in the Release index for the file,
+                if the cached file has the same contents but other bytes, e.g. after
+                applying pdiffs.
+
+        """
+        self.entries[name] = {
+            "url": url,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "size": size,
+            "sha256": sha256,
+        }
+        if content_sha256:
+            self.entries[name]["content_sha256"] = content_sha256
+        if release_sha256:
+            self.entries[name]["release_sha256"] = release_sha256
+        self._updated_entries.add(name)
+        self.save()
+
+    def record_listing(self, mirror, names):
+        """
+        Record the Contents files discovered on a mirror and save the manifest.
+
+        Args:
+            mirror (str): Mirror URL the files were discovered on.
+            names (iterable): File names of every architecture, udeb files included.
+
+        """
+        self.listings[mirror] = {"time": time.time(), "names": sorted(set(names))}
+        self._updated_listings.add(mirror)
+        self.save()
+
+    def listing(self, mirror, max_age):
+        """
+        Return the Contents files last discovered on a mirror.
+
+        Args:
+            mirror (str): Mirror URL the files were discovered on.
+            max_age (float): Seconds after which a listing is out of date.
+
+        Returns:
+            list: File names, None if the mirror was never discovered or the listing is out of date.
+
+        """
+        listing = self.listings.get(mirror)
+        if not listing or time.time() - listing["time"] > max_age:
+            return None
+        return listing["names"]
+
+    @staticmethod
+    def release_match(entry, expected):
+        """
+        Return the SHA256 of a cached file if it is the version listed in the Release index.
+        A file recompressed after applying pdiffs matches by its recorded Release SHA256.
+
+        Args:
+            entry (dict): Entry of the cached file, may be None.
+            expected (dict): Size and sha256 from the Release file, may be None.
+
+        Returns:
+            str: SHA256 of the cached file, None if it is not the listed version.
+
+        """
+        if not entry or not expected:
+            return None
+        if expected["sha256"] in (entry["sha256"], entry.get("release_sha256")):
+            return entry["sha256"]
+        return None
+
+    @staticmethod
+    def revalidated_entry(entry, expected):
+        """
+        Return the entry of a cached file that a conditional request may revalidate.
+        A file other than the version listed in the Release index is out of date
+        whatever the mirror answers, so it is downloaded again.
+
+        Args:
+            entry (dict): Entry of the cached file, may be None.
+            expected (dict): Size and sha256 from the Release file, may be None.
+
+        Returns:
+            dict: The entry, None if there is none or it is not the listed version.
+
+        """
+        if expected and not CacheManifest.release_match(entry, expected):
+            return None
+        return entry
+
+    @staticmethod
+    def conditional_headers(entry):
+        """
+        Return the conditional request headers for a cached entry.
+
+        Args:
+            entry (dict): Entry of the cached file, may be None.
+
+        Returns:
+            dict: If-None-Match and If-Modified-Since headers.
+
+        """
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+
+class CacheFileWriter:
+    """
+    Asynchronous writer hashing a download into a temporary file and renaming
+    it on success. An interrupted download never replaces the cached file.
+
+    Args:
+        path (str): Final path of the file.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = temp_path(path)
+        self.size = 0
+        self._digest = hashlib.sha256()
+        self._file = None
+
+    async def __aenter__(self):
+        # Imported on first use, runs answered from the count index never load it
+        import aiofiles  # pylint: disable=import-outside-toplevel
+        self._file = await aiofiles.open(self.tmp_path, 'wb')
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self._file.close()
+        if exc_type is None:
+            os.replace(self.tmp_path, self.path)
+        elif os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    async def write(self, chunk):
+        """
+        Write a chunk of the download.
+
+        Args:
+            chunk (bytes): Downloaded data.
+
+        """
+        self._digest.update(chunk)
+        self.size += len(chunk)
+        await self._file.write(chunk)
+
+    @property
+    def sha256(self):
+        """
+        Hex digest of the data written so far.
+        """
+        return self._digest.hexdigest()
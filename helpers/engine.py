@@ -0,0 +1,458 @@
+############################################################
+"""
+Library API of the package statistics.
+An engine owns the download client, the parse executor, the count index
+and the cache manifest of an output directory. It is opened once and
+serves any number of runs, concurrently if needed, returning their
+counts, top packages, per-file statistics and stage timings instead of
+printing them or accumulating into package_stats_dict.
+Functions:
+
+    architecture_urls:
+        Return the URLs of the Contents files of an architecture.
+
+Classes:
+
+    FileStats:
+        Statistics of one Contents file of a run.
+
+    StatsResult:
+        Result of a run of the engine.
+
+    PackageStatsEngine:
+        Asynchronous engine counting the packages of architectures of a mirror.
+
+    SyncPackageStatsEngine:
+        Blocking wrapper running a PackageStatsEngine on its own event loop thread.
+"""
+############################################################
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+import threading
+import time
+from .exceptions import DownloadError
+from .common_utils import filter_files, filter_all_files, top_packages, format_stats
+from .decompress import AUTO, select_backend
+from .parallel import process_pool
+from .download_cache import CacheManifest
+from .mirrors import MirrorSet, HEDGE_DELAY
+from .counters import PackageMatrix
+from .profiling import DISABLED, Profiler
+from .sketches import SpaceSaving
+from .count_index import CountIndex, INDEX_NAME
+from .release import file_checksums
+from .http_client import DownloadClient
+from .defaults import ALL_ARCHITECTURES
+from .package_stats_helper_async import (
+    MIRROR, discover_contents_files, download_and_process_files)
+
+DISCOVERY_TTL = 300  # Seconds a discovered file list is reused before the mirror is asked again
+
+
+class FileStats:
+    """
+    Statistics of one Contents file of a run.
+
+    Args:
+        name (str): File name, e.g. Contents-amd64.gz
+        url (str): URL of the file.
+
+    Attributes:
+        source (str): Where the counts came from: "download", "ranges", "cache",
+            "not modified", "pdiff", "stream" or "index" for indexed counts.
+        bytes_in (int): Compressed bytes received from the mirror.
+        bytes_out (int): Decompressed bytes parsed.
+        lines (int): Lines parsed.
+        seconds (dict): Stage name to seconds spent on the file.
+        queue_wait (float): Seconds the parse waited for a worker.
+        error (str): Error of a failed download, None on success.
+
+    """
+    def __init__(self, name, url):
+        self.name = name
+        self.url = url
+        self.source = "index"
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lines = 0
+        self.seconds = {}
+        self.queue_wait = 0.0
+        self.error = None
+
+    def add(self, record):
+        """
+        Add a profiler record of a stage of the file.
+
+        Args:
+            record (dict): Record from Profiler.records.
+
+        """
+        stage = record["stage"]
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + record.get("seconds", 0.0)
+        if stage in ("download", "stream", "pdiff"):
+            self.source = record.get("source", stage)
+            self.bytes_in += record.get("bytes_in") or 0
+        if stage in ("stream", "parse"):
+            self.bytes_out += record.get("bytes_out") or 0
+            self.lines += record.get("lines") or 0
+            self.queue_wait += record.get("queue_wait") or 0.0
+        if "error" in record:
+            self.error = record["error"]
+
+    def to_dict(self):
+        """
+        Return the statistics as a JSON serializable dict.
+        """
+        return dict(vars(self))
+
+
+class StatsResult:
+    """
+    Result of a run of the engine.
+
+    Args:
+        architecture (str): Architecture counted, "any" for every architecture.
+        counts (dict): Package name to file count. The PackageMatrix of an "any"
+            run or the SpaceSaving sketch of an approximate run, both readable as a dict.
+        top (list): (package, count) tuples of the top packages.
+        files (list): FileStats of every Contents file of the run.
+        profile (Profiler): Records of every stage of the run.
+        errors (dict): Package name to error bound of the top packages of an
+            approximate run. DEFAULT: exact counts
+        matrix (PackageMatrix): Package by architecture counts of an "any" run.
+
+    """
+    def __init__(self, architecture, counts, top, files, profile, errors=None, matrix=None):
+        self.architecture = architecture
+        self.counts = counts
+        self.top = top
+        self.files = files
+        self.profile = profile
+        self.errors = errors
+        self.matrix = matrix
+
+    @property
+    def timings(self):
+        """
+        dict: Stage name to seconds summed over the files of the run.
+        """
+        return {name: total["seconds"] for name, total in self.profile.summary().items()}
+
+    @property
+    def wall_time(self):
+        """
+        float: Seconds from the start to the end of the run.
+        """
+        return self.profile.wall_time
+
+    def format(self):
+        """
+        Format the top packages as the table printed by the command line.
+        """
+        return format_stats(self.top, None if self.errors is None else self.errors.get)
+
+    def to_dict(self):
+        """
+        Return the result without the full counts as a JSON serializable dict.
+        """
+        return {
+            "architecture": self.architecture,
+            "top": [list(row) for row in self.top],
+            "errors": self.errors,
+            "files": [stats.to_dict() for stats in self.files],
+            "timings": self.timings,
+            "wall_time": self.wall_time,
+        }
+
+
+class PackageStatsEngine:
+    """
+    Asynchronous engine counting the packages of architectures of a mirror.
+    Use as an async context manager. Every run of the engine shares its
+    client, executor, count index and cache manifest, and counts into its
+    own counters, so runs of several architectures can be awaited together
+    and a file counted by one run is read from the count index by the next.
+
+    Args:
+        mirror (str or list): Mirror URL for contents files, or several mirrors
+            of the same component ranked by latency when the engine opens.
+        output_dir (str): Download location for content files.
+        skip_download (int): Skip download if files are already present and newer than 's' days.
+        workers (int): Number of worker processes parsing files, 0 parses in threads.
+        split_files (bool): Split each file into blocks counted by all workers.
+        pipeline (bool): Parse files while they are downloading, workers are not used.
+        tee (bool): Store downloaded files in output_dir when pipelining.
+        client_options (dict): Keyword arguments of the DownloadClient.
+        discovery (str): Find Contents files from the "release" index or "html" listing.
+        use_index (bool): Reuse and store package counts in the index in output_dir.
+        build_path_index (bool): Build the path index used by the lookup subcommand.
+        incremental (bool): Update cached files and their indexed counts from pdiffs.
+        hedge_delay (float): Seconds before a download is hedged on the next
+            mirror, None to only fail over.
+        decompressor (str): Decompression backend, "auto" picks the fastest installed.
+        discovery_ttl (float): Seconds a discovered file list is reused.
+
+    Raises:
+        ValueError: If the decompression backend is unknown or not installed.
+
+    """
+    def __init__(self, mirror=MIRROR, output_dir="downloads", skip_download=0, workers=0,
+                 split_files=False, pipeline=False, tee=True, client_options=None,
+                 discovery="release", use_index=True, build_path_index=False,
+                 incremental=False, hedge_delay=HEDGE_DELAY, decompressor=AUTO,
+                 discovery_ttl=DISCOVERY_TTL):
+        self.mirrors = [mirror] if isinstance(mirror, str) else list(mirror)
+        self.output_dir = output_dir
+        self.skip_download = skip_download
+        self.workers = workers
+        self.split_files = split_files
+        self.pipeline = pipeline
+        self.tee = tee
+        self.client_options = client_options or {}
+        self.discovery = discovery
+        self.use_index = use_index
+        self.build_path_index = build_path_index
+        self.incremental = incremental
+        self.hedge_delay = hedge_delay
+        # Fail when the engine is created rather than on the first run
+        self.decompressor = select_backend(decompressor)
+        self.discovery_ttl = discovery_ttl
+        self.client = None
+        self.executor = None
+        self.count_index = None
+        self.manifest = None
+        self.mirror_set = None
+        self._discovered = None
+        self._discovery_lock = None
+
+    async def __aenter__(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.client = await DownloadClient(**self.client_options).__aenter__()
+        self.executor = process_pool(self.workers) if self.workers else ThreadPoolExecutor()
+        # SQLite connections are used from the thread creating them, the event loop's
+        if self.use_index:
+            self.count_index = CountIndex(os.path.join(self.output_dir, INDEX_NAME))
+        self.manifest = CacheManifest.load(self.output_dir)
+        self._discovery_lock = asyncio.Lock()
+        if len(self.mirrors) > 1:
+            self.mirror_set = MirrorSet(self.mirrors)
+            await self.mirror_set.probe(self.client)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """
+        Close the client, shut the executor down and close the count index.
+        """
+        if self.client is not None:
+            await self.client.__aexit__(None, None, None)
+            self.client = None
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.count_index is not None:
+            self.count_index.close()
+            self.count_index = None
+
+    async def discover(self, profiler=None, refresh=False):
+        """
+        Find the Contents files of the mirror, reusing them for discovery_ttl seconds.
+        Mirrors are tried in rank order until one answers.
+
+        Args:
+            profiler (Profiler): Record the discovery requests. DEFAULT: not profiled
+            refresh (bool): Ask the mirror again even if the files are recent.
+
+        Returns:
+            dict: Files by architecture.
+
+        """
+        async with self._discovery_lock:
+            if (not refresh and self._discovered
+                    and time.monotonic() - self._discovered[0] < self.discovery_ttl):
+                return self._discovered[1]
+            loop = asyncio.get_running_loop()
+            mirrors = self.mirror_set.mirrors if self.mirror_set else self.mirrors
+            for candidate in mirrors:
+                try:
+                    files = await loop.run_in_executor(
+                        None, discover_contents_files, candidate, self.discovery,
+                        profiler or DISABLED)
+                    break
+                except DownloadError as e:
+                    if candidate == mirrors[-1]:
+                        raise
+                    print(f"Mirror {candidate} unavailable, trying the next one: {e}", file=sys.stderr)
+            # Cached runs only answer for files a discovery has seen, see cached_counts
+            self.manifest.record_listing(
+                candidate, (os.path.basename(url) for url in filter_all_files(files, True)))
+            self._discovered = (time.monotonic(), files)
+            return files
+
+    async def stats(self, arch, include_udeb=False, limit=10, approximate_budget=None,
+                    profiler=None, only=None):
+        """
+        Count the packages of an architecture.
+
+        Args:
+            arch (str): Architecture of the packages to parse, "any" for every architecture.
+            include_udeb (bool): Flag to include udeb files for architecture.
+            limit (int): Number of top packages of the result.
+            approximate_budget (float): Count with a Space-Saving sketch using about
+                this many MB instead of exact counts. DEFAULT: exact counts
+            profiler (Profiler): Profiler of the run, e.g. with a capture. DEFAULT: a new one
+            only (list): Only count these URLs of the architecture, e.g. the share
+                of a map node. DEFAULT: every file of the architecture
+
+        Returns:
+            StatsResult: Counts, top packages, per-file statistics and timings.
+
+        """
+        profiler = profiler or Profiler()
+        files = await self.discover(profiler)
+        urls = architecture_urls(files, arch, include_udeb)
+        if only is not None:
+            selected = set(only)
+            urls = [url for url in urls if url in selected]
+        counts, matrix, sketch = {}, None, None
+        if approximate_budget:
+            sketch = SpaceSaving.for_budget(int(approximate_budget * (1 << 20)))
+        elif arch == ALL_ARCHITECTURES:
+            matrix = PackageMatrix(sorted(files))
+        await download_and_process_files(
+            urls, self.output_dir, self.skip_download, pipeline=self.pipeline, tee=self.tee,
+            workers=self.workers, split_files=self.split_files, client=self.client,
+            checksums=file_checksums(files), count_index=self.count_index,
+            build_path_index=self.build_path_index, matrix=matrix, sketch=sketch,
+            counts=counts, executor=self.executor, incremental=self.incremental,
+            mirrors=self.mirror_set, hedge_delay=self.hedge_delay, profiler=profiler,
+            decompressor=self.decompressor, manifest=self.manifest)
+        counts = sketch if sketch is not None else matrix if matrix is not None else counts
+        with profiler.stage("top_k"):
+            top = top_packages(counts, True, limit)
+        profiler.finish()
+        errors = {package: sketch.error(package) for package, _ in top} if sketch else None
+        return StatsResult(arch, counts, top, _file_stats(urls, profiler), profiler,
+                           errors=errors, matrix=matrix)
+
+    async def stats_many(self, archs, **options):
+        """
+        Count the packages of several architectures concurrently.
+
+        Args:
+            archs (list): Architectures.
+            **options: Keyword arguments of stats.
+
+        Returns:
+            dict: Architecture to StatsResult.
+
+        """
+        results = await asyncio.gather(*(self.stats(arch, **options) for arch in archs))
+        return dict(zip(archs, results))
+
+
+def architecture_urls(files, arch, include_udeb=False):
+    """
+    Return the URLs of the Contents files of an architecture.
+
+    Args:
+        files (dict): Files by architecture, from PackageStatsEngine.discover.
+        arch (str): Architecture, "any" for every architecture.
+        include_udeb (bool): Flag to include udeb files for architecture.
+
+    Returns:
+        list: File URLs, empty for an architecture the mirror does not have.
+
+    """
+    if arch == ALL_ARCHITECTURES:
+        return filter_all_files(files, include_udeb)
+    if arch in files:
+        return filter_files(files, arch, include_udeb)
+    # The discovered files are shared by every run and never gain an architecture
+    return []
+
+
+def _file_stats(urls, profiler):
+    """
+    Build the FileStats of the urls of a run from its profiler records.
+    """
+    files = {os.path.basename(url): FileStats(os.path.basename(url), url) for url in urls}
+    for record in profiler.records:
+        if record["file"] is None:
+            continue
+        stats = files.get(os.path.basename(str(record["file"]).rstrip("/")))
+        if stats is not None:
+            stats.add(record)
+    return list(files.values())
+
+
+class SyncPackageStatsEngine:
+    """
+    Blocking wrapper running a PackageStatsEngine on its own event loop thread.
+    Calls from any thread are run on that loop, so they share the engine's
+    client, executor and count index. Use as a context manager or call close.
+
+    Args:
+        **options: Keyword arguments of PackageStatsEngine.
+
+    """
+    def __init__(self, **options):
+        self.engine = PackageStatsEngine(**options)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        try:
+            self._run(self.engine.__aenter__())
+        except BaseException:
+            self._stop()
+            raise
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def _stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def stats(self, arch, **options):
+        """
+        Count the packages of an architecture, see PackageStatsEngine.stats.
+
+        Returns:
+            StatsResult: Counts, top packages, per-file statistics and timings.
+
+        """
+        return self._run(self.engine.stats(arch, **options))
+
+    def stats_many(self, archs, **options):
+        """
+        Count the packages of several architectures concurrently.
+
+        Returns:
+            dict: Architecture to StatsResult.
+
+        """
+        return self._run(self.engine.stats_many(archs, **options))
+
+    def close(self):
+        """
+        Close the engine and stop its event loop thread.
+        """
+        if self._loop.is_closed():
+            return
+        try:
+            self._run(self.engine.close())
+        finally:
+            self._stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
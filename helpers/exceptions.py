@@ -6,4 +6,20 @@ class DownloadError(Exception):
     def __init__(self, url, status_code=""):
         self.url = url
         self.status_code = status_code
-        super().__init__(f"Download from {url} failed with status code {status_code}")
\ No newline at end of file
+        super().__init__(f"Download from {url} failed with status code {status_code}")
+
+
+class PatchError(Exception):
+    """Custom exception for incremental updates that cannot be applied."""
+    def __init__(self, name, reason=""):
+        self.name = name
+        self.reason = reason
+        super().__init__(f"Patching {name} failed: {reason}")
+
+
+class ShardError(Exception):
+    """Custom exception for partial count shards that cannot be read or merged."""
+    def __init__(self, path, reason=""):
+        self.path = path
+        self.reason = reason
+        super().__init__(f"Shard {path} is unusable: {reason}")
@@ -0,0 +1,144 @@
+############################################################
+"""
+Shared HTTP client for downloading Contents files.
+One pooled aiohttp session is used for a whole run, so connections are
+kept alive between files and the number of parallel connections is capped.
+Functions:
+
+    ensure_client:
+        Use the given client or open a temporary one.
+
+Classes:
+
+    DownloadClient:
+        Pooled aiohttp session with a concurrency cap and retries with backoff.
+"""
+############################################################
+
+from contextlib import asynccontextmanager
+import asyncio
+from .defaults import CONNECTIONS, CONNECTIONS_PER_HOST, MAX_DOWNLOADS, RETRIES
+
+BACKOFF = 0.5  # Seconds before the first retry, doubled for each retry
+# Statuses worth retrying, the mirror is busy or temporarily failing
+RETRY_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+
+
+class DownloadClient:
+    """
+    Pooled aiohttp session with a concurrency cap and retries with backoff.
+    Use as an async context manager, the session is closed on exit.
+
+    Args:
+        connections (int): Maximum number of open connections, 0 for no limit.
+        connections_per_host (int): Maximum number of connections to one host, 0 for no limit.
+        max_downloads (int): Maximum number of requests in flight.
+        retries (int): Number of retries of a request on transient errors.
+        backoff (float): Seconds to wait before the first retry, doubled for each retry.
+
+    """
+    def __init__(self, connections=CONNECTIONS, connections_per_host=CONNECTIONS_PER_HOST,
+                 max_downloads=MAX_DOWNLOADS, retries=RETRIES, backoff=BACKOFF):
+        self.connections = connections
+        self.connections_per_host = connections_per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.semaphore = asyncio.Semaphore(max_downloads)
+        self.session = None
+
+    async def __aenter__(self):
+        # Imported when a client opens, cached runs and --help never load aiohttp
+        import aiohttp  # pylint: disable=import-outside-toplevel
+        connector = aiohttp.TCPConnector(
+            limit=self.connections, limit_per_host=self.connections_per_host)
+        self.session = aiohttp.ClientSession(connector=connector)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+        self.session = None
+
+    @asynccontextmanager
+    async def request(self, url, method="GET", headers=None):
+        """
+        Send a request on the shared session, retrying transient failures.
+        The response is released when the context exits.
+
+        Args:
+            url (str): URL to request.
+            method (str): HTTP method.
+            headers (dict): Extra request headers.
+
+        Yields:
+            aiohttp.ClientResponse: Response of the last attempt.
+
+        """
+        import aiohttp  # pylint: disable=import-outside-toplevel
+        async with self.semaphore:
+            for attempt in range(self.retries + 1):
+                try:
+                    response = await self.session.request(method, url, headers=headers)
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    if attempt == self.retries:
+                        raise
+                else:
+                    if response.status not in RETRY_STATUSES or attempt == self.retries:
+                        break
+                    response.release()
+                # Exponential backoff before retrying on the same pool
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+            try:
+                yield response
+            finally:
+                response.release()
+
+    async def transfer(self, url, consume, headers=None):
+        """
+        Send a GET request and read its body, retrying the whole transfer on transient failures.
+        A connection reset or timeout while the body is read starts the
+        request again after a backoff, as a failure to open it does.
+
+        Args:
+            url (str): URL to request.
+            consume (callable): Coroutine function reading the response, called
+                again from scratch after a failed attempt, so it must not keep
+                state from a previous call.
+            headers (dict): Extra request headers.
+
+        Returns:
+            object: Result of consume.
+
+        """
+        import aiohttp  # pylint: disable=import-outside-toplevel
+        for attempt in range(self.retries + 1):
+            opened = False
+            try:
+                async with self.request(url, headers=headers) as response:
+                    opened = True
+                    return await consume(response)
+            except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError,
+                    asyncio.TimeoutError):
+                # Failures to open were already retried by request
+                if not opened or attempt == self.retries:
+                    raise
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+        return None
+
+
+@asynccontextmanager
+async def ensure_client(client=None):
+    """
+    Use the given client or open a temporary one.
+
+    Args:
+        client (DownloadClient): Shared client of the run, None to open a new one.
+
+    Yields:
+        DownloadClient: Open client.
+
+    """
+    if client is not None:
+        yield client
+        return
+    async with DownloadClient() as new_client:
+        yield new_client
@@ -0,0 +1,103 @@
+############################################################
+"""
+Lookup subcommand, finding the packages shipping a file with the path
+indexes built by --build-path-index.
+Functions:
+
+    lookup_paths:
+        Find the packages shipping paths using the path indexes.
+
+    search_path_index:
+        Find the packages shipping paths in one open path index.
+
+    lookup_cli:
+        Command-line interface of the lookup subcommand.
+"""
+############################################################
+
+import argparse
+import os
+from .path_index import PathIndex, find_path_indexes
+
+
+def lookup_paths(output_dir, query, mode="exact", arch=None, limit=None):
+    """
+    Find the packages shipping paths using the path indexes.
+
+    Args:
+        output_dir (str): Download location holding the path indexes.
+        query (str): Path, path prefix or glob pattern.
+        mode (str): "exact", "prefix" or "glob".
+        arch (str): Only search the Contents files of this architecture. DEFAULT: all
+        limit (int): Maximum number of results per Contents file. DEFAULT: no limit
+
+    Returns:
+        list: (Contents file name, path, comma separated packages) tuples.
+
+    """
+    results = []
+    for path in find_path_indexes(output_dir, arch):
+        contents_name = os.path.basename(path)[:-len(".paths")]
+        with PathIndex(path) as index:
+            matches = search_path_index(index, query, mode, limit)
+        results.extend((contents_name, file, packages) for file, packages in matches)
+    return results
+
+
+def search_path_index(index, query, mode="exact", limit=None):
+    """
+    Find the packages shipping paths in one open path index.
+
+    Args:
+        index (PathIndex): Open path index.
+        query (str): Path, path prefix or glob pattern.
+        mode (str): "exact", "prefix" or "glob".
+        limit (int): Maximum number of results. DEFAULT: no limit
+
+    Returns:
+        list: (path, comma separated packages) tuples.
+
+    """
+    if mode == "exact":
+        packages = index.exact(query)
+        return [(query.lstrip("/"), packages)] if packages else []
+    if mode == "prefix":
+        return list(index.prefix(query, limit))
+    return list(index.glob(query, limit))
+
+
+def lookup_cli(argv):
+    """
+    Command-line interface of the lookup subcommand.
+
+    Args:
+        argv (list): Arguments after the subcommand name.
+
+    """
+    argparser = argparse.ArgumentParser(
+        prog="package_statistics.py lookup",
+        description=("Find the packages shipping a file, using the path indexes built "
+                     "with --build-path-index.")
+    )
+    argparser.add_argument("path", type=str, help="File path, path prefix or glob pattern.")
+    mode = argparser.add_mutually_exclusive_group()
+    mode.add_argument("--prefix", action="store_true", help="Match paths starting with path.")
+    mode.add_argument("--glob", action="store_true",
+                      help="Match paths against a shell style pattern.")
+    argparser.add_argument(
+        "-a", "--architecture", type=str, default=None,
+        help="Only search the Contents files of this architecture. DEFAULT: all")
+    argparser.add_argument(
+        "-l", "--limit", type=int, default=None,
+        help="Maximum number of results per Contents file. DEFAULT: no limit")
+    argparser.add_argument(
+        "-o", "--output-dir", type=str, default=os.path.join(os.getcwd(), "downloads"),
+        help=("Download location for content files \n"
+              "DEFAULT: current-working-directory/downloads"))
+    args = argparser.parse_args(argv)
+    mode = "prefix" if args.prefix else "glob" if args.glob else "exact"
+    results = lookup_paths(args.output_dir, args.path, mode, args.architecture, args.limit)
+    for contents_name, file, packages in results:
+        print(f"{file:60} \t {packages} \t {contents_name}")
+    if not results:
+        print(f"No indexed file matches {args.path}")
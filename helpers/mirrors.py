@@ -0,0 +1,149 @@
+############################################################
+"""
+Downloads from several Debian mirrors.
+Mirrors are ranked by the latency of a probe request. Each download starts
+on the fastest mirror, is hedged on the next one if it is slow, and fails
+over to the next mirror if it errors. The first download to finish wins
+and the others are cancelled.
+Functions:
+
+    hedged:
+        Run an attempt on candidates with hedging and failover.
+
+Classes:
+
+    MirrorSet:
+        Mirrors of the same component ranked by latency.
+"""
+############################################################
+
+import asyncio
+import sys
+import time
+from .exceptions import DownloadError
+from .release import split_mirror_url
+from .defaults import HEDGE_DELAY
+
+PROBE_TIMEOUT = 5  # Seconds before a mirror is considered unreachable
+MAX_HEDGED = 2  # Mirrors downloading the same file at a time
+
+
+class MirrorSet:
+    """
+    Mirrors of the same component ranked by latency.
+
+    Args:
+        mirrors (list): Mirror URLs, e.g. http://deb.debian.org/debian/dists/stable/main/
+
+    """
+    def __init__(self, mirrors):
+        self.mirrors = [mirror if mirror.endswith("/") else mirror + "/" for mirror in mirrors]
+        self.latencies = {}
+
+    async def probe(self, client, timeout=PROBE_TIMEOUT):
+        """
+        Measure the latency of every mirror and rank them, fastest first.
+        Unreachable mirrors are kept last as a last resort.
+
+        Args:
+            client (DownloadClient): Shared client of the run.
+            timeout (float): Seconds before a mirror is considered unreachable.
+
+        Returns:
+            dict: Mirror URL to latency in seconds of the reachable mirrors.
+
+        """
+        import aiohttp  # pylint: disable=import-outside-toplevel
+
+        async def head(url):
+            async with client.request(url, method="HEAD") as response:
+                return response.status < 400
+
+        async def measure(mirror):
+            start = time.perf_counter()
+            try:
+                reachable = await asyncio.wait_for(
+                    head(split_mirror_url(mirror)[0] + "Release"), timeout)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                return None
+            return time.perf_counter() - start if reachable else None
+
+        latencies = await asyncio.gather(*(measure(mirror) for mirror in self.mirrors))
+        self.latencies = {mirror: latency for mirror, latency in zip(self.mirrors, latencies)
+                          if latency is not None}
+        self.mirrors.sort(key=lambda mirror: (mirror not in self.latencies,
+                                              self.latencies.get(mirror, 0)))
+        return self.latencies
+
+    def alternatives(self, url):
+        """
+        Return the URLs of a file on every mirror, in rank order.
+
+        Args:
+            url (str): URL of the file on one of the mirrors.
+
+        Returns:
+            list: URLs of the file, only url if it is not on a known mirror.
+
+        """
+        for mirror in self.mirrors:
+            if url.startswith(mirror):
+                path = url[len(mirror):]
+                return [candidate + path for candidate in self.mirrors]
+        return [url]
+
+
+async def hedged(candidates, attempt, hedge_delay=HEDGE_DELAY, max_parallel=MAX_HEDGED):
+    """
+    Run an attempt on candidates with hedging and failover.
+    The first candidate starts at once. While fewer than max_parallel attempts
+    run, the next candidate starts when no attempt finished within hedge_delay
+    or when an attempt fails. The first successful attempt wins and the others
+    are cancelled.
+
+    Args:
+        candidates (list): Candidates in order of preference, e.g. URLs.
+        attempt (callable): Coroutine function called with a candidate.
+        hedge_delay (float): Seconds before hedging on the next candidate,
+            None to only fail over.
+        max_parallel (int): Maximum number of attempts running at a time.
+
+    Returns:
+        Result of the first successful attempt.
+
+    Raises:
+        DownloadError: Error of the last attempt if all candidates failed.
+
+    """
+    remaining = list(candidates)
+    pending = set()
+    error = None
+
+    def start():
+        pending.add(asyncio.ensure_future(attempt(remaining.pop(0))))
+
+    start()
+    try:
+        while pending:
+            can_hedge = hedge_delay is not None and remaining and len(pending) < max_parallel
+            done, _pending = await asyncio.wait(
+                pending, timeout=hedge_delay if can_hedge else None,
+                return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # The attempts are slow, race the next candidate
+                start()
+                continue
+            for task in done:
+                pending.discard(task)
+                try:
+                    return task.result()
+                except DownloadError as e:
+                    print(f"Failing over after error: {e}", file=sys.stderr)
+                    error = e
+            if remaining and len(pending) < max_parallel:
+                start()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
@@ -28,6 +28,7 @@ import time
 import requests
 from .common_utils import (
     get_contents_file_list, process_contents_file_list, filter_files, return_stats)
+from .streaming import read_line_blocks
 
 BUF_SIZE = 1024
 SEC_IN_DAY = 86400
@@ -87,11 +88,13 @@ def decompress_file(file_path):
         str: Line of decompressed data.
 
     """
-    # Open the gzipped file and yield its content line by line
+    # Open the gzipped file and yield its content line by line,
+    # decompressing a block at a time instead of reading the whole file
     with gzip.open(file_path, 'rb') as f:
-        for chunk in f.readlines():
-            unzipped_data = chunk.decode()
-            yield unzipped_data
+        for block in read_line_blocks(f):
+            for chunk in block.split(b"\n"):
+                if chunk:
+                    yield chunk.decode()
 
 
 def process_data(line):
@@ -6,9 +6,27 @@ Functions:
     download_file:
         Download a file asynchronously using aiohttp and aiofiles.
 
+    update_from_pdiff:
+        Update a cached Contents file and its counts from the pdiffs of the mirror.
+
+    discover_contents_files:
+        Find the Contents files of a mirror URL.
+
+    download_ranges:
+        Download a large file with parallel Range requests if the mirror supports them.
+
+    verify_download:
+        Check a finished download against the checksum from the Release file.
+
+    stream_and_process_file:
+        Download a gzipped file and parse it while it is downloading.
+
     process_file:
         Process a gzipped file asynchronously.
 
+    count_file:
+        Count packages of a gzipped file into a local Counter.
+
     mapper:
         Map function to process lines from the gzipped file asynchronously.
 
@@ -16,46 +34,68 @@ Functions:
         Download and process multiple files asynchronously.
 
     main:
-        Main asynchronous function to download and process Debian package files.
-
-    package_stats:
-        Calculate and print package statistics based on given parameters.
-
-    cli:
-        Command-line interface function to get package statistics.
-"""
+        Main asynchronous function to download and process Debian package files."""
 ############################################################
 
-from collections import defaultdict
+from collections import defaultdict, deque, Counter
 import os
 import asyncio
 import gzip
+import hashlib
 import time
-import argparse
+import sys
+from contextlib import AsyncExitStack, nullcontext
 from concurrent.futures import ThreadPoolExecutor
-import aiohttp
-import aiofiles
-from .exceptions import DownloadError
+from .exceptions import DownloadError, PatchError
 from .common_utils import (
-    get_contents_file_list, process_contents_file_list, filter_files, return_stats)
-
-PARTITION = 5000
-SEC_IN_DAY = 86400
+    get_contents_file_list, process_contents_file_list, filter_files, return_stats,
+    peak_memory_mb, merge_counts, contents_arch)
+from .streaming import read_line_blocks, line_decoder
+from .decompress import AUTO, open_contents, select_backend
+from .parallel import count_file_sharded, process_pool
+from .download_cache import CacheManifest, CacheFileWriter, file_sha256, is_recent_download
+from .range_download import RangeDownload, RANGE_THRESHOLD
+from .mirrors import hedged, HEDGE_DELAY
+from .profiling import DISABLED, file_metrics, run_profiled
+from .sketches import SpaceSaving
+from .path_index import building_path_index, index_path, is_current as is_path_index_current
+from .release import (
+    split_mirror_url, get_release, contents_files_from_release, file_checksums)
+from .http_client import ensure_client
+from .parser import count_block, count_bytes, decode_counts
+from .pdiff import (
+    diff_index_url, parse_diff_index, patches_to_apply, gzip_sha256, patch_file,
+    apply_count_deltas)
+
+CHUNK_SIZE = 1 << 16  # Compressed bytes read from the response at a time
+PARSE_QUEUE = 16  # Chunks of a stream waiting for its parser thread
 MIRROR = "http://ftp.uk.debian.org/debian/dists/stable/main/"
+ARCHIVE = "http://ftp.uk.debian.org/debian/"
 package_stats_dict = defaultdict(int)
 
 
-async def download_file(url, output_dir, skip_download):
+async def download_file(url, output_dir, skip_download, client=None, manifest=None,
+                        expected=None, metrics=None):
     """
     Download a file asynchronously using aiohttp and aiofiles.
+    Sends a conditional request for files recorded in the cache manifest,
+    a 304 response keeps the cached file unless the Release index lists
+    another version of it. New data is written to a temporary
+    file and renamed, so an interrupted download never leaves a truncated file.
+    Files of at least RANGE_THRESHOLD bytes are downloaded in parallel segments.
 
     Args:
         url (str): The URL of the file to download.
         output_dir (str): The directory where the downloaded file will be stored.
         skip_download (int): Number of days to skip download if the file exists and is recent.
+        client (DownloadClient): Shared client of the run. DEFAULT: a new client
+        manifest (CacheManifest): Cache manifest of output_dir. DEFAULT: loaded from output_dir
+        expected (dict): Size and sha256 from the Release file, the download is verified
+            against them and a cached file with the same sha256 is used without a request.
+        metrics (dict): Profiling record, receives the source of the file and bytes_in.
 
     Returns:
-        str: The path to the downloaded file or None if the download fails.
+        str: The path to the downloaded file.
 
     """
     # Download file. skip if newer than skip_download days
@@ -65,68 +105,425 @@ async def download_file(url, output_dir, skip_download):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
     output_path = os.path.join(output_dir, file_name)
-    if skip_download:
-        if os.path.exists(output_path):
-            # If file exists in path and is recently created, skip file download
-            time_since_download = time.time() - os.path.getmtime(output_path)
-            if time_since_download < skip_download * SEC_IN_DAY:
-                # print("Found file. Skipping download")
-                return output_path
+    if metrics is None:
+        metrics = {}
+    metrics["source"] = "cache"
+    if is_recent_download(output_path, skip_download):
+        # If file exists in path and is recently created, skip file download
+        # print("Found file. Skipping download")
+        return output_path
+    if manifest is None:
+        manifest = CacheManifest.load(output_dir)
+    entry = manifest.get(file_name)
+    if CacheManifest.release_match(entry, expected):
+        # Cached file matches the Release index, no request needed
+        return output_path
+    # A 304 must not keep a file the Release index lists another version of
+    entry = CacheManifest.revalidated_entry(entry, expected)
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    filename = os.path.basename(url)
-                    output_path = os.path.join(output_dir, filename)
-                    # Asynchronously write to local for download
-                    async with aiofiles.open(output_path, 'wb') as f:
-                        await f.write(await response.read())
-                    # print("Downloaded file", output_path)
-                    return output_path
+        async with ensure_client(client) as client:
+            if expected and expected["size"] >= RANGE_THRESHOLD and await download_ranges(
+                    url, output_path, client, manifest, expected):
+                metrics.update(source="ranges", url=url, bytes_in=expected["size"])
+                return output_path
 
-                else:
+            async def save(response):
+                if response.status == 304 and entry:
+                    # Not modified since the cached download
+                    metrics["source"] = "not modified"
+                    return output_path
+                if response.status != 200:
                     raise DownloadError(url, response.status)
+                # Asynchronously write to local for download, a failed attempt
+                # removes its temporary file
+                async with CacheFileWriter(output_path) as writer:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        await writer.write(chunk)
+                    verify_download(url, writer, expected)
+                manifest.update(file_name, url, response.headers, writer.size, writer.sha256)
+                metrics.update(source="download", url=url, bytes_in=writer.size)
+                # print("Downloaded file", output_path)
+                return output_path
+
+            return await client.transfer(
+                url, save, headers=CacheManifest.conditional_headers(entry))
+    except DownloadError:
+        raise
+    except Exception as e:
+        raise DownloadError(url, e) from e
+
+
+async def update_from_pdiff(url, output_dir, client, manifest, count_index, expected=None):
+    """
+    Update a cached Contents file and its counts from the pdiffs of the mirror.
+    Only the patches since the cached version are downloaded. The counts of the
+    cached version are updated from the patched lines and stored in the count
+    index under the SHA256 of the patched file. The patched file is recompressed,
+    so the SHA256 of the Release index is recorded next to its own.
+
+    Args:
+        url (str): The URL of the gzipped Contents file.
+        output_dir (str): The directory holding the cached file.
+        client (DownloadClient): Shared client of the run.
+        manifest (CacheManifest): Cache manifest of output_dir.
+        count_index (CountIndex): Index holding the counts of the cached file.
+        expected (dict): Size and sha256 from the Release file of the current version.
+
+    Returns:
+        str: Path of the updated file, None if it has to be downloaded in full.
+
+    """
+    file_name = os.path.basename(url)
+    output_path = os.path.join(output_dir, file_name)
+    entry = manifest.get(file_name)
+    counts = count_index.get(entry["sha256"]) if entry and count_index is not None else None
+    if counts is None:
+        return None
+    import aiohttp  # pylint: disable=import-outside-toplevel
+    loop = asyncio.get_running_loop()
+    index_url = diff_index_url(url)
+    try:
+        async with client.request(index_url) as response:
+            if response.status != 200:
+                return None
+            index = parse_diff_index(await response.text())
+        content_sha256 = entry.get("content_sha256") or await loop.run_in_executor(
+            None, gzip_sha256, output_path)
+        selected = patches_to_apply(index, content_sha256)
+        if selected is None:
+            print(f"Cached {file_name} is older than its pdiffs, downloading it", file=sys.stderr)
+            return None
+        patches = []
+        for name, download_sha256, patch_sha256 in selected:
+            patch_url = index_url.rsplit("/", 1)[0] + "/" + name
+            async with client.request(patch_url) as response:
+                if response.status != 200:
+                    raise DownloadError(patch_url, response.status)
+                data = await response.read()
+            patch = gzip.decompress(data)
+            if (hashlib.sha256(data).hexdigest() != download_sha256 or
+                    hashlib.sha256(patch).hexdigest() != patch_sha256):
+                raise PatchError(name, "checksum does not match the index")
+            patches.append(patch)
+        if patches:
+            added, removed = await loop.run_in_executor(
+                None, patch_file, output_path, patches, index["current"][0])
+            counts = apply_count_deltas(counts, added, removed)
+    except (PatchError, DownloadError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Incremental update of {file_name} failed, downloading it: {e}", file=sys.stderr)
+        return None
+    sha256 = await loop.run_in_executor(None, file_sha256, output_path)
+    # No ETag, the patched file is not byte identical to the mirror's file
+    manifest.update(file_name, url, {}, os.path.getsize(output_path), sha256,
+                    content_sha256=index["current"][0],
+                    release_sha256=expected["sha256"] if expected else None)
+    count_index.put(sha256, file_name, counts)
+    return output_path
+
+
+async def download_ranges(url, output_path, client, manifest, expected):
+    """
+    Download a large file with parallel Range requests if the mirror supports them.
+    A HEAD request checks for Accept-Ranges and a validator, it is conditional
+    so an unchanged cached file is kept. A partial download of the same file
+    version is resumed.
+
+    Args:
+        url (str): The URL of the file to download.
+        output_path (str): Path of the downloaded file.
+        client (DownloadClient): Shared client of the run.
+        manifest (CacheManifest): Cache manifest of the download directory.
+        expected (dict): Size and sha256 from the Release file.
+
+    Returns:
+        bool: True if the file is downloaded or unchanged, False if it has to
+            be downloaded in one request.
+
+    Raises:
+        DownloadError: If a segment fails after its retries or the file does not
+            match the Release file.
+
+    """
+    file_name = os.path.basename(url)
+    entry = CacheManifest.revalidated_entry(manifest.get(file_name), expected)
+    async with client.request(url, method="HEAD",
+                              headers=CacheManifest.conditional_headers(entry)) as response:
+        if response.status == 304 and entry:
+            return True
+        headers = response.headers.copy()
+        if (response.status != 200 or headers.get("Accept-Ranges") != "bytes" or
+                headers.get("Content-Length") != str(expected["size"])):
+            return False
+    validator = headers.get("ETag") or headers.get("Last-Modified")
+    if not validator or validator.startswith("W/"):
+        # If-Range needs a strong validator
+        return False
+    download = RangeDownload(output_path, url, expected["size"], validator)
+    download.load_state()
+    try:
+        await download.run(client)
+        verify_download(url, download, expected)
+    except DownloadError:
+        if download.changed or download.sha256:
+            # Nothing to resume, the file changed or the complete file is corrupt
+            download.discard()
+        raise
+    download.commit()
+    manifest.update(file_name, url, headers, download.size, download.sha256)
+    return True
+
+
+def verify_download(url, writer, expected):
+    """
+    Check a finished download against the checksum from the Release file.
+
+    Args:
+        url (str): The URL of the downloaded file.
+        writer (CacheFileWriter): Writer of the download, with its size and sha256.
+        expected (dict): Size and sha256 from the Release file, may be None.
+
+    Raises:
+        DownloadError: If the size or sha256 does not match.
+
+    """
+    if not expected:
+        return
+    if writer.size != expected["size"] or writer.sha256 != expected["sha256"]:
+        raise DownloadError(url, "checksum mismatch with Release file")
+
+
+async def stream_and_process_file(url, output_dir, skip_download, tee=True, stats=None,
+                                  client=None, manifest=None, expected=None,
+                                  build_path_index=False, metrics=None, backend="gzip",
+                                  capacity=None):
+    """
+    Download a compressed file and parse it while it is downloading.
+    Chunks from the response are decompressed incrementally and parsed by
+    a thread of the stream through a bounded queue, optionally writing the
+    compressed data to output_dir as well.
+
+    Args:
+        url (str): The URL of the file to download.
+        output_dir (str): The directory where the downloaded file will be stored.
+        skip_download (int): Number of days to skip download if the file exists and is recent.
+        tee (bool): Write the downloaded file to output_dir while parsing.
+        stats (dict): Counter to update. DEFAULT: package_stats_dict
+        client (DownloadClient): Shared client of the run. DEFAULT: a new client
+        manifest (CacheManifest): Cache manifest of output_dir. DEFAULT: loaded from output_dir
+        expected (dict): Size and sha256 from the Release file to verify the stored file.
+        build_path_index (bool): Also build the path index of the stored file.
+        metrics (dict): Profiling record, receives bytes_in, bytes_out and lines.
+        backend (str): Decompression backend of a file parsed from the cache.
+        capacity (int): Count block by block into a SpaceSaving sketch of this
+            capacity merged into stats, which must be a sketch. DEFAULT: exact counts
+
+    Returns:
+        str: The path to the downloaded file or None if it was not stored.
+
+    """
+    file_name = os.path.basename(url)
+    output_path = os.path.join(output_dir, file_name)
+    if stats is None:
+        stats = package_stats_dict
+    loop = asyncio.get_running_loop()
+    if is_recent_download(output_path, skip_download):
+        # Recent file in cache, parse it from disk
+        await loop.run_in_executor(
+            None, _process_cached_file, output_path, stats, build_path_index, manifest,
+            backend, bool(capacity))
+        return output_path
+    if tee and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    if manifest is None:
+        manifest = CacheManifest.load(output_dir)
+    entry = CacheManifest.revalidated_entry(manifest.get(file_name), expected)
+
+    async def consume(response):
+        if response.status == 304 and entry:
+            # Not modified, parse the cached file from disk
+            await loop.run_in_executor(
+                None, _process_cached_file, output_path, stats, build_path_index,
+                manifest, backend, bool(capacity))
+            return None
+        if response.status != 200:
+            raise DownloadError(url, response.status)
+        # Every attempt starts from scratch, a failed one leaves nothing behind
+        decoder = line_decoder(file_name)
+        counts = Counter()
+        sketch = SpaceSaving(capacity) if capacity else None
+        if metrics is not None:
+            for key in ("bytes_in", "bytes_out", "lines"):
+                metrics.pop(key, None)
+        async with AsyncExitStack() as stack:
+            # The tee is renamed into place only if the whole stream was read
+            writer = await stack.enter_async_context(
+                CacheFileWriter(output_path)) if tee else None
+            path_index = stack.enter_context(building_path_index(
+                output_path, enabled=build_path_index and tee))
+            # Chunks are decompressed and parsed in order by one thread of this
+            # stream, so the event loop keeps serving the other downloads
+            parser = stack.enter_context(ThreadPoolExecutor(max_workers=1))
+            slots = asyncio.Semaphore(PARSE_QUEUE)
+            pending = deque()
+
+            def parse(chunk):
+                block = decoder.finish() if chunk is None else decoder.feed(chunk)
+                count_block(block, counts)
+                if sketch is not None:
+                    sketch.update(decode_counts(counts))
+                    counts.clear()
+                if path_index is not None:
+                    path_index.add_block(block)
+                if metrics is not None:
+                    _count_block_metrics(metrics, block, len(chunk or b""))
+
+            async def submit(chunk):
+                await slots.acquire()
+                future = loop.run_in_executor(parser, parse, chunk)
+                future.add_done_callback(lambda _future: slots.release())
+                pending.append(future)
+                while pending and pending[0].done():
+                    # Raise parse errors without waiting for the end of the stream
+                    pending.popleft().result()
+
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                if writer:
+                    await writer.write(chunk)
+                await submit(chunk)
+            await submit(None)
+            await asyncio.gather(*pending)
+            if writer:
+                verify_download(url, writer, expected)
+            if path_index is not None:
+                path_index.sha256 = writer.sha256
+        if writer:
+            manifest.update(file_name, url, response.headers, writer.size, writer.sha256)
+        return counts if sketch is None else sketch
+
+    try:
+        async with ensure_client(client) as client:
+            counts = await client.transfer(
+                url, consume, headers=CacheManifest.conditional_headers(entry))
+    except DownloadError:
+        raise
     except Exception as e:
         raise DownloadError(url, e) from e
+    if counts is None:
+        return output_path
+    if capacity:
+        stats.merge(counts)
+    else:
+        decode_counts(counts, stats)
+    return output_path if tee else None
 
 
-def process_file(file_path):
+def process_file(file_path, stats=None, path_index=None, backend="gzip", per_block=False):
     """
-    Process a gzipped file asynchronously in PARTITION sized 
-    buffers and sends to mapper function.
+    Process a compressed file block by block with the bytes parser.
+    The file is decompressed in fixed size blocks so memory stays bounded
+    regardless of the size of the Contents file, and package names are
+    decoded once per file instead of once per line.
 
     Args:
-        file_path (str): The path to the gzipped file to process.
+        file_path (str): The path to the .gz or .xz file to process.
+        stats (dict): Counter to update. DEFAULT: package_stats_dict
+        path_index (PathIndexWriter): Also add the paths to this index in the same pass.
+        backend (str): Decompression backend from select_backend. DEFAULT: gzip
+        per_block (bool): Update stats with the counts of every block instead of the
+            whole file, e.g. a SpaceSaving sketch, so the file is never counted exactly.
 
     """
-    # Read and decompress file, send data in chunks to mapper
+    # Read and decompress file block by block, count packages as bytes
 
     # print("Processing file", file_path)
-    with gzip.open(file_path, 'rb') as f:
-        buffer = []
-        # Decompress and read the file in buffers of size PARTITION
-        for line in f.readlines():
-            buffer.append(line.decode())
-            if len(buffer) < PARTITION:
-                continue
-            # Send the buffer to mapper function
-            mapper(buffer)
-            buffer = []
-        # Send the left over lines to mapper function
-        mapper(buffer)
+    counts = Counter()
+    # Set when the parse is profiled, the block loop pays one check otherwise
+    metrics = file_metrics()
+    with open_contents(file_path, backend) as f:
+        for block in read_line_blocks(f):
+            count_block(block, counts)
+            if per_block:
+                stats.update(decode_counts(counts))
+                counts.clear()
+            if path_index is not None:
+                path_index.add_block(block)
+            if metrics is not None:
+                _count_block_metrics(metrics, block)
+    if not per_block:
+        decode_counts(counts, package_stats_dict if stats is None else stats)
 
     # print("Processed file", file_path)
 
 
-def mapper(lines):
+def _count_block_metrics(metrics, block, compressed=None):
+    """
+    Add the size and lines of a parsed block to a profiling record.
+    """
+    metrics["bytes_out"] = metrics.get("bytes_out", 0) + len(block)
+    metrics["lines"] = metrics.get("lines", 0) + block.count(b"\n")
+    if compressed is not None:
+        metrics["bytes_in"] = metrics.get("bytes_in", 0) + compressed
+
+
+def _process_cached_file(file_path, stats, build_path_index, manifest, backend="gzip",
+                         per_block=False):
+    """
+    Process a cached file, building its path index if it is missing or outdated.
+    """
+    entry = manifest.get(os.path.basename(file_path)) if manifest else None
+    sha256 = entry["sha256"] if entry else file_sha256(file_path)
+    build = build_path_index and not is_path_index_current(index_path(file_path), sha256)
+    with building_path_index(file_path, sha256, build) as path_index:
+        process_file(file_path, stats, path_index, backend, per_block)
+
+
+def count_file(file_path, build_path_index=False, sha256="", backend="gzip", capacity=None):
+    """
+    Count packages of a compressed file into a local Counter.
+    Runs in a worker process, the parent merges the partial counters.
+
+    Args:
+        file_path (str): The path to the .gz or .xz file to process.
+        build_path_index (bool): Also build the path index of the file.
+        sha256 (str): SHA256 of the file, recorded in the path index.
+        backend (str): Decompression backend from select_backend. DEFAULT: gzip
+        capacity (int): Count block by block into a SpaceSaving sketch of this
+            capacity instead, so the worker memory is bounded. DEFAULT: exact counts
+
+    Returns:
+        Counter: Package name to file count for this file, or the SpaceSaving sketch.
+
+    """
+    counts = SpaceSaving(capacity) if capacity else Counter()
+    with building_path_index(file_path, sha256, build_path_index) as path_index:
+        process_file(file_path, counts, path_index, backend, per_block=bool(capacity))
+    return counts
+
+
+def _count_file_split(file_path, executor, max_pending, build_path_index, sha256, backend,
+                      capacity=None):
+    """
+    Count a file split into blocks, building its path index in the reader.
+    """
+    with building_path_index(file_path, sha256, build_path_index) as path_index:
+        return count_file_sharded(
+            file_path, executor, count_bytes, max_pending,
+            block_callback=path_index.add_block if path_index is not None else None,
+            backend=backend, counts=SpaceSaving(capacity) if capacity else None)
+
+
+def mapper(lines, stats=None):
     """
     Map function to process lines from the gzipped file asynchronously.
     Counts the occurences of packages and updates dict.
     Args:
         lines (list): List of lines from the gzipped file.
+        stats (dict): Counter to update. DEFAULT: package_stats_dict
 
     """
     # Process each line to split, and count package occurences
+    if stats is None:
+        stats = package_stats_dict
 
     # print("mapper", len(lines))
     for line in lines:
@@ -134,14 +531,20 @@ def mapper(lines):
         file_name, package_names = line.rsplit(maxsplit=1)
         package_names_list = package_names.split(",")
         if file_name == 'EMPTY_PACKAGE':
-            return
+            continue
         # Updating package dictionary counts
         for package in package_names_list:
-            package_stats_dict[package] += 1
+            stats[package] += 1
     # print("mapper done")
 
 
-async def download_and_process_files(urls, output_dir, skip_download):
+async def download_and_process_files(urls, output_dir, skip_download, pipeline=False,
+                                     tee=True, workers=0, split_files=False,
+                                     client=None, checksums=None, count_index=None,
+                                     build_path_index=False, matrix=None, sketch=None,
+                                     counts=None, executor=None, incremental=False,
+                                     mirrors=None, hedge_delay=HEDGE_DELAY, profiler=None,
+                                     decompressor=AUTO, manifest=None):
     """
     Download and process multiple files asynchronously.
 
@@ -149,23 +552,249 @@ async def download_and_process_files(urls, output_dir, skip_download):
         urls (list): File URLs to download and process.
         output_dir (str): Download location for content files.
         skip_download (int): Skip download if files are already present and newer than 's' days.
+        pipeline (bool): Parse files while they are downloading, workers are not used.
+        tee (bool): Store downloaded files in output_dir when pipelining.
+        workers (int): Number of worker processes parsing files, 0 parses in a thread.
+        split_files (bool): Split each file into blocks counted by all workers.
+        client (DownloadClient): Shared client of the run. DEFAULT: a new client
+        checksums (dict): URL to size and sha256 from the Release file. Files are
+            verified against them and the largest files are started first.
+        count_index (CountIndex): Index of counts of parsed files. Files whose
+            SHA256 is indexed are not parsed again, new counts are stored.
+        build_path_index (bool): Build the path index of every file in the same
+            pass, files without an up to date path index are parsed.
+        matrix (PackageMatrix): Count each file into the column of its architecture
+            instead of package_stats_dict.
+        sketch (SpaceSaving): Count into this bounded memory sketch instead of
+            package_stats_dict. Every file is counted block by block into a sketch
+            of the same capacity merged into it, and counts are not indexed.
+        counts (dict): Merge the counts into this dict instead of package_stats_dict.
+        executor (Executor): Executor shared by several runs, left running.
+            DEFAULT: a new executor for this run
+        incremental (bool): Update cached files and their indexed counts from
+            the pdiffs of the mirror, downloading in full only when that fails.
+        mirrors (MirrorSet): Ranked mirrors holding the files. Downloads are hedged
+            on the next mirror and fail over to it. DEFAULT: only the given URLs
+        hedge_delay (float): Seconds before a download is hedged on the next
+            mirror, None to only fail over.
+        profiler (Profiler): Record the download and parse of every file. DEFAULT: not profiled
+        decompressor (str): Decompression backend, "auto" picks the fastest installed.
+        manifest (CacheManifest): Cache manifest of output_dir shared by several runs.
+            DEFAULT: loaded from output_dir
 
     """
-    # Filter files according to architecture
-    tasks = []
-    for url in urls:
-        # Add download and process tasks to list
-        tasks.append(asyncio.create_task(
-            download_file(url, output_dir, skip_download)))
-    # wait download and process tasks
-    for task in asyncio.as_completed(tasks):
-        try:
-            download_path = await task
-            loop = asyncio.get_event_loop()
-            executor = ThreadPoolExecutor()
-            await loop.run_in_executor(executor, process_file, download_path)
-        except DownloadError as e:
-            print(f"Task {task} failed with error: {e}")
+    checksums = checksums or {}
+    # Start the largest files first, they are the critical path of the run
+    urls = sorted(urls, key=lambda url: checksums.get(url, {}).get("size", 0), reverse=True)
+    async with ensure_client(client) as client:
+        await _download_and_process_files(
+            urls, output_dir, skip_download, pipeline=pipeline, tee=tee, workers=workers,
+            split_files=split_files, client=client, checksums=checksums,
+            count_index=count_index, build_path_index=build_path_index, matrix=matrix,
+            sketch=sketch, counts=counts, executor=executor, incremental=incremental,
+            mirrors=mirrors, hedge_delay=hedge_delay, profiler=profiler or DISABLED,
+            backend=select_backend(decompressor), manifest=manifest)
+
+
+async def _download_and_process_files(urls, output_dir, skip_download, *, pipeline, tee,
+                                      workers, split_files, client, checksums,
+                                      count_index, build_path_index, matrix, sketch, counts,
+                                      executor, incremental, mirrors, hedge_delay, profiler,
+                                      backend, manifest):
+    """
+    Download and process multiple files on an open client.
+    """
+    def merge(name, partial):
+        if sketch is not None:
+            sketch.merge(partial)
+        elif matrix is not None:
+            matrix.add(contents_arch(name)[0], partial)
+        else:
+            merge_counts(package_stats_dict if counts is None else counts, partial)
+
+    # One manifest shared by all downloads of the run
+    if manifest is None:
+        manifest = CacheManifest.load(output_dir)
+    loop = asyncio.get_running_loop()
+    # SHA256 and name of files whose counts are loaded from the index at the end
+    indexed = []
+
+    def is_indexed(path, sha256):
+        # Counts are indexed, and the path index too when it is requested
+        return count_index is not None and count_index.has(sha256) and (
+            not build_path_index or is_path_index_current(index_path(path), sha256))
+
+    # Files listed in the Release index with known counts need no download
+    for url in list(urls):
+        expected = checksums.get(url)
+        path = os.path.join(output_dir, os.path.basename(url))
+        # A file patched from pdiffs is indexed under its own SHA256, not the Release one
+        sha256 = expected and (CacheManifest.release_match(
+            manifest.get(os.path.basename(url)), expected) or expected["sha256"])
+        if sha256 and is_indexed(path, sha256):
+            indexed.append((sha256, url))
+            urls.remove(url)
+
+    async def source_sha256(path):
+        # SHA256 recorded when downloading, hash the file if it was not recorded
+        entry = manifest.get(os.path.basename(path))
+        if entry:
+            return entry["sha256"]
+        return await loop.run_in_executor(None, file_sha256, path)
+
+    def store(path, sha256, partial):
+        # A sketch is not exact, only exact counts are indexed
+        if count_index is not None and sketch is None:
+            count_index.put(sha256, os.path.basename(path), partial)
+
+    def load(sha256):
+        if sketch is None:
+            return count_index.get(sha256)
+        # Read row by row, the exact counts of the file are never held
+        partial = SpaceSaving(sketch.capacity)
+        for package, count in count_index.iter_counts(sha256):
+            partial.add(package, count)
+        return partial
+
+    capacity = sketch.capacity if sketch is not None else None
+
+    async def patch(url):
+        if not incremental or not url.endswith(".gz"):
+            # pdiffs are only published for the gzipped Contents files
+            return None
+        with profiler.stage("pdiff", url) as record:
+            path = record["path"] = await update_from_pdiff(
+                url, output_dir, client, manifest, count_index, checksums.get(url))
+        return path
+
+    def alternatives(url):
+        return mirrors.alternatives(url) if mirrors is not None else [url]
+
+    async def fetch(url):
+        path = await patch(url)
+        if path:
+            return path
+        expected = checksums.get(url)
+        # Segmented downloads share their partial file, they only fail over
+        large = expected and expected["size"] >= RANGE_THRESHOLD
+        with profiler.stage("download", url) as record:
+            return await hedged(
+                alternatives(url),
+                lambda candidate: download_file(
+                    candidate, output_dir, skip_download, client, manifest, expected,
+                    record if profiler.enabled else None),
+                hedge_delay=None if large else hedge_delay)
+
+    async def stream(url):
+        path = await patch(url)
+        if path:
+            return url, load(await source_sha256(path))
+        candidates = alternatives(url)
+        for candidate in candidates:
+            # A stream parsed while downloading fails over but is not hedged
+            partial = SpaceSaving(capacity) if capacity else Counter()
+            try:
+                with profiler.stage("stream", candidate) as record:
+                    path = await stream_and_process_file(
+                        candidate, output_dir, skip_download, tee, partial, client, manifest,
+                        checksums.get(url), build_path_index,
+                        record if profiler.enabled else None, backend, capacity)
+                break
+            except DownloadError as e:
+                if candidate == candidates[-1]:
+                    raise
+                print(f"Failing over after error: {e}", file=sys.stderr)
+        if path:
+            store(path, await source_sha256(path), partial)
+        return url, partial
+
+    if pipeline:
+        tasks = [asyncio.create_task(stream(url)) for url in urls]
+        for task in asyncio.as_completed(tasks):
+            try:
+                merge(*await task)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                # Download and parse failures both lose this file only, the stream stage
+                # records the error
+                print(f"Task {task} failed with error: {e}", file=sys.stderr)
+    else:
+        # Filter files according to architecture
+        tasks = []
+        for url in urls:
+            # Add download and process tasks to list
+            tasks.append(asyncio.create_task(fetch(url)))
+        # One executor for the whole run. Each file is counted into its own
+        # Counter so workers never share state, the partial counts are merged here
+        if executor is None:
+            executor = process_pool(workers) if workers else ThreadPoolExecutor()
+            executor_context = executor
+        else:
+            executor_context = nullcontext(executor)
+
+        async def parse(path, sha256):
+            try:
+                partial = await count(path, sha256)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                # A corrupt file or a crashed worker loses this file only, like a failed download
+                if not split_files:
+                    # The parse stage of split files records its own error
+                    profiler.add("parse", path, error=str(e))
+                print(f"Parsing {path} failed, skipping it: {e}", file=sys.stderr)
+                return path, None
+            store(path, sha256, partial)
+            return path, partial
+
+        async def count(path, sha256):
+            if split_files:
+                # Read and decompress in a thread, count the blocks in the executor
+                max_pending = 2 * (workers or os.cpu_count() or 1)
+                with profiler.stage("parse", path) as record:
+                    partial = await loop.run_in_executor(
+                        None, _count_file_split, path, executor, max_pending, build_path_index,
+                        sha256, backend, capacity)
+                    record["bytes_in"] = os.path.getsize(path)
+            elif profiler.enabled:
+                # The worker reports its start time, the difference is the queue wait
+                submitted = time.time()
+                partial, metrics = await loop.run_in_executor(
+                    executor, run_profiled, count_file,
+                    (path, build_path_index, sha256, backend, capacity), profiler.capture)
+                profiler.add("parse", path, queue_wait=metrics.pop("started") - submitted,
+                             bytes_in=os.path.getsize(path), **metrics)
+            else:
+                partial = await loop.run_in_executor(
+                    executor, count_file, path, build_path_index, sha256, backend, capacity)
+            return partial
+
+        with executor_context:
+            parse_tasks = []
+            # wait download and process tasks
+            for task in asyncio.as_completed(tasks):
+                try:
+                    download_path = await task
+                except DownloadError as e:
+                    print(f"Task {task} failed with error: {e}", file=sys.stderr)
+                    continue
+                sha256 = ""
+                if count_index is not None or build_path_index:
+                    sha256 = await source_sha256(download_path)
+                if is_indexed(download_path, sha256):
+                    indexed.append((sha256, download_path))
+                    continue
+                parse_tasks.append(asyncio.ensure_future(parse(download_path, sha256)))
+            for parse_task in asyncio.as_completed(parse_tasks):
+                path, partial = await parse_task
+                if partial is not None:
+                    merge(path, partial)
+    if indexed and (matrix is not None or sketch is not None):
+        # Each file goes to its own column, or into the sketch without a full union
+        for sha256, name in indexed:
+            with profiler.stage("index", name):
+                merge(name, load(sha256))
+    elif indexed:
+        # Sum all indexed files in one query instead of loading them one by one
+        with profiler.stage("index", files=len(indexed)):
+            merge(None, count_index.union(sha256 for sha256, _name in indexed))
 
 
 async def main():
@@ -174,83 +803,43 @@ async def main():
     For test execution.
     """
     start = time.time()
-    files = get_contents_file_list(MIRROR)
-    files = process_contents_file_list(MIRROR, files)
+    files = discover_contents_files(MIRROR)
     urls = filter_files(files, "arm64", True)
-    await download_and_process_files(urls, "./downloads", 10)
+    await download_and_process_files(urls, "./downloads", 10, checksums=file_checksums(files))
     stats = return_stats(package_stats_dict, True, 10)
     print(stats)
     print("Time taken:", time.time()-start)
+    print("Peak memory (MB):", peak_memory_mb())
 
 
-def package_stats(arch, mirror, include_udeb, limit, output_dir, skip_download):
+def discover_contents_files(mirror, discovery="release", profiler=DISABLED):
     """
-    Calculate and print package statistics based on given parameters.
+    Find the Contents files of a mirror URL.
 
     Args:
-        arch (str): Architecture of the packages to parse.
         mirror (str): Mirror URL for contents files.
-        include_udeb (bool): Flag to include udeb files for architecture.
-        limit (int): Top 'limit' number of packages with maximum count of files.
-        output_dir (str): Download location for content files.
-        skip_download (int): Skip download if files are already present and newer than 's' days.
-
-    """
-    files = get_contents_file_list(mirror)
-    files = process_contents_file_list(mirror, files)
-    urls = filter_files(files, arch, include_udeb)
-    asyncio.run(download_and_process_files(
-        urls, output_dir, skip_download))
-    stats = return_stats(package_stats_dict, True, limit)
-    print(stats)
+        discovery (str): "release" to read the suite's Release index, falling
+            back to the directory listing if unavailable, or "html" to scrape the listing.
+        profiler (Profiler): Record the discovery requests. DEFAULT: not profiled
 
+    Returns:
+        dict: Files by architecture.
 
-def cli():
     """
-    Command-line interface function to get package statistics.
-    """
-    argparser = argparse.ArgumentParser(
-        description="CLI tool to get the package statistics of debian packages given architecture."
-    )
-    argparser.add_argument(
-        "architecture", type=str,
-        help="Architecture of the packages to parse.")
-    argparser.add_argument(
-        "-m", "--mirror_url", type=str,
-        default="http://ftp.uk.debian.org/debian/dists/stable/main/",
-        help=(
-            "Mirror URL for contents files. "
-            "DEFAULT: http://ftp.uk.debian.org/debian/dists/stable/main/")
-    )
-    argparser.add_argument(
-        "-u", "--udeb",
-        help=("Include udeb file for architecture. \n"
-              "DEFAULT: False"),
-        action="store_true"
-    )
-    argparser.add_argument(
-        "-l", "--limit", type=int, default=10,
-        help=("Top 'l' number of packages with maximum count of files. \n"
-              "DEFAULT: 10"
-              )
-    )
-    argparser.add_argument(
-        "-o", "--output-dir", type=str, default=os.path.join(os.getcwd(), "downloads"),
-        help=(
-            "Download location for content files \n"
-            "DEFAULT: current-working-directory/downloads"
-        )
-    )
-    argparser.add_argument(
-        "-s", "--skip-download", type=int, default=0,
-        help=(
-            "Skip download if files are already present and newer than 's' days. \n"
-            "DEFAULT: 10"
-        ),
-    )
-    args = argparser.parse_args()
-    package_stats(arch=args.architecture, mirror=args.mirror_url, include_udeb=args.udeb,
-                  limit=args.limit, output_dir=args.output_dir, skip_download=args.skip_download)
+    if discovery == "release":
+        suite_url, component = split_mirror_url(mirror)
+        try:
+            with profiler.stage("release", suite_url):
+                release = get_release(suite_url)
+        except DownloadError as e:
+            print(f"Release index unavailable, scraping directory listing: {e}", file=sys.stderr)
+        else:
+            files = contents_files_from_release(suite_url, release, component)
+            if files:
+                return files
+    with profiler.stage("scrape", mirror):
+        files = get_contents_file_list(mirror)
+        return process_contents_file_list(mirror, files)
 
 
 if __name__ == "__main__":
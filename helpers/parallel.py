@@ -0,0 +1,134 @@
+############################################################
+"""
+Intra-file parallel parsing of Contents files using shared memory.
+A single reader decompresses the file into line aligned blocks, each block
+is copied into a shared memory segment and only the segment name is sent
+to the worker processes, so no file data is pickled.
+Functions:
+
+    process_pool:
+        Create a process pool whose workers are safe to start from any thread.
+
+    count_shared_block:
+        Count packages of a block stored in a shared memory segment.
+
+    count_file_sharded:
+        Split a compressed file into blocks and count them in an executor.
+"""
+############################################################
+
+from collections import Counter
+from concurrent.futures import wait, FIRST_COMPLETED, ProcessPoolExecutor
+import multiprocessing
+from multiprocessing import shared_memory
+from .decompress import open_contents
+from .streaming import read_line_blocks
+
+SHARD_SIZE = 8 << 20  # 8 MiB of decompressed data per block
+
+
+def process_pool(workers):
+    """
+    Create a process pool whose workers are safe to start from any thread.
+    Workers are started on the first submit, which may come from a reader
+    thread. Forking while other threads hold locks can deadlock the child,
+    so workers are forked from a single threaded fork server instead, or
+    spawned where there is no fork server, e.g. on Windows.
+
+    Args:
+        workers (int): Number of worker processes.
+
+    Returns:
+        ProcessPoolExecutor: The pool.
+
+    """
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=workers,
+                               mp_context=multiprocessing.get_context(method))
+
+
+def count_shared_block(name, size, count_func):
+    """
+    Count packages of a block stored in a shared memory segment.
+
+    Args:
+        name (str): Name of the shared memory segment.
+        size (int): Number of bytes of the segment holding data.
+        count_func (callable): Function counting a block of bytes into a Counter.
+
+    Returns:
+        Counter: Package name to file count for this block.
+
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        view = shm.buf[:size]
+        block = bytes(view)
+        view.release()
+    finally:
+        shm.close()
+    return count_func(block)
+
+
+def _release(shm):
+    """
+    Close and remove a shared memory segment.
+    """
+    shm.close()
+    shm.unlink()
+
+
+def count_file_sharded(file_path, executor, count_func, max_pending, block_size=SHARD_SIZE,
+                       block_callback=None, backend="gzip", counts=None):
+    """
+    Split a compressed file into blocks and count them in an executor.
+    At most max_pending blocks are in flight to bound memory use.
+
+    Args:
+        file_path (str): The path to the .gz or .xz file to process.
+        executor (Executor): Executor running count_shared_block.
+        count_func (callable): Function counting a block of bytes into a Counter.
+        max_pending (int): Maximum number of blocks waiting to be counted.
+        block_size (int): Number of decompressed bytes per block.
+        block_callback (callable): Also called with every block by the reader,
+            e.g. to build a path index in the same pass.
+        backend (str): Decompression backend from select_backend. DEFAULT: gzip
+        counts (object): Target updated with the Counter of every block, e.g. a
+            SpaceSaving sketch. DEFAULT: a new Counter
+
+    Returns:
+        object: counts, with the package counts of the whole file.
+
+    """
+    if counts is None:
+        counts = Counter()
+    segments = {}
+
+    def collect(futures):
+        # Merge finished blocks and free their segments
+        for future in futures:
+            shm = segments.pop(future)
+            try:
+                counts.update(future.result())
+            finally:
+                _release(shm)
+
+    try:
+        with open_contents(file_path, backend) as f:
+            for block in read_line_blocks(f, block_size):
+                if block_callback is not None:
+                    block_callback(block)
+                shm = shared_memory.SharedMemory(create=True, size=len(block))
+                shm.buf[:len(block)] = block
+                future = executor.submit(count_shared_block, shm.name, len(block), count_func)
+                segments[future] = shm
+                if len(segments) >= max_pending:
+                    done, _ = wait(segments, return_when=FIRST_COMPLETED)
+                    collect(done)
+        collect(wait(segments).done)
+    finally:
+        # Do not leak segments if reading or counting failed
+        for future, shm in segments.items():
+            future.cancel()
+            _release(shm)
+    return counts
@@ -0,0 +1,104 @@
+############################################################
+"""
+Bytes level parser for Contents files.
+Works on line aligned blocks of raw bytes and only decodes the distinct
+package names, instead of decoding and splitting every line as str.
+Functions:
+
+    count_lines_bytes:
+        Count packages of a block line by line.
+
+    count_block:
+        Count packages of a whole block with a few calls into C.
+
+    decode_counts:
+        Decode bytes package names of a counter into str.
+
+    count_bytes:
+        Count packages of a block and return a Counter keyed by str.
+"""
+############################################################
+
+from collections import Counter
+
+EMPTY_PACKAGE = b"EMPTY_PACKAGE"
+
+
+def count_lines_bytes(block, counts):
+    """
+    Count packages of a block line by line.
+    An EMPTY_PACKAGE line is skipped, the rest of the block is still counted.
+
+    Args:
+        block (bytes): Line aligned block of a Contents file.
+        counts (Counter): Counter keyed by bytes package names to update.
+
+    """
+    for line in block.split(b"\n"):
+        # Split on the last whitespace run, ignoring surrounding whitespace
+        fields = line.rsplit(None, 1)
+        if len(fields) != 2 or fields[0].strip() == EMPTY_PACKAGE:
+            continue
+        for package in fields[1].split(b","):
+            counts[package] += 1
+
+
+def count_block(block, counts):
+    """
+    Count packages of a whole block with a few calls into C.
+    The location field of every line is collected in one comprehension,
+    all package tokens are split in one call and counted by Counter.update.
+
+    Args:
+        block (bytes): Line aligned block of a Contents file.
+        counts (Counter): Counter keyed by bytes package names to update.
+
+    """
+    # EMPTY_PACKAGE lines are rare, count such blocks line by line
+    if EMPTY_PACKAGE in block:
+        count_lines_bytes(block, counts)
+        return
+    try:
+        locations = [line.rsplit(None, 1)[-1] for line in block.split(b"\n") if line]
+    except IndexError:
+        # A whitespace only line splits into no fields, count such blocks line by line
+        count_lines_bytes(block, counts)
+        return
+    if locations:
+        counts.update(b",".join(locations).split(b","))
+
+
+def decode_counts(counts, target=None):
+    """
+    Decode bytes package names of a counter into str.
+
+    Args:
+        counts (dict): Counter keyed by bytes package names.
+        target (dict): Counter keyed by str to add the counts to. DEFAULT: new Counter
+
+    Returns:
+        dict: Counter keyed by str package names.
+
+    """
+    if target is None:
+        target = Counter()
+    for package, count in counts.items():
+        key = package.decode()
+        target[key] = target.get(key, 0) + count
+    return target
+
+
+def count_bytes(block):
+    """
+    Count packages of a block and return a Counter keyed by str.
+
+    Args:
+        block (bytes): Line aligned block of a Contents file.
+
+    Returns:
+        Counter: Package name to file count for this block.
+
+    """
+    counts = Counter()
+    count_block(block, counts)
+    return decode_counts(counts)
@@ -0,0 +1,602 @@
+############################################################
+"""
+Reverse index from file paths to the packages shipping them.
+Built while a Contents file is parsed and stored as a sorted,
+prefix compressed path table that is memory mapped for queries, so
+no Python objects are kept for the millions of paths.
+
+File layout, all integers little endian:
+    header: magic, version, record count, restart count, section offsets,
+        location count and the SHA256 of the source Contents file.
+    records: varint shared prefix length, varint suffix length, suffix,
+        varint location id. Every RESTART_INTERVAL records the shared
+        prefix is 0, so the full path can be read at that record.
+    restarts: uint64 offsets of the restart records.
+    locations: uint64 offsets followed by the distinct location fields
+        (comma separated package names).
+Functions:
+
+    encode_varint:
+        Encode a non negative integer as a varint.
+
+    decode_varint:
+        Decode a varint from a buffer.
+
+    index_path:
+        Return the path index file of a Contents file.
+
+    is_current:
+        Check if a path index exists and was built from a given Contents file.
+
+    find_path_indexes:
+        List the path indexes of a download directory.
+
+    building_path_index:
+        Context manager building the path index of a Contents file if enabled.
+
+Classes:
+
+    PathIndexWriter:
+        Build a path index from line aligned blocks of a Contents file.
+
+    PathIndex:
+        Memory mapped path index answering exact, prefix and glob queries.
+"""
+############################################################
+
+from array import array
+from contextlib import contextmanager, ExitStack
+import fnmatch
+import heapq
+import mmap
+import os
+import re
+import struct
+from .download_cache import temp_path
+from .parser import EMPTY_PACKAGE
+
+MAGIC = b"DPSPATH\0"
+VERSION = 1
+HEADER = struct.Struct("<8sIQQQQQQ64s")
+RESTART_INTERVAL = 16
+SORT_BUFFER = 1 << 17  # Out of order records sorted in memory at a time
+WRITE_BATCH = 4096  # Records encoded before a write
+READ_SIZE = 1 << 20
+READ_AHEAD = 1 << 16  # Bytes kept decoded ahead, longer than any record
+INDEX_SUFFIX = ".paths"
+GLOB_CHARS = re.compile(rb"[*?\[]")
+# Encodings of the small integers that make up most varints
+SMALL_VARINTS = [bytes((value,)) for value in range(0x80)]
+
+
+def encode_varint(value):
+    """
+    Encode a non negative integer as a varint.
+
+    Args:
+        value (int): Integer to encode.
+
+    Returns:
+        bytes: Little endian base 128 encoding.
+
+    """
+    if value < 0x80:
+        return SMALL_VARINTS[value]
+    output = bytearray()
+    while value >= 0x80:
+        output.append((value & 0x7F) | 0x80)
+        value >>= 7
+    output.append(value)
+    return bytes(output)
+
+
+def decode_varint(buffer, offset):
+    """
+    Decode a varint from a buffer.
+
+    Args:
+        buffer: Bytes like object.
+        offset (int): Position of the varint.
+
+    Returns:
+        tuple: Decoded integer and the position after it.
+
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = buffer[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def index_path(contents_path):
+    """
+    Return the path index file of a Contents file.
+
+    Args:
+        contents_path (str): Path of the Contents file.
+
+    Returns:
+        str: Path of its path index.
+
+    """
+    return contents_path + INDEX_SUFFIX
+
+
+def is_current(path, sha256):
+    """
+    Check if a path index exists and was built from a given Contents file.
+
+    Args:
+        path (str): Path of the index file.
+        sha256 (str): SHA256 of the Contents file.
+
+    Returns:
+        bool: True if the index is up to date.
+
+    """
+    if not sha256 or not os.path.exists(path):
+        return False
+    try:
+        with PathIndex(path) as index:
+            return index.sha256 == sha256
+    except (OSError, ValueError):
+        return False
+
+
+def find_path_indexes(directory, arch=None):
+    """
+    List the path indexes of a download directory.
+
+    Args:
+        directory (str): Download directory.
+        arch (str): Only list indexes of this architecture. DEFAULT: all
+
+    Returns:
+        list: Paths of the index files, sorted by name.
+
+    """
+    if not os.path.isdir(directory):
+        return []
+    paths = []
+    for name in sorted(os.listdir(directory)):
+        if not name.startswith("Contents-") or not name.endswith(INDEX_SUFFIX):
+            continue
+        contents_name = name[:-len(INDEX_SUFFIX)]
+        stem = contents_name.split(".", 1)[0]
+        if arch is None or stem.split("-")[-1] == arch:
+            paths.append(os.path.join(directory, name))
+    return paths
+
+
+@contextmanager
+def building_path_index(contents_path, sha256="", enabled=True):
+    """
+    Context manager building the path index of a Contents file if enabled.
+    The index is written when the context exits without error.
+
+    Args:
+        contents_path (str): Path of the Contents file.
+        sha256 (str): SHA256 of the Contents file.
+        enabled (bool): Build the index, otherwise yield None.
+
+    Yields:
+        PathIndexWriter: Writer to add blocks to, or None.
+
+    """
+    if not enabled:
+        yield None
+        return
+    writer = PathIndexWriter(index_path(contents_path), sha256)
+    try:
+        yield writer
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+
+
+def _common_prefix(first, second):
+    """
+    Return the length of the common prefix of two byte strings.
+    """
+    # Binary search on slice comparisons, which run in C
+    low, high = 0, min(len(first), len(second))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if first[:middle] == second[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _read_records(f, count):
+    """
+    Decode prefix compressed (path, location id) records from a file, a block at a time.
+    """
+    buffer = b""
+    offset = 0
+    key = b""
+    end_of_file = False
+    for _record in range(count):
+        if not end_of_file and len(buffer) - offset < READ_AHEAD:
+            chunk = f.read(READ_SIZE)
+            end_of_file = len(chunk) < READ_SIZE
+            buffer = buffer[offset:] + chunk
+            offset = 0
+        shared, offset = decode_varint(buffer, offset)
+        length, offset = decode_varint(buffer, offset)
+        key = key[:shared] + buffer[offset:offset + length]
+        location_id, offset = decode_varint(buffer, offset + length)
+        yield key, location_id
+
+
+def _pad(f):
+    """
+    Pad a file to an 8 byte boundary and return the position.
+    """
+    position = f.tell()
+    if position % 8:
+        f.write(b"\0" * (8 - position % 8))
+    return f.tell()
+
+
+class PathIndexWriter:
+    """
+    Build a path index from line aligned blocks of a Contents file.
+    Records are prefix compressed and written to disk as they are added,
+    only the distinct location fields are kept in memory. Contents files
+    are sorted by path; should records arrive out of order, they are sorted
+    sort_buffer at a time into run files merged when the index is closed.
+
+    Args:
+        path (str): Path of the index file to write.
+        sha256 (str): SHA256 of the source Contents file. DEFAULT: unknown
+        sort_buffer (int): Out of order records sorted in memory at a time.
+
+    """
+    def __init__(self, path, sha256="", sort_buffer=SORT_BUFFER):
+        self.path = path
+        self.sha256 = sha256
+        self.sort_buffer = sort_buffer
+        self.locations = {}
+        self.count = 0
+        self.is_sorted = True
+        self._pending = []
+        self._runs = []  # Path and number of records of every sorted run file
+        self._last = b""
+        self._restarts = array('Q')
+        self._tmp_path = temp_path(path)
+        self._file = self._open_index()
+        self._position = 0  # Size of the records written so far
+
+    def _open_index(self):
+        """
+        Open the temporary index file and reserve its header.
+        """
+        f = open(self._tmp_path, 'wb')  # pylint: disable=consider-using-with
+        f.write(b"\0" * HEADER.size)
+        self._records_offset = _pad(f)
+        return f
+
+    def _encode(self, records):
+        """
+        Prefix compress (path, location id) records in path order.
+        """
+        output = []
+        last = self._last
+        count = self.count
+        position = self._position
+        for file_name, location_id in records:
+            if count % RESTART_INTERVAL == 0:
+                self._restarts.append(position)
+                shared = 0
+            else:
+                shared = _common_prefix(last, file_name)
+            record = b"".join((encode_varint(shared), encode_varint(len(file_name) - shared),
+                               file_name[shared:], encode_varint(location_id)))
+            output.append(record)
+            position += len(record)
+            count += 1
+            last = file_name
+            if len(output) >= WRITE_BATCH:
+                self._file.write(b"".join(output))
+                output = []
+        self._last = last
+        self.count = count
+        self._position = position
+        self._file.write(b"".join(output))
+
+    def add_block(self, block):
+        """
+        Add the lines of a line aligned block.
+
+        Args:
+            block (bytes): Block of a decompressed Contents file.
+
+        """
+        locations = self.locations
+        records = []
+        for line in block.split(b"\n"):
+            fields = line.rsplit(None, 1)
+            if len(fields) != 2:
+                continue
+            file_name = fields[0].strip()
+            # Packages without files, not a path, as the counters skip them
+            if file_name == EMPTY_PACKAGE:
+                continue
+            records.append((file_name, locations.setdefault(fields[1], len(locations))))
+        if self.is_sorted:
+            last = self._last
+            for index, (file_name, _location_id) in enumerate(records):
+                if file_name < last:
+                    # The sorted records written so far become the first run
+                    self.is_sorted = False
+                    self._encode(records[:index])
+                    records = records[index:]
+                    break
+                last = file_name
+            else:
+                self._encode(records)
+                return
+        self._pending.extend(records)
+        if len(self._pending) >= self.sort_buffer:
+            self._spill()
+
+    def _spill(self):
+        """
+        Sort the pending out of order records into a run file.
+        """
+        self._pending.sort()
+        run_path = f"{self._tmp_path}.run{len(self._runs)}"
+        self._runs.append((run_path, len(self._pending)))
+        with open(run_path, 'wb') as f:
+            output = []
+            last = b""
+            for file_name, location_id in self._pending:
+                shared = _common_prefix(last, file_name)
+                output.append(b"".join((
+                    encode_varint(shared), encode_varint(len(file_name) - shared),
+                    file_name[shared:], encode_varint(location_id))))
+                last = file_name
+                if len(output) >= WRITE_BATCH:
+                    f.write(b"".join(output))
+                    output = []
+            f.write(b"".join(output))
+        self._pending = []
+
+    def _sort(self):
+        """
+        Merge the sorted runs into a new index file, reading each run sequentially.
+        """
+        if self._pending:
+            self._spill()
+        self._file.close()
+        with ExitStack() as stack:
+            f = stack.enter_context(open(self._tmp_path, 'rb'))
+            f.seek(self._records_offset)
+            runs = [_read_records(f, self.count)]
+            for run_path, count in self._runs:
+                runs.append(_read_records(stack.enter_context(open(run_path, 'rb')), count))
+            sorted_path = self._tmp_path
+            self._tmp_path = temp_path(self.path)
+            self._file = self._open_index()
+            self._restarts = array('Q')
+            self._last = b""
+            self.count = 0
+            self._position = 0
+            self._encode(heapq.merge(*runs))
+        os.remove(sorted_path)
+        self._remove_runs()
+
+    def _remove_runs(self):
+        """
+        Remove the run files.
+        """
+        for run_path, _count in self._runs:
+            if os.path.exists(run_path):
+                os.remove(run_path)
+        self._runs = []
+
+    def close(self):
+        """
+        Write the index file atomically.
+        """
+        try:
+            if not self.is_sorted:
+                self._sort()
+            f = self._file
+            restarts_offset = _pad(f)
+            self._restarts.tofile(f)
+            locations_offset = _pad(f)
+            ordered = sorted(self.locations, key=self.locations.get)
+            location_offsets = array('Q', [0])
+            for location in ordered:
+                location_offsets.append(location_offsets[-1] + len(location))
+            location_offsets.tofile(f)
+            f.write(b"".join(ordered))
+            f.seek(0)
+            f.write(HEADER.pack(
+                MAGIC, VERSION, self.count, len(self._restarts), self._records_offset,
+                restarts_offset, locations_offset, len(ordered),
+                self.sha256.encode().ljust(64, b"\0")))
+            f.close()
+            os.replace(self._tmp_path, self.path)
+        finally:
+            self.abort()
+
+    def abort(self):
+        """
+        Discard the index being built.
+        """
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+        self._remove_runs()
+
+
+class PathIndex:
+    """
+    Memory mapped path index answering exact, prefix and glob queries.
+
+    Args:
+        path (str): Path of the index file.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.count, restart_count, self._records, restarts_offset,
+         locations_offset, location_count, sha256) = HEADER.unpack_from(self._data)
+        if magic != MAGIC or version != VERSION:
+            self._data.close()
+            raise ValueError(f"{path} is not a path index")
+        self.sha256 = sha256.rstrip(b"\0").decode()
+        self._restarts = memoryview(self._data)[
+            restarts_offset:restarts_offset + 8 * restart_count].cast('Q')
+        self._location_offsets = memoryview(self._data)[
+            locations_offset:locations_offset + 8 * (location_count + 1)].cast('Q')
+        self._location_data = locations_offset + 8 * (location_count + 1)
+
+    def close(self):
+        """
+        Unmap the index file.
+        """
+        self._restarts.release()
+        self._location_offsets.release()
+        self._data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def location(self, location_id):
+        """
+        Return the location field of a location id.
+
+        Args:
+            location_id (int): Location id of a record.
+
+        Returns:
+            str: Comma separated package names.
+
+        """
+        start = self._location_data + self._location_offsets[location_id]
+        end = self._location_data + self._location_offsets[location_id + 1]
+        return self._data[start:end].decode()
+
+    def _scan(self, restart):
+        """
+        Yield (path, location id) records starting at a restart point.
+        """
+        data = self._data
+        offset = self._records + self._restarts[restart]
+        key = b""
+        for _record in range(restart * RESTART_INTERVAL, self.count):
+            shared, offset = decode_varint(data, offset)
+            length, offset = decode_varint(data, offset)
+            key = key[:shared] + data[offset:offset + length]
+            location_id, offset = decode_varint(data, offset + length)
+            yield key, location_id
+
+    def _restart_key(self, restart):
+        """
+        Return the full path of a restart record.
+        """
+        offset = self._records + self._restarts[restart]
+        _shared, offset = decode_varint(self._data, offset)
+        length, offset = decode_varint(self._data, offset)
+        return self._data[offset:offset + length]
+
+    def _lower_bound(self, target):
+        """
+        Yield records in path order starting at the first path >= target.
+        """
+        if not self.count:
+            return
+        # Last restart whose path is <= target
+        low, high = 0, len(self._restarts) - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self._restart_key(middle) <= target:
+                low = middle
+            else:
+                high = middle - 1
+        for key, location_id in self._scan(low):
+            if key >= target:
+                yield key, location_id
+
+    @staticmethod
+    def _normalize(query):
+        """
+        Contents paths have no leading slash.
+        """
+        return query.encode().lstrip(b"/")
+
+    def exact(self, query):
+        """
+        Find the packages shipping a path.
+
+        Args:
+            query (str): File path, with or without leading slash.
+
+        Returns:
+            str: Comma separated package names, None if the path is not indexed.
+
+        """
+        target = self._normalize(query)
+        for key, location_id in self._lower_bound(target):
+            return self.location(location_id) if key == target else None
+        return None
+
+    def prefix(self, query, limit=None):
+        """
+        Find the paths starting with a prefix.
+
+        Args:
+            query (str): Path prefix, with or without leading slash.
+            limit (int): Maximum number of results. DEFAULT: no limit
+
+        Yields:
+            tuple: Path and comma separated package names.
+
+        """
+        target = self._normalize(query)
+        found = 0
+        for key, location_id in self._lower_bound(target):
+            if not key.startswith(target) or (limit is not None and found >= limit):
+                return
+            found += 1
+            yield key.decode(), self.location(location_id)
+
+    def glob(self, pattern, limit=None):
+        """
+        Find the paths matching a shell style pattern.
+        Only the paths sharing the literal prefix of the pattern are scanned.
+
+        Args:
+            pattern (str): Pattern with *, ? or [...] wildcards.
+            limit (int): Maximum number of results. DEFAULT: no limit
+
+        Yields:
+            tuple: Path and comma separated package names.
+
+        """
+        target = self._normalize(pattern)
+        match = GLOB_CHARS.search(target)
+        literal = target[:match.start()] if match else target
+        found = 0
+        for key, location_id in self._lower_bound(literal):
+            if not key.startswith(literal) or (limit is not None and found >= limit):
+                return
+            if fnmatch.fnmatchcase(key, target):
+                found += 1
+                yield key.decode(), self.location(location_id)
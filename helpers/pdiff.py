@@ -0,0 +1,326 @@
+############################################################
+"""
+Incremental updates of Contents files from the pdiffs of a mirror.
+Next to Contents-<arch>.gz, mirrors publish Contents-<arch>.diff/Index
+listing the SHA256 of past versions and gzipped ed scripts turning each
+version into the next. The cached file is patched while streaming, and
+the package counts are updated from the added and removed lines.
+Functions:
+
+    diff_index_url:
+        Return the URL of the diff index of a Contents file.
+
+    parse_diff_index:
+        Parse a pdiff Index file.
+
+    patches_to_apply:
+        Select the patches turning a known version into the current one.
+
+    parse_ed_patch:
+        Parse an ed script into commands in file order.
+
+    apply_ed_patch:
+        Apply ed commands to a stream of lines.
+
+    gzip_sha256:
+        Compute the SHA256 of the decompressed content of a gzipped file.
+
+    patch_file:
+        Apply patches to a gzipped file in place.
+
+    apply_count_deltas:
+        Update package counts with the lines added and removed by patches.
+"""
+############################################################
+
+from collections import Counter
+import gzip
+import hashlib
+import io
+import os
+import re
+from .download_cache import temp_path
+from .exceptions import PatchError
+from .parser import count_lines_bytes, decode_counts
+from .streaming import BLOCK_SIZE
+
+DIFF_INDEX_FIELDS = {
+    "SHA256-History": "history",
+    "SHA256-Patches": "patches",
+    "SHA256-Download": "download",
+}
+ED_COMMAND = re.compile(rb"^(\d+)(?:,(\d+))?([acd])$")
+WRITE_LINES = 4096  # Lines joined into one write of the patched file
+
+
+def diff_index_url(url):
+    """
+    Return the URL of the diff index of a Contents file.
+
+    Args:
+        url (str): URL of the gzipped Contents file.
+
+    Returns:
+        str: URL of Contents-<arch>.diff/Index.
+
+    """
+    return os.path.splitext(url)[0] + ".diff/Index"
+
+
+def parse_diff_index(text):
+    """
+    Parse a pdiff Index file.
+
+    Args:
+        text (str): Content of the Index file.
+
+    Returns:
+        dict: "current" as (sha256, size) of the decompressed current file,
+            "history", "patches" and "download" as lists of (sha256, size, name),
+            and "merged" if every patch leads directly to the current version.
+
+    """
+    index = {"current": None, "history": [], "patches": [], "download": [], "merged": False}
+    field = None
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        if line[0].isspace():
+            # Continuation line of a multi line field
+            key = DIFF_INDEX_FIELDS.get(field)
+            if key:
+                sha256, size, name = line.split()
+                index[key].append((sha256, int(size), name))
+            continue
+        field, _sep, value = line.partition(":")
+        if field == "SHA256-Current":
+            sha256, size = value.split()
+            index["current"] = (sha256, int(size))
+        elif field == "X-Patch-Precedence":
+            index["merged"] = value.strip() == "merged"
+    return index
+
+
+def patches_to_apply(index, sha256):
+    """
+    Select the patches turning a known version into the current one.
+
+    Args:
+        index (dict): Parsed diff index.
+        sha256 (str): SHA256 of the decompressed cached file.
+
+    Returns:
+        list: (download name, download sha256, patch sha256) of the patches in
+            order, empty if the file is current, None if its version is unknown.
+
+    """
+    if index["current"] and sha256 == index["current"][0]:
+        return []
+    versions = [name for version_sha256, _size, name in index["history"]
+                if version_sha256 == sha256]
+    if not versions:
+        return None
+    patch_names = [name for _sha256, _size, name in index["patches"]]
+    if index["merged"]:
+        # Merged patches are named T-<current>-F-<version>
+        selected = [name for name in patch_names if name.endswith("-F-" + versions[0])]
+    elif versions[0] in patch_names:
+        selected = patch_names[patch_names.index(versions[0]):]
+    else:
+        selected = []
+    if not selected:
+        return None
+    patch_sha256 = {name: sha256 for sha256, _size, name in index["patches"]}
+    download_sha256 = {name: sha256 for sha256, _size, name in index["download"]}
+    try:
+        return [(name + ".gz", download_sha256[name + ".gz"], patch_sha256[name])
+                for name in selected]
+    except KeyError:
+        return None
+
+
+def parse_ed_patch(data):
+    """
+    Parse an ed script into commands in file order.
+    Scripts written by diff --ed list their commands from the end of the file,
+    so they can be applied in one pass once sorted.
+
+    Args:
+        data (bytes): Decompressed ed script.
+
+    Returns:
+        list: (first line, last line, command, added lines) tuples sorted by line.
+
+    Raises:
+        PatchError: If the script has an unsupported command.
+
+    """
+    commands = []
+    lines = io.BytesIO(data)
+    for line in lines:
+        command = line.rstrip(b"\n")
+        if command == b"s/.//" and commands:
+            # A text line of a single "." was written as ".." and is fixed up here
+            text = commands[-1][3]
+            text[-1] = text[-1][1:]
+            continue
+        if command == b"a" and commands:
+            # Continue the text of the previous command after a fix up
+            text = commands[-1][3]
+        else:
+            match = ED_COMMAND.match(command)
+            if not match:
+                raise PatchError("ed script", f"unsupported command {command!r}")
+            first = int(match.group(1))
+            last = int(match.group(2) or first)
+            kind = match.group(3).decode()
+            text = []
+            commands.append((first, last, kind, text))
+            if kind == "d":
+                continue
+        for text_line in lines:
+            if text_line == b".\n":
+                break
+            text.append(text_line)
+    commands.sort(key=lambda command: command[0])
+    return commands
+
+
+def apply_ed_patch(lines, commands, added, removed):
+    """
+    Apply ed commands to a stream of lines.
+
+    Args:
+        lines (iterable): Lines of the old version, with their newline.
+        commands (list): Commands from parse_ed_patch.
+        added (list): Receives the lines added by the patch.
+        removed (list): Receives the lines removed by the patch.
+
+    Yields:
+        bytes: Lines of the new version.
+
+    Raises:
+        PatchError: If the commands do not fit the lines.
+
+    """
+    lines = iter(lines)
+    line_number = 0
+    try:
+        for first, last, kind, text in commands:
+            # Lines before an append address are kept, changed lines are replaced
+            keep_until = first if kind == "a" else first - 1
+            if keep_until < line_number:
+                raise PatchError("ed script", f"overlapping command at line {first}")
+            while line_number < keep_until:
+                yield next(lines)
+                line_number += 1
+            if kind in "cd":
+                while line_number < last:
+                    removed.append(next(lines))
+                    line_number += 1
+            if kind in "ac":
+                added.extend(text)
+                yield from text
+    except StopIteration as e:
+        raise PatchError("ed script", f"file ends before line {line_number + 1}") from e
+    yield from lines
+
+
+def gzip_sha256(path):
+    """
+    Compute the SHA256 of the decompressed content of a gzipped file.
+
+    Args:
+        path (str): Path of the gzipped file.
+
+    Returns:
+        str: Hex digest of the decompressed content.
+
+    """
+    digest = hashlib.sha256()
+    with gzip.open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def patch_file(path, patches, expected_sha256):
+    """
+    Apply patches to a gzipped file in place.
+    The patched file is written to a temporary file and only replaces the
+    cached file if its content matches the current version of the index.
+
+    Args:
+        path (str): Path of the gzipped Contents file.
+        patches (list): Decompressed ed scripts in order.
+        expected_sha256 (str): SHA256 of the decompressed current version.
+
+    Returns:
+        tuple: Lines added and lines removed by all patches.
+
+    Raises:
+        PatchError: If a patch does not apply or the result does not match.
+
+    """
+    added = []
+    removed = []
+    tmp_path = temp_path(path)
+    digest = hashlib.sha256()
+    try:
+        with gzip.open(path, 'rb') as source, gzip.open(tmp_path, 'wb') as target:
+            lines = source
+            for patch in patches:
+                lines = apply_ed_patch(lines, parse_ed_patch(patch), added, removed)
+            batch = []
+            for line in lines:
+                batch.append(line)
+                if len(batch) == WRITE_LINES:
+                    data = b"".join(batch)
+                    digest.update(data)
+                    target.write(data)
+                    batch = []
+            data = b"".join(batch)
+            digest.update(data)
+            target.write(data)
+        if digest.hexdigest() != expected_sha256:
+            raise PatchError(os.path.basename(path), "patched file does not match the index")
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return added, removed
+
+
+def apply_count_deltas(counts, added, removed):
+    """
+    Update package counts with the lines added and removed by patches.
+    Every added line counts +1 and every removed line -1 for each of its packages.
+
+    Args:
+        counts (dict): Package counts of the old version.
+        added (list): Lines added by the patches.
+        removed (list): Lines removed by the patches.
+
+    Returns:
+        dict: Package counts of the new version.
+
+    Raises:
+        PatchError: If a count would become negative, the counts do not belong
+            to the patched version.
+
+    """
+    delta = Counter()
+    count_lines_bytes(b"".join(added), delta)
+    removed_counts = Counter()
+    count_lines_bytes(b"".join(removed), removed_counts)
+    delta.subtract(removed_counts)
+    updated = dict(counts)
+    for package, change in decode_counts(delta).items():
+        count = updated.get(package, 0) + change
+        if count < 0:
+            raise PatchError(package, "counts do not match the patched file")
+        if count:
+            updated[package] = count
+        else:
+            updated.pop(package, None)
+    return updated
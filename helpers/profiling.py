@@ -0,0 +1,300 @@
+############################################################
+"""
+Per-stage timing and throughput instrumentation of a run.
+Every stage of a file (discovery, download, parse, top-K) is recorded with
+its wall time, bytes in and out, lines, and the time it waited in the
+executor queue. Parse functions running in worker processes report their
+metrics through file_metrics, which is None unless the call is profiled,
+so a run without a profiler only pays for a few None checks.
+Functions:
+
+    file_metrics:
+        Return the metrics of the profiled call running in this thread.
+
+    run_profiled:
+        Run a function in a worker with its metrics and an optional capture.
+
+Classes:
+
+    Profiler:
+        Recorder of the stages of a run with a text and JSON report.
+"""
+############################################################
+
+from contextlib import contextmanager
+import cProfile
+import io
+import json
+import pstats
+import threading
+import time
+import tracemalloc
+from .download_cache import atomic_write_bytes
+
+CAPTURES = ("cprofile", "tracemalloc")
+TOP_FUNCTIONS = 20  # Functions of the cProfile capture shown in the report
+TOP_ALLOCATIONS = 10  # Lines of the tracemalloc capture kept per file
+
+_local = threading.local()
+
+
+def file_metrics():
+    """
+    Return the metrics of the profiled call running in this thread.
+
+    Returns:
+        dict: Metrics to update with "bytes_out" and "lines", None when not profiling.
+
+    """
+    return getattr(_local, "metrics", None)
+
+
+class _StatsHolder:
+    """
+    cProfile statistics sent back from a worker, loadable by pstats.Stats.
+    """
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        """
+        The statistics are already created, pstats.Stats calls this before reading them.
+        """
+
+
+def run_profiled(func, args, capture=None):
+    """
+    Run a function in a worker with its metrics and an optional capture.
+    Picklable, so it can be submitted to a process pool in place of func.
+
+    Args:
+        func (callable): Function to run, e.g. count_file.
+        args (tuple): Arguments of func.
+        capture (str): "cprofile" or "tracemalloc" to capture the call. DEFAULT: None
+
+    Returns:
+        tuple: Result of func and its metrics, with the wall clock start time
+            so the parent can compute the queue wait.
+
+    """
+    metrics = {"started": time.time(), "bytes_out": 0, "lines": 0}
+    _local.metrics = metrics
+    profile = cProfile.Profile() if capture == "cprofile" else None
+    tracing = capture == "tracemalloc" and not tracemalloc.is_tracing()
+    start = time.perf_counter()
+    try:
+        if tracing:
+            tracemalloc.start()
+        if profile:
+            profile.enable()
+        result = func(*args)
+    finally:
+        if profile:
+            profile.disable()
+        metrics["seconds"] = time.perf_counter() - start
+        if tracing:
+            metrics["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            metrics["allocations"] = [
+                str(stat) for stat in
+                tracemalloc.take_snapshot().statistics("lineno")[:TOP_ALLOCATIONS]]
+            tracemalloc.stop()
+        _local.metrics = None
+    if profile:
+        profile.create_stats()
+        metrics["cprofile"] = profile.stats
+    return result, metrics
+
+
+class _Disabled:
+    """
+    Profiler of runs without --profile, every stage is a no-op.
+    """
+    enabled = False
+    capture = None
+
+    @contextmanager
+    def stage(self, _name, _file=None, **_fields):
+        """
+        Run the stage without recording it.
+        """
+        yield {}
+
+    def add(self, _name, _file=None, **_fields):
+        """
+        Ignore a finished stage.
+        """
+
+
+DISABLED = _Disabled()
+
+
+class Profiler:
+    """
+    Recorder of the stages of a run with a text and JSON report.
+    Records are appended from the event loop and executor threads, list
+    appends are atomic so no lock is needed.
+
+    Args:
+        capture (str): "cprofile" or "tracemalloc" to also capture the parse
+            of every file. DEFAULT: None
+
+    """
+    enabled = True
+
+    def __init__(self, capture=None):
+        if capture not in (None, *CAPTURES):
+            raise ValueError(f"Unknown capture {capture}, expected one of {CAPTURES}")
+        self.capture = capture
+        self.records = []
+        self.cprofile = []
+        self.started = time.perf_counter()
+        self.wall_time = None
+
+    @contextmanager
+    def stage(self, name, file=None, **fields):
+        """
+        Time a stage, the caller may add bytes_in, bytes_out and lines to the yielded record.
+
+        Args:
+            name (str): Stage name, e.g. download.
+            file (str): File the stage works on. DEFAULT: the whole run
+            **fields: Initial fields of the record.
+
+        Yields:
+            dict: Record of the stage.
+
+        """
+        record = {"stage": name, "file": file, **fields}
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception as e:
+            record["error"] = str(e)
+            raise
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            self.records.append(record)
+
+    def add(self, name, file=None, **fields):
+        """
+        Record a stage timed elsewhere, e.g. in a worker process.
+
+        Args:
+            name (str): Stage name.
+            file (str): File the stage worked on.
+            **fields: seconds and any of bytes_in, bytes_out, lines, queue_wait.
+
+        """
+        if "cprofile" in fields:
+            self.cprofile.append(_StatsHolder(fields.pop("cprofile")))
+        self.records.append({"stage": name, "file": file, **fields})
+
+    def finish(self):
+        """
+        Stop the wall clock of the run.
+        """
+        self.wall_time = time.perf_counter() - self.started
+
+    def summary(self):
+        """
+        Sum the records of every stage.
+
+        Returns:
+            dict: Stage name to calls, seconds, queue_wait, bytes_in, bytes_out,
+                lines, and mb_per_s and lines_per_s when known.
+
+        """
+        stages = {}
+        for record in self.records:
+            total = stages.setdefault(record["stage"], {
+                "calls": 0, "seconds": 0.0, "queue_wait": 0.0,
+                "bytes_in": 0, "bytes_out": 0, "lines": 0})
+            total["calls"] += 1
+            for key in ("seconds", "queue_wait", "bytes_in", "bytes_out", "lines"):
+                total[key] += record.get(key) or 0
+        for total in stages.values():
+            _add_rates(total)
+        return stages
+
+    def to_dict(self):
+        """
+        Return the report as a JSON serializable dict.
+        """
+        return {
+            "wall_time": self.wall_time,
+            "stages": self.summary(),
+            "files": [_add_rates(dict(record)) for record in self.records],
+        }
+
+    def write_json(self, path):
+        """
+        Write the report to a JSON file.
+
+        Args:
+            path (str): Path of the JSON file.
+
+        """
+        atomic_write_bytes(path, json.dumps(self.to_dict(), indent=2).encode())
+
+    def report(self):
+        """
+        Format the per-stage and per-file report.
+
+        Returns:
+            str: Report tables, followed by the capture if any.
+
+        """
+        columns = (f"{'Time (s)':>9} {'Queue (s)':>9} {'In (MB)':>8} {'Out (MB)':>8} "
+                   f"{'MB/s':>8} {'Lines/s':>10}")
+        output = [f"{'Stage':12} {'Calls':>5} {columns}"]
+        for name, total in self.summary().items():
+            output.append(f"{name:12} {total['calls']:5} " + _format_row(total))
+        if self.wall_time is not None:
+            output.append(f"Wall time: {self.wall_time:.3f} s")
+        output.append("")
+        output.append(f"{'File':32} {'Stage':12} {columns}")
+        for record in self.records:
+            if record["file"] is None:
+                continue
+            name = str(record["file"]).rstrip("/").rsplit("/", 1)[-1]
+            output.append(f"{name[-32:]:32} {record['stage']:12} " + _format_row(
+                _add_rates(dict(record))))
+            if "peak_bytes" in record:
+                output.append(f"{'':32} peak traced memory "
+                              f"{record['peak_bytes'] / (1 << 20):.1f} MB")
+                output.extend(f"{'':34}{line}" for line in record.get("allocations", []))
+        if self.cprofile:
+            stream = io.StringIO()
+            stats = pstats.Stats(*self.cprofile, stream=stream)
+            stats.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+            output.append(stream.getvalue())
+        return "\n".join(output)
+
+
+def _add_rates(total):
+    """
+    Add throughput to a record or stage total with a known time.
+    """
+    seconds = total.get("seconds") or 0
+    size = total.get("bytes_out") or total.get("bytes_in")
+    if seconds and size:
+        total["mb_per_s"] = size / (1 << 20) / seconds
+    if seconds and total.get("lines"):
+        total["lines_per_s"] = total["lines"] / seconds
+    return total
+
+
+def _format_row(total):
+    """
+    Format the time, size and rate columns of a record or stage total.
+    """
+    def megabytes(key):
+        return f"{total[key] / (1 << 20):8.1f}" if total.get(key) else f"{'-':>8}"
+
+    def rate(key, width, digits):
+        return f"{total[key]:{width}.{digits}f}" if key in total else f"{'-':>{width}}"
+
+    queue_wait = total.get("queue_wait")
+    queue = f"{queue_wait:9.3f}" if queue_wait else f"{'-':>9}"
+    return (f"{total.get('seconds', 0):9.3f} {queue} {megabytes('bytes_in')} "
+            f"{megabytes('bytes_out')} {rate('mb_per_s', 8, 1)} {rate('lines_per_s', 10, 0)}")
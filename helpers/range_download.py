@@ -0,0 +1,191 @@
+############################################################
+"""
+Segmented download of a large file with parallel Range requests.
+The file is preallocated and every segment is written at its offset with
+os.pwrite, so segments can arrive in any order. Finished segments are
+recorded in a sidecar state file, a failed segment is retried alone and
+an interrupted download resumes from the state file.
+Functions:
+
+    segment_paths:
+        Return the paths of the partial file and the state file of a download.
+
+Classes:
+
+    RangeDownload:
+        Download of one file in segments into a preallocated file.
+"""
+############################################################
+
+import asyncio
+import json
+import os
+from .download_cache import atomic_write_bytes, file_sha256
+from .exceptions import DownloadError
+
+RANGE_THRESHOLD = 32 << 20  # Files from this size are downloaded in segments
+SEGMENT_SIZE = 8 << 20
+PARALLEL_SEGMENTS = 4  # Segments of one file downloaded at a time
+CHUNK_SIZE = 1 << 16
+
+
+def segment_paths(path):
+    """
+    Return the paths of the partial file and the state file of a download.
+    Unlike temporary download files, they have fixed names so a later run finds them.
+
+    Args:
+        path (str): Final path of the file.
+
+    Returns:
+        tuple: Path of the partial file and of its state file.
+
+    """
+    directory, name = os.path.split(path)
+    part_path = os.path.join(directory, f".{name}.ranges")
+    return part_path, part_path + ".json"
+
+
+class RangeDownload:
+    """
+    Download of one file in segments into a preallocated file.
+    Every range request carries If-Range, so a file changing on the mirror
+    during the download is detected instead of mixing two versions.
+
+    Args:
+        path (str): Final path of the file.
+        url (str): URL of the file.
+        size (int): Size of the file in bytes.
+        validator (str): ETag or Last-Modified of the file.
+        segment_size (int): Bytes per range request. DEFAULT: SEGMENT_SIZE
+
+    """
+    def __init__(self, path, url, size, validator, segment_size=None):
+        segment_size = segment_size or SEGMENT_SIZE
+        self.path = path
+        self.url = url
+        self.size = size
+        self.validator = validator
+        self.segment_size = segment_size
+        self.part_path, self.state_path = segment_paths(path)
+        self.segments = [(start, min(start + segment_size, size) - 1)
+                         for start in range(0, size, segment_size)]
+        self.done = set()
+        self.changed = False
+        self.sha256 = None
+
+    def _state(self):
+        return {
+            "url": self.url,
+            "size": self.size,
+            "validator": self.validator,
+            "segment_size": self.segment_size,
+        }
+
+    def load_state(self):
+        """
+        Resume the finished segments of a previous download of the same file version.
+
+        Returns:
+            int: Number of segments already downloaded.
+
+        """
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        if (all(state.get(key) == value for key, value in self._state().items()) and
+                os.path.exists(self.part_path) and os.path.getsize(self.part_path) == self.size):
+            self.done = set(state.get("done", []))
+        return len(self.done)
+
+    def _save_state(self):
+        atomic_write_bytes(self.state_path, json.dumps(
+            {**self._state(), "done": sorted(self.done)}).encode())
+
+    async def run(self, client, parallel=None):
+        """
+        Download the missing segments and hash the complete file.
+
+        Args:
+            client (DownloadClient): Shared client of the run.
+            parallel (int): Number of segments downloaded at a time. DEFAULT: PARALLEL_SEGMENTS
+
+        Raises:
+            DownloadError: If a segment still fails after its retries, or the
+                file changed on the mirror.
+
+        """
+        fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, self.size)
+            if hasattr(os, "posix_fallocate"):
+                try:
+                    # Reserve the blocks so segments written out of order do not fragment
+                    os.posix_fallocate(fd, 0, self.size)
+                except OSError:
+                    pass
+            semaphore = asyncio.Semaphore(parallel or PARALLEL_SEGMENTS)
+            tasks = [asyncio.ensure_future(self._download_segment(client, fd, index, semaphore))
+                     for index in range(len(self.segments)) if index not in self.done]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                # Stop the other segments before their file descriptor is closed
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+        finally:
+            os.close(fd)
+        loop = asyncio.get_running_loop()
+        self.sha256 = await loop.run_in_executor(None, file_sha256, self.part_path)
+
+    async def _download_segment(self, client, fd, index, semaphore):
+        """
+        Download one segment, retrying it alone on failures.
+        """
+        import aiohttp  # pylint: disable=import-outside-toplevel
+        start, end = self.segments[index]
+        headers = {"Range": f"bytes={start}-{end}", "If-Range": self.validator}
+        async with semaphore:
+            for attempt in range(client.retries + 1):
+                offset = start
+                try:
+                    async with client.request(self.url, headers=headers) as response:
+                        if response.status == 200:
+                            # If-Range did not match, the file changed on the mirror
+                            self.changed = True
+                            raise DownloadError(self.url, "file changed during download")
+                        if response.status != 206:
+                            raise DownloadError(self.url, response.status)
+                        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                            os.pwrite(fd, chunk, offset)
+                            offset += len(chunk)
+                    if offset != end + 1:
+                        raise aiohttp.ClientPayloadError(
+                            f"segment {index} ended at byte {offset} of {end + 1}")
+                    break
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt == client.retries:
+                        raise DownloadError(self.url, e) from e
+                    await asyncio.sleep(client.backoff * 2 ** attempt)
+        self.done.add(index)
+        self._save_state()
+
+    def commit(self):
+        """
+        Move the complete file into place and remove the state file.
+        """
+        os.replace(self.part_path, self.path)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+    def discard(self):
+        """
+        Remove the partial file and the state file.
+        """
+        for path in (self.part_path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,211 @@
+###########################################################
+"""
+Discovery of Contents files from the Release index of a suite.
+The Release file lists every index of the suite with its size and
+checksums, so no directory listing has to be scraped.
+Functions:
+
+    split_mirror_url:
+        Split a component mirror URL into the suite URL and component.
+
+    strip_signature:
+        Return the signed message of a clearsigned InRelease file.
+
+    parse_release:
+        Parse the fields and SHA256 checksums of a Release file.
+
+    get_release:
+        Download and parse the Release file of a suite.
+
+    list_contents_files:
+        List the Contents files of a component from a parsed Release file.
+
+    contents_files_from_release:
+        Organize the Contents files of a Release file by architecture.
+
+    file_checksums:
+        Map file links to their expected size and SHA256.
+"""
+###########################################################
+
+from collections import defaultdict
+import os
+from .exceptions import DownloadError
+
+RELEASE_FILES = ("InRelease", "Release")
+# Compressions of Contents files the parser can read, in order of preference
+CONTENTS_EXTENSIONS = (".gz", ".xz")
+
+
+def split_mirror_url(url):
+    """
+    Split a component mirror URL into the suite URL and component.
+
+    Args:
+        url (str): Mirror URL, e.g. http://deb.debian.org/debian/dists/stable/main/
+
+    Returns:
+        tuple: Suite URL ending with "/" and component name.
+
+    """
+    suite_url, component = os.path.split(url.rstrip("/"))
+    return suite_url + "/", component
+
+
+def strip_signature(text):
+    """
+    Return the signed message of a clearsigned InRelease file.
+    The signature is not verified.
+
+    Args:
+        text (str): Content of an InRelease or Release file.
+
+    Returns:
+        str: Content without the PGP armor.
+
+    """
+    if not text.startswith("-----BEGIN PGP SIGNED MESSAGE-----"):
+        return text
+    # Armor headers end at the first empty line
+    message = text.split("\n\n", 1)[1]
+    return message.split("\n-----BEGIN PGP SIGNATURE-----", 1)[0]
+
+
+def parse_release(text):
+    """
+    Parse the fields and SHA256 checksums of a Release file.
+
+    Args:
+        text (str): Content of an InRelease or Release file.
+
+    Returns:
+        dict: Single line fields by name, and "SHA256" as a dict of
+            path to {"size", "sha256"}.
+
+    """
+    release = {"SHA256": {}}
+    field = None
+    for line in strip_signature(text).splitlines():
+        if not line.strip():
+            continue
+        if line[0].isspace():
+            # Continuation line of a multi line field
+            if field == "SHA256":
+                sha256, size, path = line.split()
+                release["SHA256"][path] = {"size": int(size), "sha256": sha256}
+            continue
+        field, _sep, value = line.partition(":")
+        if field != "SHA256":
+            release[field] = value.strip()
+    return release
+
+
+def get_release(suite_url):
+    """
+    Download and parse the Release file of a suite.
+
+    Args:
+        suite_url (str): URL of the suite, e.g. http://deb.debian.org/debian/dists/stable/
+
+    Returns:
+        dict: Parsed Release file.
+
+    Raises:
+        DownloadError: If neither InRelease nor Release can be downloaded.
+
+    """
+    # Imported on first use, runs answered from the count index never load it
+    import requests  # pylint: disable=import-outside-toplevel
+    error = None
+    for name in RELEASE_FILES:
+        url = suite_url + name
+        try:
+            response = requests.get(url, timeout=10)
+            response.raise_for_status()
+            return parse_release(response.text)
+        except requests.exceptions.RequestException as e:
+            error = DownloadError(url, e)
+    raise error
+
+
+def list_contents_files(release, component):
+    """
+    List the Contents files of a component from a parsed Release file.
+
+    Args:
+        release (dict): Parsed Release file.
+        component (str): Component name, e.g. main.
+
+    Returns:
+        list: Dictionaries with path, name, arch, udeb, ext, size and sha256.
+
+    """
+    contents = []
+    for path, checksum in release["SHA256"].items():
+        directory, name = os.path.split(path)
+        if directory != component or not name.startswith("Contents-"):
+            continue
+        stem, ext = os.path.splitext(name)
+        parts = stem.split("-")
+        contents.append({
+            "path": path,
+            "name": name,
+            "arch": parts[-1],
+            "udeb": "udeb" in parts,
+            "ext": ext,
+            **checksum,
+        })
+    return contents
+
+
+def contents_files_from_release(suite_url, release, component):
+    """
+    Organize the Contents files of a Release file by architecture.
+    Only one compression of each file is kept, following CONTENTS_EXTENSIONS.
+
+    Args:
+        suite_url (str): URL of the suite the Release file belongs to.
+        release (dict): Parsed Release file.
+        component (str): Component name, e.g. main.
+
+    Returns:
+        dict: Files by architecture, in the format of process_contents_file_list
+            with the size and sha256 of each file.
+
+    """
+    chosen = {}
+    for file in list_contents_files(release, component):
+        if file["ext"] not in CONTENTS_EXTENSIONS:
+            continue
+        stem = file["path"][:-len(file["ext"])]
+        current = chosen.get(stem)
+        rank = CONTENTS_EXTENSIONS.index(file["ext"])
+        if current is None or rank < CONTENTS_EXTENSIONS.index(current["ext"]):
+            chosen[stem] = file
+    files = defaultdict(list)
+    for file in sorted(chosen.values(), key=lambda f: f["name"]):
+        files[file["arch"]].append({
+            "name": file["name"],
+            "link": suite_url + file["path"],
+            "udeb": file["udeb"],
+            "size": file["size"],
+            "sha256": file["sha256"],
+        })
+    return files
+
+
+def file_checksums(files):
+    """
+    Map file links to their expected size and SHA256.
+
+    Args:
+        files (dict): Files by architecture from contents_files_from_release.
+
+    Returns:
+        dict: Link to {"size", "sha256"} for files with known checksums.
+
+    """
+    return {
+        file["link"]: {"size": file["size"], "sha256": file["sha256"]}
+        for arch_files in files.values() for file in arch_files if file.get("sha256")
+    }
@@ -0,0 +1,490 @@
+############################################################
+"""
+Long running query service keeping package statistics in memory.
+The counts of every suite and architecture are computed once with a
+PackageStatsEngine and kept resident with their packages already ranked,
+so a top-K or package count query is a slice or a dict lookup. A
+background task polls the Release file of every suite and recounts a
+suite when it changes, replacing its snapshots only once they are complete.
+Queries are answered as JSON over HTTP on a TCP port or a Unix socket.
+Functions:
+
+    create_app:
+        Create the aiohttp application answering queries from a service.
+
+    run_server:
+        Serve a service over HTTP until cancelled.
+
+    server_cli:
+        Command-line interface of the serve subcommand.
+
+Classes:
+
+    Snapshot:
+        Ranked counts of one suite and architecture.
+
+    StatsService:
+        Resident statistics of several suites and architectures of an archive.
+"""
+############################################################
+
+import argparse
+import asyncio
+from contextlib import AsyncExitStack
+import hashlib
+import os
+import sys
+import time
+import aiohttp
+from aiohttp import web
+from .exceptions import DownloadError
+from .common_utils import top_packages
+from .engine import PackageStatsEngine
+from .path_index import PathIndex, find_path_indexes
+from .release import RELEASE_FILES
+from .cli_options import run_options
+from .lookup import search_path_index
+from .package_stats_helper_async import ARCHIVE
+
+HOST = "127.0.0.1"
+PORT = 8080
+REFRESH_INTERVAL = 600  # Seconds between two checks of the Release files
+LOOKUP_MODES = ("exact", "prefix", "glob")
+
+
+class Snapshot:
+    """
+    Ranked counts of one suite and architecture.
+
+    Args:
+        suite (str): Suite name.
+        result (StatsResult): Result of the engine run.
+        release (str): SHA256 of the Release file the counts were made from,
+            None if the mirror has no Release file.
+
+    """
+    def __init__(self, suite, result, release):
+        self.suite = suite
+        self.architecture = result.architecture
+        self.counts = result.counts
+        # Ranked once per refresh, a top-K query is then a slice
+        self.ranking = top_packages(result.counts, True, len(result.counts))
+        self.files = [stats.name for stats in result.files]
+        self.release = release
+        self.refreshed = time.time()
+        self.path_indexes = []
+
+    def close(self):
+        """
+        Close the path indexes of the snapshot.
+        """
+        for index in self.path_indexes:
+            index.close()
+        self.path_indexes = []
+
+    def info(self):
+        """
+        Return the description of the snapshot as a JSON serializable dict.
+        """
+        return {
+            "suite": self.suite,
+            "architecture": self.architecture,
+            "release": self.release,
+            "refreshed": self.refreshed,
+            "files": self.files,
+            "packages": len(self.ranking),
+        }
+
+
+class StatsService:
+    """
+    Resident statistics of several suites and architectures of an archive.
+    Use as an async context manager, every suite is counted before it
+    returns and refreshed in the background afterwards.
+
+    Args:
+        archive (str): Archive URL holding the dists directory.
+        suites (list): Suite names.
+        archs (list): Architectures, "any" for the union of every architecture.
+        output_dir (str): Download location, one directory per suite and component.
+        component (str): Component of the suites. DEFAULT: main
+        include_udeb (bool): Include udeb files in the counts.
+        refresh_interval (float): Seconds between two checks of the Release files,
+            None to never refresh.
+        build_path_index (bool): Also keep the path indexes open for lookup queries.
+        **engine_options: Keyword arguments of PackageStatsEngine, e.g. workers.
+
+    """
+    def __init__(self, archive, suites, archs, output_dir, component="main",
+                 include_udeb=False, refresh_interval=REFRESH_INTERVAL,
+                 build_path_index=False, **engine_options):
+        self.archive = archive if archive.endswith("/") else archive + "/"
+        self.suites = list(suites)
+        self.archs = list(archs)
+        self.component = component
+        self.include_udeb = include_udeb
+        self.refresh_interval = refresh_interval
+        self.build_path_index = build_path_index
+        self.engines = {
+            suite: PackageStatsEngine(
+                self.suite_url(suite) + component + "/",
+                os.path.join(output_dir, suite, component),
+                build_path_index=build_path_index, **engine_options)
+            for suite in self.suites}
+        self.snapshots = {}
+        self.releases = {}
+        self._locks = {suite: asyncio.Lock() for suite in self.suites}
+        self._exit_stack = AsyncExitStack()
+        self._refresher = None
+
+    def suite_url(self, suite):
+        """
+        Return the URL of a suite, ending with "/".
+        """
+        return f"{self.archive}dists/{suite}/"
+
+    async def __aenter__(self):
+        try:
+            for engine in self.engines.values():
+                await self._exit_stack.enter_async_context(engine)
+            await asyncio.gather(*(self.refresh(suite, force=True) for suite in self.suites))
+        except BaseException:
+            await self.close()
+            raise
+        if self.refresh_interval:
+            self._refresher = asyncio.create_task(self._refresh_periodically())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """
+        Stop the background refresh, close the path indexes and the engines.
+        """
+        try:
+            if self._refresher is not None:
+                self._refresher.cancel()
+                try:
+                    await self._refresher
+                except asyncio.CancelledError:
+                    pass
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    # A refresher that died must not keep the engines open
+                    print(f"Background refresh had failed: {e}", file=sys.stderr)
+                self._refresher = None
+        finally:
+            for snapshot in self.snapshots.values():
+                snapshot.close()
+            await self._exit_stack.aclose()
+
+    async def release_sha256(self, suite):
+        """
+        Fetch the Release index of a suite, InRelease first as discovery does.
+
+        Args:
+            suite (str): Suite name.
+
+        Returns:
+            str: SHA256 of the Release index, None if the mirror has none.
+
+        """
+        for name in RELEASE_FILES:
+            try:
+                async with self.engines[suite].client.request(
+                        self.suite_url(suite) + name) as response:
+                    if response.status == 200:
+                        return hashlib.sha256(await response.read()).hexdigest()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+        return None
+
+    async def refresh(self, suite, force=False):
+        """
+        Recount a suite if its Release file changed.
+        Suites without a Release file are recounted on every refresh. The
+        snapshots of the suite are replaced together once every architecture
+        is counted, queries meanwhile are answered from the previous ones.
+
+        Args:
+            suite (str): Suite name.
+            force (bool): Recount even if the Release file did not change.
+
+        Returns:
+            bool: True if the suite was recounted.
+
+        Raises:
+            DownloadError: If a Contents file could not be counted, the previous
+                snapshots and Release are kept.
+
+        """
+        async with self._locks[suite]:
+            release = await self.release_sha256(suite)
+            if not force and release is not None and release == self.releases.get(suite):
+                return False
+            engine = self.engines[suite]
+            await engine.discover(refresh=True)
+            results = await engine.stats_many(
+                self.archs, include_udeb=self.include_udeb, limit=0)
+            failed = [stats.name for result in results.values() for stats in result.files
+                      if stats.error]
+            if failed:
+                # Undercounted snapshots would be served until the Release changes
+                raise DownloadError(", ".join(failed), "not counted, previous counts kept")
+            loop = asyncio.get_running_loop()
+            snapshots = {}
+            for arch, result in results.items():
+                # Ranking every package is slow, queries are answered meanwhile
+                snapshot = snapshots[suite, arch] = await loop.run_in_executor(
+                    None, Snapshot, suite, result, release)
+                if self.build_path_index:
+                    snapshot.path_indexes = [
+                        PathIndex(path) for path in find_path_indexes(engine.output_dir, arch)]
+            previous = [self.snapshots[key] for key in snapshots if key in self.snapshots]
+            self.snapshots.update(snapshots)
+            self.releases[suite] = release
+            # Queries run on the event loop, none is using the replaced indexes
+            for snapshot in previous:
+                snapshot.close()
+            return True
+
+    async def _refresh_periodically(self):
+        """
+        Refresh every suite every refresh_interval seconds.
+        """
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            for suite in self.suites:
+                try:
+                    if await self.refresh(suite):
+                        print(f"Refreshed {suite}, Release {self.releases[suite]}")
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    # Any failure of one suite, e.g. a corrupt file, must not stop the refresher
+                    print(f"Refresh of {suite} failed, keeping the previous counts: {e}",
+                          file=sys.stderr)
+
+    def snapshot(self, suite, arch):
+        """
+        Return the snapshot of a suite and architecture.
+
+        Raises:
+            KeyError: If the suite or architecture is not served.
+
+        """
+        return self.snapshots[suite, arch]
+
+    def top(self, suite, arch, limit=10):
+        """
+        Return the top packages of a suite and architecture.
+
+        Args:
+            suite (str): Suite name.
+            arch (str): Architecture.
+            limit (int): Number of packages.
+
+        Returns:
+            list: (package, count) tuples in rank order.
+
+        """
+        return self.snapshot(suite, arch).ranking[:max(limit, 0)]
+
+    def count(self, suite, arch, package):
+        """
+        Return the file count of a package, 0 if it ships no file.
+        """
+        counts = self.snapshot(suite, arch).counts
+        return counts[package] if package in counts else 0
+
+    def lookup(self, suite, query, mode="exact", arch=None, limit=None):
+        """
+        Find the packages shipping paths in the resident path indexes of a suite.
+
+        Args:
+            suite (str): Suite name.
+            query (str): Path, path prefix or glob pattern.
+            mode (str): "exact", "prefix" or "glob".
+            arch (str): Only search this architecture. DEFAULT: every served architecture
+            limit (int): Maximum number of results per Contents file. DEFAULT: no limit
+
+        Returns:
+            list: (Contents file name, path, comma separated packages) tuples.
+
+        """
+        results = []
+        for arch_name in [arch] if arch else self.archs:
+            for index in self.snapshot(suite, arch_name).path_indexes:
+                contents_name = os.path.basename(index.path)[:-len(".paths")]
+                results.extend((contents_name, file, packages) for file, packages
+                               in search_path_index(index, query, mode, limit))
+        return results
+
+
+def create_app(service):
+    """
+    Create the aiohttp application answering queries from a service.
+
+    Routes:
+        GET /health: Snapshots served and the Release file of every suite.
+        GET /top/{suite}/{arch}?limit=N: Top N packages.
+        GET /count/{suite}/{arch}/{package}: File count of a package.
+        GET /lookup/{suite}?path=P&mode=M&arch=A&limit=N: Packages shipping paths.
+        POST /refresh/{suite}: Recount the suite now if its Release file changed.
+
+    Args:
+        service (StatsService): Open service.
+
+    Returns:
+        web.Application: The application.
+
+    """
+    def not_found(request):
+        return web.json_response(
+            {"error": f"{request.match_info.get('suite')}/"
+                      f"{request.match_info.get('arch', '')} is not served"}, status=404)
+
+    def int_query(request, name, default):
+        try:
+            return int(request.query.get(name, default))
+        except (TypeError, ValueError) as e:
+            raise web.HTTPBadRequest(text=f"{name} must be an integer") from e
+
+    async def health(_request):
+        return web.json_response({
+            "releases": service.releases,
+            "snapshots": [snapshot.info() for snapshot in service.snapshots.values()],
+        })
+
+    async def top(request):
+        suite, arch = request.match_info["suite"], request.match_info["arch"]
+        try:
+            snapshot = service.snapshot(suite, arch)
+        except KeyError:
+            return not_found(request)
+        return web.json_response({
+            "suite": suite, "architecture": arch, "release": snapshot.release,
+            "top": service.top(suite, arch, int_query(request, "limit", 10)),
+        })
+
+    async def count(request):
+        suite, arch = request.match_info["suite"], request.match_info["arch"]
+        package = request.match_info["package"]
+        try:
+            return web.json_response({"package": package,
+                                      "count": service.count(suite, arch, package)})
+        except KeyError:
+            return not_found(request)
+
+    async def lookup(request):
+        if "path" not in request.query:
+            raise web.HTTPBadRequest(text="path is required")
+        mode = request.query.get("mode", "exact")
+        if mode not in LOOKUP_MODES:
+            raise web.HTTPBadRequest(text=f"mode must be one of {LOOKUP_MODES}")
+        limit = int_query(request, "limit", 0) or None
+        try:
+            results = service.lookup(request.match_info["suite"], request.query["path"],
+                                     mode, request.query.get("arch"), limit)
+        except KeyError:
+            return not_found(request)
+        return web.json_response({"results": results})
+
+    async def refresh(request):
+        suite = request.match_info["suite"]
+        if suite not in service.engines:
+            return not_found(request)
+        try:
+            changed = await service.refresh(suite)
+        except DownloadError as e:
+            return web.json_response({"error": str(e)}, status=502)
+        return web.json_response({"refreshed": changed, "release": service.releases[suite]})
+
+    app = web.Application()
+    app.router.add_get("/health", health)
+    app.router.add_get("/top/{suite}/{arch}", top)
+    app.router.add_get("/count/{suite}/{arch}/{package:.+}", count)
+    app.router.add_get("/lookup/{suite}", lookup)
+    app.router.add_post("/refresh/{suite}", refresh)
+    return app
+
+
+async def run_server(service, host=HOST, port=PORT, unix_socket=None):
+    """
+    Serve a service over HTTP until cancelled.
+
+    Args:
+        service (StatsService): Service, opened and closed by the server.
+        host (str): Address to listen on. DEFAULT: 127.0.0.1
+        port (int): TCP port to listen on. DEFAULT: 8080
+        unix_socket (str): Listen on this Unix socket instead of TCP.
+
+    """
+    async with service:
+        runner = web.AppRunner(create_app(service))
+        await runner.setup()
+        try:
+            if unix_socket:
+                site = web.UnixSite(runner, unix_socket)
+            else:
+                site = web.TCPSite(runner, host, port)
+            await site.start()
+            print(f"Serving {', '.join(service.suites)} "
+                  f"({', '.join(service.archs)}) on {site.name}")
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+
+def server_cli(argv):
+    """
+    Command-line interface of the serve subcommand.
+
+    Args:
+        argv (list): Arguments after the subcommand name.
+
+    """
+    argparser = argparse.ArgumentParser(
+        prog="package_statistics.py serve",
+        description=("Keep the package statistics of suites and architectures in memory "
+                     "and answer queries over HTTP, refreshing them when the Release "
+                     "file of a suite changes."),
+        parents=[run_options(per_suite=True, skip_download=False, use_index=False)]
+    )
+    argparser.add_argument(
+        "-a", "--architectures", nargs="+", required=True,
+        help="Architectures to serve, 'any' for every architecture.")
+    argparser.add_argument(
+        "--suites", nargs="+", default=["stable"],
+        help="Suites to serve. DEFAULT: stable")
+    argparser.add_argument(
+        "--component", type=str, default="main",
+        help="Component of the suites. DEFAULT: main")
+    argparser.add_argument(
+        "-m", "--archive", type=str, default=ARCHIVE,
+        help=f"Archive URL holding the dists directory. DEFAULT: {ARCHIVE}")
+    argparser.add_argument(
+        "-u", "--udeb", action="store_true",
+        help="Include udeb files. DEFAULT: False")
+    argparser.add_argument(
+        "--build-path-index", action="store_true",
+        help="Build and keep the path indexes open to answer lookup queries.")
+    argparser.add_argument(
+        "--refresh-interval", type=float, default=REFRESH_INTERVAL,
+        help=("Seconds between two checks of the Release files, 0 never refreshes. "
+              f"DEFAULT: {REFRESH_INTERVAL}"))
+    argparser.add_argument(
+        "--host", type=str, default=HOST, help=f"Address to listen on. DEFAULT: {HOST}")
+    argparser.add_argument(
+        "--port", type=int, default=PORT, help=f"TCP port to listen on. DEFAULT: {PORT}")
+    argparser.add_argument(
+        "--unix-socket", type=str, default=None,
+        help="Listen on this Unix socket instead of a TCP port.")
+    args = argparser.parse_args(argv)
+    service = StatsService(
+        args.archive, args.suites, args.architectures, args.output_dir,
+        component=args.component, include_udeb=args.udeb,
+        refresh_interval=args.refresh_interval, build_path_index=args.build_path_index,
+        workers=args.workers, discovery=args.discovery)
+    try:
+        asyncio.run(run_server(service, args.host, args.port, args.unix_socket))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,519 @@
+############################################################
+"""
+Partial count shards exchanged between the map and reduce subcommands.
+A shard holds the package counts of a subset of Contents files: a JSON
+header describing the files, the package names in sorted order, prefix
+compressed, each followed by its varint count, and a trailer with the
+number of packages, the total count and the SHA256 of the file. Sorted
+names let any number of shards be merged in one streaming pass.
+Functions:
+
+    assign_files:
+        Split Contents files between map nodes by compressed size.
+
+    write_shard:
+        Write package counts to a shard file.
+
+    merge_shards:
+        Merge shards into global package counts in name order.
+
+    reduce_shards:
+        Merge shards into global top packages, optionally writing the merged shard.
+
+    map_shard:
+        Count this node's share of the Contents files of an architecture into a shard.
+
+    map_cli:
+        Command-line interface of the map subcommand.
+
+    reduce_cli:
+        Command-line interface of the reduce subcommand.
+
+Classes:
+
+    ShardWriter:
+        Stream package counts in name order into a shard file.
+
+    ShardReader:
+        Stream the package counts of a shard file, verifying its checksum.
+"""
+############################################################
+
+import argparse
+import asyncio
+import hashlib
+import heapq
+from itertools import groupby
+import json
+from operator import itemgetter
+import os
+import struct
+from .exceptions import DownloadError, ShardError
+from .common_utils import format_stats
+from .download_cache import temp_path, atomic_write_bytes
+from .path_index import encode_varint, decode_varint
+from .release import file_checksums
+from .cli_options import run_options
+from .engine import PackageStatsEngine, architecture_urls
+from .defaults import ALL_ARCHITECTURES
+from .package_stats_helper_async import MIRROR
+
+SHARD_SUFFIX = ".shard"
+MAGIC = b"PKGSHARD"
+VERSION = 1
+HEADER = struct.Struct("<8sHI")  # magic, version, length of the JSON metadata
+TRAILER = struct.Struct("<QQ")  # packages and total count, then the SHA256 of all preceding bytes
+DIGEST_SIZE = 32
+END = encode_varint(0) + encode_varint(0)  # No package has an empty name
+READ_SIZE = 1 << 20
+READ_AHEAD = 1 << 16  # Bytes kept decoded ahead, longer than any record
+WRITE_BATCH = 4096  # Records encoded before a write
+
+
+def assign_files(urls, checksums, nodes):
+    """
+    Split Contents files between map nodes by compressed size.
+    Files are given largest first to the least loaded node, so every node
+    computes the same split from the same Release file, whatever mirror it uses.
+
+    Args:
+        urls (list): File URLs.
+        checksums (dict): URL to size and sha256 from the Release file.
+        nodes (int): Number of nodes.
+
+    Returns:
+        list: URLs of every node.
+
+    """
+    def size(url):
+        return checksums.get(url, {}).get("size", 0)
+
+    shares = [[] for _ in range(nodes)]
+    loads = [0] * nodes
+    for url in sorted(urls, key=lambda url: (-size(url), os.path.basename(url))):
+        node = min(range(nodes), key=lambda index: (loads[index], index))
+        shares[node].append(url)
+        # Files of unknown size are spread by number instead
+        loads[node] += size(url) or 1
+    return shares
+
+
+class ShardWriter:
+    """
+    Stream package counts in name order into a shard file.
+    The file is written to a temporary path and renamed on close, so
+    readers on a shared filesystem never see a partial shard.
+
+    Args:
+        path (str): Path of the shard.
+        metadata (dict): JSON serializable description of the counted files.
+
+    """
+    def __init__(self, path, metadata):
+        self.path = path
+        self.packages = 0
+        self.total = 0
+        self._last = b""
+        self._pending = []
+        self._digest = hashlib.sha256()
+        self._tmp_path = temp_path(path)
+        self._file = open(self._tmp_path, 'wb')  # pylint: disable=consider-using-with
+        header = json.dumps(metadata, sort_keys=True).encode()
+        self._write(HEADER.pack(MAGIC, VERSION, len(header)) + header)
+
+    def _write(self, data):
+        self._digest.update(data)
+        self._file.write(data)
+
+    def add(self, package, count):
+        """
+        Add the count of a package, names must be added in increasing order.
+
+        Args:
+            package (str): Package name.
+            count (int): File count.
+
+        Raises:
+            ValueError: If the name is not greater than the previous one.
+
+        """
+        name = package.encode()
+        if name <= self._last and self.packages:
+            raise ValueError(f"{package} added after {self._last.decode()}")
+        shared = len(os.path.commonprefix((self._last, name)))
+        self._pending.append(b"".join((encode_varint(shared), encode_varint(len(name) - shared),
+                                       name[shared:], encode_varint(count))))
+        self._last = name
+        self.packages += 1
+        self.total += count
+        if len(self._pending) >= WRITE_BATCH:
+            self._write(b"".join(self._pending))
+            self._pending = []
+
+    def close(self):
+        """
+        Write the trailer and rename the shard into place.
+        """
+        try:
+            self._write(b"".join(self._pending) + END)
+            self._pending = []
+            self._write(TRAILER.pack(self.packages, self.total))
+            self._file.write(self._digest.digest())
+            self._file.close()
+            os.replace(self._tmp_path, self.path)
+        finally:
+            self.abort()
+
+    def abort(self):
+        """
+        Discard the shard being written.
+        """
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_shard(path, counts, metadata):
+    """
+    Write package counts to a shard file.
+
+    Args:
+        path (str): Path of the shard.
+        counts (dict): Package name to file count, or any mapping with items().
+        metadata (dict): JSON serializable description of the counted files.
+
+    """
+    with ShardWriter(path, metadata) as writer:
+        for package, count in sorted(counts.items()):
+            writer.add(package, count)
+
+
+class ShardReader:
+    """
+    Stream the package counts of a shard file, verifying its checksum.
+    The header is read on open. Iterating yields (package, count) tuples in
+    name order and raises ShardError at the end if the shard is corrupt, so
+    a merge never completes on a damaged shard.
+
+    Args:
+        path (str): Path of the shard.
+
+    Raises:
+        ShardError: If the file is not a shard of a supported version.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')  # pylint: disable=consider-using-with
+        self._hashed = os.path.getsize(path) - DIGEST_SIZE  # Bytes covered by the checksum
+        self._position = 0
+        self._digest = hashlib.sha256()
+        try:
+            magic, version, length = HEADER.unpack(self._read(HEADER.size))
+            if magic != MAGIC:
+                raise ShardError(path, "not a shard file")
+            if version != VERSION:
+                raise ShardError(path, f"version {version}, expected {VERSION}")
+            self.metadata = json.loads(self._read(length))
+        except (struct.error, ValueError) as e:
+            self.close()
+            raise ShardError(path, e) from e
+        except ShardError:
+            self.close()
+            raise
+
+    def _read(self, size):
+        data = self._file.read(size)
+        covered = max(0, min(len(data), self._hashed - self._position))
+        self._digest.update(data[:covered])
+        self._position += len(data)
+        return data
+
+    def __iter__(self):
+        buffer = b""
+        offset = 0
+        name = b""
+        packages = total = 0
+        end_of_file = False
+        try:
+            while True:
+                if not end_of_file and len(buffer) - offset < READ_AHEAD:
+                    chunk = self._read(READ_SIZE)
+                    end_of_file = len(chunk) < READ_SIZE
+                    buffer = buffer[offset:] + chunk
+                    offset = 0
+                # Prefix and suffix lengths almost always fit in one byte
+                shared = buffer[offset]
+                length = buffer[offset + 1]
+                if shared < 0x80 and length < 0x80:
+                    offset += 2
+                else:
+                    shared, offset = decode_varint(buffer, offset)
+                    length, offset = decode_varint(buffer, offset)
+                if not shared and not length:
+                    break
+                name = name[:shared] + buffer[offset:offset + length]
+                count, offset = decode_varint(buffer, offset + length)
+                packages += 1
+                total += count
+                yield name.decode(), count
+            trailer = buffer[offset:] + self._read(TRAILER.size + DIGEST_SIZE)
+            expected_packages, expected_total = TRAILER.unpack(trailer[:TRAILER.size])
+            sha256 = trailer[TRAILER.size:]
+        except (IndexError, UnicodeDecodeError, struct.error) as e:
+            raise ShardError(self.path, "truncated or corrupt") from e
+        finally:
+            self.close()
+        if sha256 != self._digest.digest():
+            raise ShardError(self.path, "checksum does not match")
+        if (packages, total) != (expected_packages, expected_total):
+            raise ShardError(self.path, "counts do not match the trailer")
+
+    def close(self):
+        """
+        Close the shard file.
+        """
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _file_key(file):
+    """
+    Identify a Contents file independently of the mirror it was downloaded from.
+    """
+    return file["url"].split("/dists/", 1)[-1]
+
+
+def merge_shards(readers):
+    """
+    Merge shards into global package counts in name order.
+    Only one record per shard is held in memory.
+
+    Args:
+        readers (list): Open ShardReader of every shard.
+
+    Yields:
+        tuple: Package name and its count summed over the shards.
+
+    """
+    merged = heapq.merge(*readers, key=itemgetter(0))
+    for package, records in groupby(merged, key=itemgetter(0)):
+        yield package, sum(count for _package, count in records)
+
+
+def reduce_shards(paths, limit=10, output=None):
+    """
+    Merge shards into global top packages, optionally writing the merged shard.
+
+    Args:
+        paths (list): Paths of the shards.
+        limit (int): Number of top packages.
+        output (str): Also write the merged counts as a shard to this path.
+
+    Returns:
+        dict: "top" packages, the number of "shards", "files" and "packages",
+            and the "total" count.
+
+    Raises:
+        ShardError: If a shard is corrupt or a Contents file is in two shards.
+
+    """
+    readers = []
+    try:
+        for path in paths:
+            readers.append(ShardReader(path))
+        files = []
+        owners = {}
+        for reader in readers:
+            for file in reader.metadata.get("files", []):
+                key = _file_key(file)
+                if key in owners:
+                    raise ShardError(reader.path, f"{key} is also counted in {owners[key]}")
+                owners[key] = reader.path
+                files.append(file)
+        architectures = sorted({reader.metadata.get("architecture") for reader in readers},
+                               key=str)
+        writer = ShardWriter(output, {"version": VERSION, "files": files,
+                                      "architectures": architectures,
+                                      "shards": len(readers)}) if output else None
+        totals = {"packages": 0, "total": 0}
+
+        def merged():
+            for package, count in merge_shards(readers):
+                totals["packages"] += 1
+                totals["total"] += count
+                if writer is not None:
+                    writer.add(package, count)
+                yield package, count
+
+        stream = merged()
+        try:
+            # A bounded heap over the stream, ranked like top_packages
+            top = heapq.nsmallest(max(limit, 0), stream, key=lambda item: (-item[1], item[0]))
+            # Drain what nsmallest left, it reads nothing when limit is 0
+            for _item in stream:
+                pass
+        except BaseException:
+            if writer is not None:
+                writer.abort()
+            raise
+        if writer is not None:
+            writer.close()
+    finally:
+        for reader in readers:
+            reader.close()
+    return {"top": top, "shards": len(readers), "files": len(files), **totals}
+
+
+def map_shard(arch, mirror, include_udeb, output_dir, shard_path, node=0, nodes=1,
+              skip_download=0, workers=0, discovery="release", use_index=True):
+    """
+    Count this node's share of the Contents files of an architecture into a shard.
+    Every node discovers the same files and computes the same split, so
+    nodes only need their index and the number of nodes.
+
+    Args:
+        arch (str): Architecture of the packages to parse, "any" for every architecture.
+        mirror (str or list): Mirror URL for contents files, or several ranked mirrors.
+        include_udeb (bool): Flag to include udeb files for architecture.
+        output_dir (str): Download location for content files.
+        shard_path (str): Path of the shard to write.
+        node (int): Index of this node, from 0.
+        nodes (int): Number of nodes sharing the work.
+        skip_download (int): Skip download if files are already present and newer than 's' days.
+        workers (int): Number of worker processes parsing files, 0 parses in a thread.
+        discovery (str): Find Contents files from the "release" index or "html" listing.
+        use_index (bool): Reuse and store package counts in the index in output_dir.
+
+    Returns:
+        dict: Metadata written in the shard.
+
+    """
+    if not 0 <= node < nodes:
+        raise ValueError(f"Node {node} is not between 0 and {nodes - 1}")
+    engine = PackageStatsEngine(mirror, output_dir, skip_download, workers=workers,
+                                discovery=discovery, use_index=use_index)
+
+    async def run():
+        async with engine:
+            files = await engine.discover()
+            checksums = file_checksums(files)
+            urls = assign_files(architecture_urls(files, arch, include_udeb), checksums,
+                                nodes)[node]
+            result = await engine.stats(arch, include_udeb, limit=0, only=urls)
+            return result, checksums
+
+    result, checksums = asyncio.run(run())
+    metadata = {
+        "version": VERSION,
+        "architecture": arch,
+        "node": node,
+        "nodes": nodes,
+        "files": [{"name": stats.name, "url": stats.url,
+                   "sha256": checksums.get(stats.url, {}).get("sha256"),
+                   "lines": stats.lines, "error": stats.error}
+                  for stats in result.files],
+    }
+    failed = [stats.name for stats in result.files if stats.error]
+    if failed:
+        # A shard missing files would silently undercount the reduce
+        raise DownloadError(", ".join(failed), "not counted, no shard written")
+    write_shard(shard_path, result.counts, metadata)
+    return metadata
+
+
+def map_cli(argv):
+    """
+    Command-line interface of the map subcommand.
+
+    Args:
+        argv (list): Arguments after the subcommand name.
+
+    """
+    argparser = argparse.ArgumentParser(
+        prog="package_statistics.py map",
+        description=("Count one node's share of the Contents files of an architecture "
+                     "into a partial count shard, to be merged by the reduce subcommand."),
+        parents=[run_options()]
+    )
+    argparser.add_argument(
+        "architecture", type=str,
+        help=(f"Architecture of the packages to parse, '{ALL_ARCHITECTURES}' for every "
+              "architecture."))
+    argparser.add_argument(
+        "--node", type=int, default=0, help="Index of this node, from 0. DEFAULT: 0")
+    argparser.add_argument(
+        "--nodes", type=int, default=1, help="Number of nodes sharing the work. DEFAULT: 1")
+    argparser.add_argument(
+        "--shard", type=str, default=None,
+        help=("Path of the shard to write, e.g. on a shared filesystem. "
+              f"DEFAULT: <architecture>-<node>-of-<nodes>{SHARD_SUFFIX}"))
+    argparser.add_argument(
+        "-m", "--mirror_url", type=str, nargs="+", default=[MIRROR],
+        help=f"Mirror URL for contents files, or several ranked mirrors. DEFAULT: {MIRROR}")
+    argparser.add_argument(
+        "-u", "--udeb", action="store_true",
+        help="Include udeb files. DEFAULT: False")
+    args = argparser.parse_args(argv)
+    shard_path = args.shard or (
+        f"{args.architecture}-{args.node}-of-{args.nodes}{SHARD_SUFFIX}")
+    metadata = map_shard(
+        args.architecture, args.mirror_url, args.udeb, args.output_dir, shard_path,
+        args.node, args.nodes, skip_download=args.skip_download, workers=args.workers,
+        discovery=args.discovery, use_index=not args.no_index)
+    print(f"Wrote {shard_path} with {len(metadata['files'])} files")
+
+
+def reduce_cli(argv):
+    """
+    Command-line interface of the reduce subcommand.
+
+    Args:
+        argv (list): Arguments after the subcommand name.
+
+    """
+    argparser = argparse.ArgumentParser(
+        prog="package_statistics.py reduce",
+        description=("Merge partial count shards written by the map subcommand into "
+                     "global counts and top packages, in one streaming pass.")
+    )
+    argparser.add_argument(
+        "shards", nargs="+",
+        help=f"Shard files, or directories whose {SHARD_SUFFIX} files are all merged.")
+    argparser.add_argument(
+        "-l", "--limit", type=int, default=10,
+        help="Top 'l' number of packages with maximum count of files. DEFAULT: 10")
+    argparser.add_argument(
+        "--output", type=str, default=None,
+        help="Also write the merged counts as a shard to this file.")
+    argparser.add_argument(
+        "--json", type=str, default=None,
+        help="Also write the top packages and totals to this JSON file.")
+    args = argparser.parse_args(argv)
+    paths = []
+    for path in args.shards:
+        if os.path.isdir(path):
+            paths.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if name.endswith(SHARD_SUFFIX))
+        else:
+            paths.append(path)
+    result = reduce_shards(paths, args.limit, args.output)
+    print(format_stats(result["top"]))
+    print(f"Merged {result['shards']} shards of {result['files']} files: "
+          f"{result['packages']} packages, {result['total']} files")
+    if args.json:
+        atomic_write_bytes(args.json, json.dumps(result, indent=1).encode())
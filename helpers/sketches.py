@@ -0,0 +1,144 @@
+############################################################
+"""
+Bounded memory approximate counting of package file counts.
+The Space-Saving sketch keeps at most a fixed number of packages. Every
+estimate is an upper bound of the true count and comes with the maximum
+overestimate, so top-K rows can be printed with their error bounds.
+Classes:
+
+    SpaceSaving:
+        Mergeable Space-Saving sketch of package counts.
+"""
+############################################################
+
+import heapq
+from operator import itemgetter
+
+# Approximate bytes of one tracked package: its name, two dict slots and two ints
+ENTRY_BYTES = 256
+
+
+class SpaceSaving:
+    """
+    Mergeable Space-Saving sketch of package counts.
+    Up to twice the capacity packages are tracked before the sketch is pruned
+    back to the capacity largest, so pruning cost is amortized. A package that
+    is not tracked has a true count of at most floor, so a package inserted later
+    starts at floor and records floor as its error.
+
+    Args:
+        capacity (int): Number of packages kept after pruning.
+
+    """
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError("Sketch capacity must be at least 1")
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.floor = 0
+        self.total = 0
+
+    @classmethod
+    def for_budget(cls, budget_bytes):
+        """
+        Create a sketch fitting in a memory budget.
+
+        Args:
+            budget_bytes (int): Memory budget of the sketch in bytes.
+
+        Returns:
+            SpaceSaving: Empty sketch.
+
+        """
+        return cls(max(1, budget_bytes // (2 * ENTRY_BYTES)))
+
+    def add(self, package, count=1):
+        """
+        Count a package.
+
+        Args:
+            package (str): Package name.
+            count (int): Number of files to add.
+
+        """
+        self.total += count
+        if package in self.counts:
+            self.counts[package] += count
+            return
+        self.counts[package] = self.floor + count
+        self.errors[package] = self.floor
+        if len(self.counts) >= 2 * self.capacity:
+            self._prune()
+
+    def update(self, partial):
+        """
+        Count the packages of a partial count.
+
+        Args:
+            partial (dict): Package name to count, e.g. the counts of one file.
+
+        """
+        for package, count in partial.items():
+            self.add(package, count)
+
+    def merge(self, other):
+        """
+        Merge another sketch into this one.
+        A package missing from one sketch is counted with that sketch's floor,
+        so estimates stay upper bounds.
+
+        Args:
+            other (SpaceSaving): Sketch of other files.
+
+        """
+        counts = {}
+        errors = {}
+        for package in self.counts.keys() | other.counts.keys():
+            counts[package] = (self.counts.get(package, self.floor) +
+                               other.counts.get(package, other.floor))
+            errors[package] = (self.errors.get(package, self.floor) +
+                               other.errors.get(package, other.floor))
+        self.counts = counts
+        self.errors = errors
+        self.floor += other.floor
+        self.total += other.total
+        self.capacity = max(self.capacity, other.capacity)
+        if len(self.counts) > self.capacity:
+            self._prune()
+
+    def _prune(self):
+        """
+        Keep the capacity largest packages and raise the floor to the largest evicted count.
+        """
+        keep = dict(heapq.nlargest(self.capacity, self.counts.items(), key=itemgetter(1)))
+        for package, count in self.counts.items():
+            if package not in keep:
+                self.floor = max(self.floor, count)
+        self.errors = {package: self.errors[package] for package in keep}
+        self.counts = keep
+
+    def error(self, package):
+        """
+        Return the maximum overestimate of a package count.
+
+        Args:
+            package (str): Package name.
+
+        Returns:
+            int: Error bound, the true count is within [estimate - error, estimate].
+
+        """
+        return self.errors.get(package, self.floor)
+
+    def items(self):
+        """
+        Return the tracked packages with their estimated counts.
+        """
+        return self.counts.items()
+
+    def __getitem__(self, package):
+        return self.counts.get(package, self.floor)
+
+    def __len__(self):
+        return len(self.counts)
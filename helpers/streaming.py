@@ -0,0 +1,160 @@
+############################################################
+"""
+Streaming helpers for reading decompressed Contents files with bounded memory.
+Functions:
+
+    read_line_blocks:
+        Read a file object in fixed size blocks and yield line aligned blocks.
+
+    line_decoder:
+        Create the incremental line decoder of a compressed file name.
+
+Classes:
+
+    GzipLineDecoder:
+        Incremental gzip decompressor that turns compressed chunks into line aligned blocks.
+
+    XzLineDecoder:
+        Incremental xz decompressor that turns compressed chunks into line aligned blocks.
+"""
+############################################################
+
+import lzma
+import os
+import zlib
+
+BLOCK_SIZE = 1 << 20  # 1 MiB of decompressed data per read
+GZIP_WBITS = 16 + zlib.MAX_WBITS  # Expect a gzip header and trailer
+
+
+def read_line_blocks(file_obj, block_size=BLOCK_SIZE):
+    """
+    Read a file object in fixed size blocks and yield line aligned blocks.
+    A partial line at the end of a block is carried over to the next one,
+    so memory use is bounded by block_size plus the longest line.
+
+    Args:
+        file_obj: Binary file object (e.g. gzip.open handle) to read from.
+        block_size (int): Number of decompressed bytes to read at a time.
+
+    Yields:
+        bytes: Block of data ending on a line boundary.
+
+    """
+    remainder = b""
+    while True:
+        block = file_obj.read(block_size)
+        if not block:
+            break
+        if remainder:
+            block = remainder + block
+        # Cut the block after the last complete line
+        cut = block.rfind(b"\n") + 1
+        if not cut:
+            remainder = block
+            continue
+        remainder = block[cut:]
+        yield block[:cut]
+    # File without trailing newline
+    if remainder:
+        yield remainder
+
+
+class GzipLineDecoder:
+    """
+    Incremental gzip decompressor that turns compressed chunks into line
+    aligned blocks. Used to parse a Contents file while it is downloading.
+    """
+    def __init__(self):
+        self._decompressor = self._new_decompressor()
+        self._remainder = b""
+        # Whether the current gzip member has received any input
+        self._in_member = False
+
+    @staticmethod
+    def _new_decompressor():
+        return zlib.decompressobj(GZIP_WBITS)
+
+    def _decompress(self, chunk):
+        """
+        Decompress a chunk, starting a new decompressor for every member.
+
+        Args:
+            chunk (bytes): Compressed data.
+
+        Returns:
+            bytes: Decompressed data.
+
+        """
+        output = []
+        while chunk:
+            self._in_member = True
+            output.append(self._decompressor.decompress(chunk))
+            if not self._decompressor.eof:
+                break
+            # Concatenated members are valid, continue with the next one
+            chunk = self._decompressor.unused_data
+            self._decompressor = self._new_decompressor()
+            self._in_member = False
+        return b"".join(output)
+
+    def feed(self, chunk):
+        """
+        Feed a compressed chunk to the decoder.
+
+        Args:
+            chunk (bytes): Compressed data as received from the network.
+
+        Returns:
+            bytes: Block of complete lines, empty if no line was completed.
+
+        """
+        data = self._remainder + self._decompress(chunk)
+        # Hold back the incomplete last line until the next chunk
+        cut = data.rfind(b"\n") + 1
+        self._remainder = data[cut:]
+        return data[:cut]
+
+    def finish(self):
+        """
+        Flush the decoder at the end of the stream.
+
+        Returns:
+            bytes: Remaining data not terminated by a newline.
+
+        Raises:
+            EOFError: If the stream ended in the middle of a gzip member.
+
+        """
+        if self._in_member:
+            raise EOFError(
+                "Compressed stream ended before the end-of-stream marker was reached")
+        data = self._remainder
+        self._remainder = b""
+        return data
+
+
+class XzLineDecoder(GzipLineDecoder):
+    """
+    Incremental xz decompressor that turns compressed chunks into line
+    aligned blocks. Used to parse a .xz Contents file while it is downloading.
+    """
+    @staticmethod
+    def _new_decompressor():
+        return lzma.LZMADecompressor(lzma.FORMAT_XZ)
+
+
+def line_decoder(file_name):
+    """
+    Create the incremental line decoder of a compressed file name.
+
+    Args:
+        file_name (str): File name or URL ending in .gz or .xz.
+
+    Returns:
+        GzipLineDecoder: Decoder matching the file extension.
+
+    """
+    if os.path.splitext(file_name)[1] == ".xz":
+        return XzLineDecoder()
+    return GzipLineDecoder()
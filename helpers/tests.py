@@ -5,14 +5,61 @@ Module for unit tests for package stats helpers and common utility functions
 #####################################################
 
 
+import asyncio
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import os
+import random
+import shutil
+import tempfile
+import threading
 import unittest
 from unittest.mock import patch
-from collections import defaultdict
+from collections import defaultdict, Counter
 from bs4 import BeautifulSoup
 import requests
+import aiohttp
+from aiohttp import web, test_utils
 from .common_utils import (
-    get_contents_file_list, process_contents_file_list, filter_files, return_stats
+    get_contents_file_list, process_contents_file_list, filter_files, filter_all_files,
+    return_stats, top_packages
 )
+from .streaming import read_line_blocks, GzipLineDecoder, line_decoder
+from .decompress import BACKENDS, PipeReader, available_backends, select_backend
+from .parallel import count_file_sharded, process_pool
+from .http_client import DownloadClient
+from .exceptions import DownloadError, PatchError, ShardError
+from .download_cache import CacheManifest, file_sha256
+from .count_index import CountIndex, cached_counts, cached_stats
+from . import range_download
+from . import batch
+from .mirrors import MirrorSet, hedged
+from .counters import PackageMatrix, dict_memory
+from .sketches import SpaceSaving
+from .profiling import Profiler, file_metrics, run_profiled
+from .pdiff import (
+    parse_diff_index, patches_to_apply, parse_ed_patch, patch_file, apply_count_deltas)
+from .path_index import PathIndexWriter, PathIndex, building_path_index, is_current
+from .release import (
+    parse_release, split_mirror_url, contents_files_from_release, file_checksums)
+from .parser import count_block, count_lines_bytes, count_bytes, decode_counts
+from . import package_stats_helper_async as helper_async
+from .cli import cli
+from .lookup import lookup_paths
+from .batch import batch_stats
+from .engine import PackageStatsEngine, SyncPackageStatsEngine
+from .diff import diff_counts, format_diff, diff_stats
+from .server import StatsService, create_app, run_server
+from .shards import (
+    ShardReader, ShardWriter, assign_files, write_shard, reduce_shards, SHARD_SUFFIX)
+from benchmarks.contents_generator import generate_contents, write_contents_files
+from benchmarks.local_mirror import LocalMirror as BenchmarkMirror
+from benchmarks.bench_startup import (
+    ENTRY_POINT, NETWORK_MODULES, RUN_MODULES, INDEX_MODULES, cached_command, import_times)
 
 
 class TestCommonUtils(unittest.TestCase):
@@ -109,6 +156,10 @@ class TestCommonUtils(unittest.TestCase):
         expected_urls = ['https://example.com/Contents-arch2.gz']
         urls = filter_files(files, 'arch2', include_udeb=False)
         self.assertEqual(urls, expected_urls)
+        self.assertEqual(filter_all_files(files, include_udeb=False),
+                         ['https://example.com/Contents-arch1.gz',
+                          'https://example.com/Contents-arch2.gz'])
+        self.assertEqual(len(filter_all_files(files, include_udeb=True)), 4)
 
     def test_return_stats(self):
         """
@@ -122,3 +173,1894 @@ class TestCommonUtils(unittest.TestCase):
         output = return_stats(stats, descending=True, count=2)
         # print(expected_output, output)
         self.assertEqual(output, expected_output)
+
+
+class TestStreaming(unittest.TestCase):
+    """
+    Class for streaming decompression unit tests
+    """
+    def test_read_line_blocks(self):
+        """
+        Method to test blocks are cut on line boundaries
+        """
+        data = b"usr/bin/a\tpkg/a\nusr/bin/b\tpkg/b\nusr/bin/c\tpkg/c"
+        blocks = list(read_line_blocks(io.BytesIO(data), block_size=7))
+        self.assertEqual(b"".join(blocks), data)
+        for block in blocks[:-1]:
+            self.assertTrue(block.endswith(b"\n"))
+
+    def test_process_file(self):
+        """
+        Method to test process_file counts packages from a gzipped file
+        """
+        lines = b"".join(
+            f"usr/share/doc/f{i}\tdevel/pkg{i % 3},libs/common\n".encode()
+            for i in range(30))
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "Contents-test.gz")
+            with gzip.open(path, "wb") as f:
+                f.write(lines)
+            helper_async.package_stats_dict.clear()
+            helper_async.process_file(path)
+        self.assertEqual(helper_async.package_stats_dict["libs/common"], 30)
+        self.assertEqual(helper_async.package_stats_dict["devel/pkg0"], 10)
+        helper_async.package_stats_dict.clear()
+
+    def test_gzip_line_decoder(self):
+        """
+        Method to test incremental decoding of multi member gzip data
+        """
+        data = gzip.compress(b"a x\nb y\nc") + gzip.compress(b" z\nd w\n")
+        decoder = GzipLineDecoder()
+        output = b""
+        for i in range(0, len(data), 5):
+            block = decoder.feed(data[i:i + 5])
+            self.assertTrue(block == b"" or block.endswith(b"\n"))
+            output += block
+        output += decoder.finish()
+        self.assertEqual(output, b"a x\nb y\nc z\nd w\n")
+
+    def test_gzip_line_decoder_truncated(self):
+        """
+        Method to test truncated gzip streams are detected
+        """
+        decoder = GzipLineDecoder()
+        decoder.feed(gzip.compress(b"a x\n" * 100)[:-10])
+        with self.assertRaises(EOFError):
+            decoder.finish()
+
+
+class TestDecompress(unittest.TestCase):
+    """
+    Class for decompression backend unit tests
+    """
+    DATA = b"".join(f"usr/lib/f{i}\tlibs/pkg{i % 3}\n".encode() for i in range(3000))
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.tmp.cleanup)
+        self.gz_path = os.path.join(self.tmp.name, "Contents-arch1.gz")
+        self.xz_path = os.path.join(self.tmp.name, "Contents-arch1.xz")
+        with open(self.gz_path, "wb") as f:
+            f.write(gzip.compress(self.DATA))
+        with open(self.xz_path, "wb") as f:
+            f.write(lzma.compress(self.DATA))
+
+    def test_select_backend(self):
+        """
+        Method to test auto selection and rejection of missing backends
+        """
+        available = available_backends()
+        self.assertEqual(available[-1], "gzip")
+        self.assertEqual(select_backend("auto"), available[0])
+        for backend in BACKENDS:
+            if backend not in available:
+                with self.assertRaises(ValueError):
+                    select_backend(backend)
+        with self.assertRaises(ValueError):
+            select_backend("bzip2")
+
+    def test_backends_agree(self):
+        """
+        Method to test every backend and compression gives the same counts
+        """
+        expected = helper_async.count_file(self.gz_path)
+        self.assertEqual(expected["libs/pkg0"], 1000)
+        for backend in available_backends():
+            self.assertEqual(helper_async.count_file(self.gz_path, backend=backend), expected)
+        self.assertEqual(helper_async.count_file(self.xz_path), expected)
+        decoder = line_decoder(self.xz_path)
+        data = lzma.compress(self.DATA)
+        output = b"".join(decoder.feed(data[i:i + 100]) for i in range(0, len(data), 100))
+        self.assertEqual(output + decoder.finish(), self.DATA)
+
+    def test_pipe_reader(self):
+        """
+        Method to test decompressing in a subprocess and detecting corrupt files
+        """
+        with PipeReader(("gzip", "-dc"), self.gz_path) as f:
+            self.assertEqual(b"".join(read_line_blocks(f, 4096)), self.DATA)
+        with open(self.gz_path, "r+b") as f:
+            f.seek(-12, os.SEEK_END)
+            f.write(b"\0" * 8)
+        with self.assertRaises(OSError):
+            with PipeReader(("gzip", "-dc"), self.gz_path) as f:
+                f.read()
+
+    def test_one_compression_per_file(self):
+        """
+        Method to test only the preferred compression of a listed file is kept
+        """
+        html = ('<a href="Contents-arch1.xz">Contents-arch1.xz</a>'
+                '<a href="Contents-arch1.gz">Contents-arch1.gz</a>'
+                '<a href="Contents-arch2.xz">Contents-arch2.xz</a>')
+        links = BeautifulSoup(html, "html.parser").find_all("a", href=True)
+        files = process_contents_file_list("http://mirror/", links)
+        self.assertEqual([file["name"] for file in files["arch1"]], ["Contents-arch1.gz"])
+        self.assertEqual([file["name"] for file in files["arch2"]], ["Contents-arch2.xz"])
+
+
+class LocalMirrorTestCase(unittest.IsolatedAsyncioTestCase):
+    """
+    Base class for tests that need a local aiohttp stand-in for a Debian mirror
+    """
+    async def start_mirror(self, routes):
+        """
+        Start a local mirror serving the given {path: handler} routes and return its base URL
+        """
+        app = web.Application()
+        for path, handler in routes.items():
+            app.router.add_get(path, handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        self.addAsyncCleanup(runner.cleanup)
+        port = site._server.sockets[0].getsockname()[1]  # pylint: disable=protected-access
+        return f"http://127.0.0.1:{port}/"
+
+
+class TestPipeline(LocalMirrorTestCase):
+    """
+    Class for download-while-parsing unit tests
+    """
+    async def test_stream_and_process_file(self):
+        """
+        Method to test a file is parsed from the response stream and cached
+        """
+        content = b"".join(
+            f"usr/lib/f{i}\tlibs/pkg{i % 2}\n".encode() for i in range(1000))
+        body = gzip.compress(content)
+
+        async def handler(_request):
+            return web.Response(body=body)
+
+        url = await self.start_mirror({"/Contents-test.gz": handler})
+        helper_async.package_stats_dict.clear()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = await helper_async.stream_and_process_file(
+                url + "Contents-test.gz", tmp, 0)
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), body)
+        self.assertEqual(helper_async.package_stats_dict["libs/pkg0"], 500)
+        self.assertEqual(helper_async.package_stats_dict["libs/pkg1"], 500)
+        helper_async.package_stats_dict.clear()
+
+    async def test_stream_parses_off_the_event_loop(self):
+        """
+        Method to test streamed blocks are parsed in order outside the event loop thread
+        """
+        content = b"".join(
+            f"usr/lib/f{i}\tlibs/pkg{i % 7}\n".encode() for i in range(200000))
+        body = gzip.compress(content)
+
+        async def handler(_request):
+            return web.Response(body=body)
+
+        url = await self.start_mirror({"/Contents-test.gz": handler})
+        threads = set()
+
+        def recording_count_block(block, counts):
+            threads.add(threading.get_ident())
+            count_block(block, counts)
+
+        stats = Counter()
+        with tempfile.TemporaryDirectory() as tmp, \
+                patch.object(helper_async, "count_block", recording_count_block):
+            await helper_async.stream_and_process_file(
+                url + "Contents-test.gz", tmp, 0, stats=stats, build_path_index=True)
+        self.assertNotIn(threading.get_ident(), threads)
+        self.assertEqual(stats, Counter(f"libs/pkg{i % 7}" for i in range(200000)))
+
+
+class LocalContentsTestCase(unittest.IsolatedAsyncioTestCase):
+    """
+    Base class for tests on Contents files already present in the download directory
+    """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.tmp.cleanup)
+        self.urls = []
+        for arch in ("arch1", "arch2", "arch3"):
+            path = os.path.join(self.tmp.name, f"Contents-{arch}.gz")
+            with gzip.open(path, "wb") as f:
+                for i in range(200):
+                    f.write(f"usr/lib/{arch}/f{i}\tlibs/pkg{i % 4},{arch}/own\n".encode())
+            self.urls.append(f"http://mirror.invalid/Contents-{arch}.gz")
+        helper_async.package_stats_dict.clear()
+        self.addCleanup(helper_async.package_stats_dict.clear)
+
+
+class TestParallelParsing(LocalContentsTestCase):
+    """
+    Class for process pool parsing unit tests
+    """
+    def test_count_file(self):
+        """
+        Method to test count_file returns a local counter
+        """
+        counts = helper_async.count_file(os.path.join(self.tmp.name, "Contents-arch1.gz"))
+        self.assertEqual(counts["libs/pkg0"], 50)
+        self.assertEqual(counts["arch1/own"], 200)
+        self.assertEqual(helper_async.package_stats_dict, {})
+
+    async def test_process_pool_matches_thread(self):
+        """
+        Method to test worker processes give the same counts as the thread path
+        """
+        await helper_async.download_and_process_files(self.urls, self.tmp.name, 10)
+        expected = dict(helper_async.package_stats_dict)
+        helper_async.package_stats_dict.clear()
+        await helper_async.download_and_process_files(
+            self.urls, self.tmp.name, 10, workers=2)
+        self.assertEqual(dict(helper_async.package_stats_dict), expected)
+        self.assertEqual(expected["libs/pkg1"], 150)
+
+    def test_count_file_sharded(self):
+        """
+        Method to test a file split across workers gives the same counts
+        """
+        path = os.path.join(self.tmp.name, "Contents-arch2.gz")
+        with process_pool(2) as executor:
+            counts = count_file_sharded(
+                path, executor, count_bytes, max_pending=2, block_size=256)
+        self.assertEqual(counts, helper_async.count_file(path))
+
+    def test_process_pool_without_fork_server(self):
+        """
+        Method to test workers are spawned where there is no fork server
+        """
+        path = os.path.join(self.tmp.name, "Contents-arch2.gz")
+        with patch("multiprocessing.get_all_start_methods", return_value=["spawn"]):
+            executor = process_pool(1)
+        with executor:
+            self.assertEqual(executor.submit(helper_async.count_file, path).result(),
+                             helper_async.count_file(path))
+        # pylint: disable-next=protected-access
+        self.assertEqual(executor._mp_context.get_start_method(), "spawn")
+
+    async def test_parse_failure_skips_file(self):
+        """
+        Method to test a corrupt file is skipped and reported like a failed download
+        """
+        path = os.path.join(self.tmp.name, "Contents-arch2.gz")
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) // 2)
+        for workers in (0, 2):
+            helper_async.package_stats_dict.clear()
+            profiler = Profiler()
+            with patch("builtins.print"):
+                await helper_async.download_and_process_files(
+                    self.urls, self.tmp.name, 10, workers=workers, profiler=profiler)
+            self.assertEqual(helper_async.package_stats_dict["arch1/own"], 200)
+            self.assertNotIn("arch2/own", helper_async.package_stats_dict)
+            errors = [record["file"] for record in profiler.records if "error" in record]
+            self.assertEqual(errors, [path])
+        with self.assertRaises(SystemExit), patch("sys.stderr"):
+            cli(["amd64", "--pipeline", "--workers", "2"])
+
+    async def test_split_files(self):
+        """
+        Method to test split_files mode through download_and_process_files
+        """
+        await helper_async.download_and_process_files(
+            self.urls, self.tmp.name, 10, workers=2, split_files=True)
+        self.assertEqual(helper_async.package_stats_dict["libs/pkg1"], 150)
+        self.assertEqual(helper_async.package_stats_dict["arch3/own"], 200)
+
+
+class TestProfiling(LocalContentsTestCase):
+    """
+    Class for per-stage instrumentation unit tests
+    """
+    async def test_profiled_run(self):
+        """
+        Method to test every file is recorded with its bytes, lines and queue wait
+        """
+        profiler = Profiler()
+        await helper_async.download_and_process_files(
+            self.urls, self.tmp.name, 10, profiler=profiler)
+        profiler.finish()
+        stages = profiler.summary()
+        self.assertEqual(stages["download"]["calls"], 3)
+        self.assertEqual(stages["parse"]["calls"], 3)
+        self.assertEqual(stages["parse"]["lines"], 600)
+        self.assertGreater(stages["parse"]["bytes_out"], stages["parse"]["bytes_in"])
+        self.assertIn("lines_per_s", stages["parse"])
+        self.assertTrue(all(record["source"] == "cache" for record in profiler.records
+                            if record["stage"] == "download"))
+        self.assertIn("Contents-arch2.gz", profiler.report())
+        profiler.write_json(os.path.join(self.tmp.name, "profile.json"))
+        with open(os.path.join(self.tmp.name, "profile.json"), encoding="utf-8") as f:
+            self.assertEqual(json.load(f)["stages"], json.loads(json.dumps(stages)))
+        self.assertEqual(helper_async.package_stats_dict["libs/pkg1"], 150)
+
+    def test_run_profiled_capture(self):
+        """
+        Method to test a profiled call returns its metrics and cProfile statistics
+        """
+        path = os.path.join(self.tmp.name, "Contents-arch1.gz")
+        counts, metrics = run_profiled(helper_async.count_file, (path,), "cprofile")
+        self.assertEqual(counts, helper_async.count_file(path))
+        self.assertEqual(metrics["lines"], 200)
+        self.assertIsNone(file_metrics())
+        profiler = Profiler("cprofile")
+        profiler.add("parse", path, **metrics)
+        self.assertIn("count_file", profiler.report())
+        with self.assertRaises(ValueError):
+            Profiler("perf")
+
+
+class TestBytesParser(unittest.TestCase):
+    """
+    Class for bytes level parser unit tests
+    """
+    LINES = [
+        "usr/bin/tool                                            admin/tool",
+        "usr/share/doc/a file with spaces.txt\tdoc/pkg-a,doc/pkg-b",
+        "EMPTY_PACKAGE                                           misc/empty",
+        "usr/lib/x86_64-linux-gnu/libz.so.1   libs/zlib1g  ",
+        "usr/share/doc/ünïcode/readme       doc/pkg-a",
+    ]
+
+    def expected(self):
+        """
+        Counts computed with the str mapper
+        """
+        stats = Counter()
+        helper_async.mapper(self.LINES, stats)
+        return stats
+
+    def test_count_block_matches_mapper(self):
+        """
+        Method to test the vectorized parser gives the same counts as mapper
+        """
+        block = ("\n".join(self.LINES[:2] + self.LINES[3:]) + "\n").encode()
+        counts = Counter()
+        count_block(block, counts)
+        self.assertEqual(decode_counts(counts), self.expected())
+        self.assertEqual(decode_counts(counts)["doc/pkg-a"], 2)
+
+    def test_empty_package_lines(self):
+        """
+        Method to test EMPTY_PACKAGE lines are skipped by both parsers
+        """
+        block = ("\n".join(self.LINES) + "\n").encode()
+        counts = Counter()
+        count_block(block, counts)
+        line_counts = Counter()
+        count_lines_bytes(block, line_counts)
+        self.assertEqual(counts, line_counts)
+        self.assertEqual(count_bytes(block), self.expected())
+        self.assertNotIn("misc/empty", count_bytes(block))
+
+
+    def test_blank_lines(self):
+        """
+        Method to test blank and whitespace only lines are skipped by both parsers
+        """
+        block = b"a pkg\n   \n\t\nb pkg2\n\n"
+        counts = Counter()
+        count_block(block, counts)
+        line_counts = Counter()
+        count_lines_bytes(block, line_counts)
+        self.assertEqual(counts, Counter({b"pkg": 1, b"pkg2": 1}))
+        self.assertEqual(line_counts, counts)
+
+class TestTopK(unittest.TestCase):
+    """
+    Class for top-K selection unit tests
+    """
+    def test_top_packages_ties(self):
+        """
+        Method to test ties are broken by package name
+        """
+        stats = {'pkg-c': 2, 'pkg-a': 2, 'pkg-d': 5, 'pkg-b': 2, 'pkg-e': 1}
+        self.assertEqual(top_packages(stats, True, 3),
+                         [('pkg-d', 5), ('pkg-a', 2), ('pkg-b', 2)])
+        self.assertEqual(top_packages(stats, False, 2), [('pkg-e', 1), ('pkg-a', 2)])
+        self.assertEqual(top_packages(stats, True, 0), [])
+
+
+class TestDownloadClient(LocalMirrorTestCase):
+    """
+    Class for shared download client unit tests
+    """
+    async def test_retry_transient_status(self):
+        """
+        Method to test a transient error is retried on the shared session
+        """
+        calls = []
+
+        async def handler(_request):
+            calls.append(1)
+            if len(calls) < 3:
+                return web.Response(status=503)
+            return web.Response(body=b"ok")
+
+        url = await self.start_mirror({"/file": handler})
+        async with DownloadClient(retries=3, backoff=0) as client:
+            async with client.request(url + "file") as response:
+                self.assertEqual(response.status, 200)
+                self.assertEqual(await response.read(), b"ok")
+        self.assertEqual(len(calls), 3)
+
+    async def test_retries_exhausted(self):
+        """
+        Method to test the last response is returned when retries are exhausted
+        """
+        async def handler(_request):
+            return web.Response(status=503)
+
+        url = await self.start_mirror({"/file": handler})
+        async with DownloadClient(retries=1, backoff=0) as client:
+            with self.assertRaises(DownloadError):
+                await helper_async.download_file(url + "file", tempfile.gettempdir(), 0, client)
+
+    async def test_shared_connection_pool(self):
+        """
+        Method to test downloads reuse the pooled connections
+        """
+        peers = set()
+
+        async def handler(request):
+            peers.add(request.transport.get_extra_info("peername"))
+            return web.Response(body=gzip.compress(b"usr/bin/a\tpkg/a\n"))
+
+        url = await self.start_mirror({"/Contents-{arch}.gz": handler})
+        urls = [f"{url}Contents-arch{i}.gz" for i in range(6)]
+        helper_async.package_stats_dict.clear()
+        self.addCleanup(helper_async.package_stats_dict.clear)
+        with tempfile.TemporaryDirectory() as tmp:
+            async with DownloadClient(connections=1) as client:
+                await helper_async.download_and_process_files(
+                    urls, tmp, 0, client=client)
+        self.assertEqual(helper_async.package_stats_dict["pkg/a"], 6)
+        self.assertEqual(len(peers), 1)
+
+    async def test_retry_interrupted_body(self):
+        """
+        Method to test a connection reset in the middle of the body retries the transfer
+        """
+        body = gzip.compress(b"".join(f"usr/lib/f{i}\tlibs/pkg{i % 3}\n".encode()
+                                      for i in range(30000)))
+        calls = []
+
+        async def handler(request):
+            calls.append(1)
+            response = web.StreamResponse(headers={"Content-Length": str(len(body))})
+            await response.prepare(request)
+            if len(calls) % 2:
+                # Every other attempt is cut after half of the body
+                await response.write(body[:len(body) // 2])
+                request.transport.close()
+                return response
+            await response.write(body)
+            return response
+
+        url = await self.start_mirror({"/Contents-{arch}.gz": handler})
+        stats = Counter()
+        with tempfile.TemporaryDirectory() as tmp:
+            async with DownloadClient(retries=1, backoff=0) as client:
+                path = await helper_async.download_file(url + "Contents-a.gz", tmp, 0, client)
+                with open(path, "rb") as f:
+                    self.assertEqual(f.read(), body)
+                await helper_async.stream_and_process_file(
+                    url + "Contents-b.gz", tmp, 0, stats=stats, client=client)
+            self.assertEqual(sorted(os.listdir(tmp)),
+                             [".contents-manifest.json", "Contents-a.gz", "Contents-b.gz"])
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(stats, Counter({"libs/pkg0": 10000, "libs/pkg1": 10000,
+                                         "libs/pkg2": 10000}))
+
+
+class TestDownloadCache(LocalMirrorTestCase):
+    """
+    Class for validated download cache unit tests
+    """
+    async def test_conditional_get(self):
+        """
+        Method to test a 304 response keeps the cached file
+        """
+        body = gzip.compress(b"usr/bin/a\tpkg/a\n")
+        requests_seen = []
+
+        async def handler(request):
+            requests_seen.append(request.headers.get("If-None-Match"))
+            if request.headers.get("If-None-Match") == '"v1"':
+                return web.Response(status=304)
+            return web.Response(body=body, headers={"ETag": '"v1"'})
+
+        url = await self.start_mirror({"/Contents-test.gz": handler})
+        with tempfile.TemporaryDirectory() as tmp:
+            path = await helper_async.download_file(url + "Contents-test.gz", tmp, 0)
+            entry = CacheManifest.load(tmp).get("Contents-test.gz", verify=True)
+            self.assertEqual(entry["etag"], '"v1"')
+            self.assertEqual(entry["size"], len(body))
+            self.assertEqual(entry["sha256"], file_sha256(path))
+            path = await helper_async.download_file(url + "Contents-test.gz", tmp, 0)
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), body)
+        self.assertEqual(requests_seen, [None, '"v1"'])
+
+    async def test_not_modified_out_of_date_file(self):
+        """
+        Method to test a cached file the Release index lists another version of is
+        downloaded again even if the mirror would answer 304
+        """
+        old, new = gzip.compress(b"usr/bin/a\tpkg/a\n"), gzip.compress(b"usr/bin/b\tpkg/b\n")
+        requests_seen = []
+
+        async def handler(request):
+            requests_seen.append(request.headers.get("If-None-Match"))
+            if request.headers.get("If-None-Match"):
+                return web.Response(status=304)
+            return web.Response(body=new, headers={"ETag": '"v1"'})
+
+        url = await self.start_mirror({"/Contents-test.gz": handler})
+        expected = {"size": len(new), "sha256": hashlib.sha256(new).hexdigest()}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "Contents-test.gz")
+            with open(path, "wb") as f:
+                f.write(old)
+            manifest = CacheManifest(tmp)
+            manifest.update("Contents-test.gz", url + "Contents-test.gz", {"ETag": '"v1"'},
+                            len(old), hashlib.sha256(old).hexdigest())
+            await helper_async.download_file(url + "Contents-test.gz", tmp, 0,
+                                             manifest=manifest, expected=expected)
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), new)
+        self.assertEqual(requests_seen, [None])
+
+    def test_concurrent_manifests(self):
+        """
+        Method to test manifests of runs sharing a directory keep each other's entries
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            first, second = CacheManifest.load(tmp), CacheManifest.load(tmp)
+            first.update("Contents-a.gz", "http://a/Contents-a.gz", {}, 1, "a1")
+            second.update("Contents-b.gz", "http://a/Contents-b.gz", {}, 2, "b1")
+            second.record_listing("http://a/", ["Contents-a.gz", "Contents-b.gz"])
+            # The stale copy of b in first must not replace the entry second saved
+            first.update("Contents-a.gz", "http://a/Contents-a.gz", {}, 1, "a2")
+            saved = CacheManifest.load(tmp)
+            self.assertEqual({name: entry["sha256"] for name, entry in saved.entries.items()},
+                             {"Contents-a.gz": "a2", "Contents-b.gz": "b1"})
+            self.assertEqual(saved.listings, first.listings)
+            self.assertEqual(first.entries, saved.entries)
+
+    async def test_interrupted_download(self):
+        """
+        Method to test an interrupted download leaves the cached file untouched
+        """
+        async def handler(request):
+            response = web.StreamResponse(headers={"Content-Length": "100000"})
+            await response.prepare(request)
+            await response.write(b"x" * 1000)
+            request.transport.close()
+            return response
+
+        url = await self.start_mirror({"/Contents-test.gz": handler})
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "Contents-test.gz")
+            with open(path, "wb") as f:
+                f.write(b"previous")
+            async with DownloadClient(retries=0) as client:
+                with self.assertRaises(DownloadError):
+                    await helper_async.download_file(
+                        url + "Contents-test.gz", tmp, 0, client)
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), b"previous")
+            self.assertEqual(os.listdir(tmp), ["Contents-test.gz"])
+
+
+RELEASE_TEXT = """-----BEGIN PGP SIGNED MESSAGE-----
+Hash: SHA256
+
+Origin: Debian
+Suite: stable
+Codename: bookworm
+Architectures: all amd64 arm64
+Components: main contrib
+SHA256:
+ {gz_sha} {gz_size} main/Contents-arch1.gz
+ 1111111111111111111111111111111111111111111111111111111111111111 20 main/Contents-arch1.xz
+ 2222222222222222222222222222222222222222222222222222222222222222 30 main/Contents-udeb-arch1.gz
+ 3333333333333333333333333333333333333333333333333333333333333333 40 contrib/Contents-arch1.gz
+ 4444444444444444444444444444444444444444444444444444444444444444 50 main/binary-arch1/Packages.gz
+-----BEGIN PGP SIGNATURE-----
+
+iQIzBAEBCAAdFiEE
+-----END PGP SIGNATURE-----
+"""
+
+
+class TestRelease(LocalMirrorTestCase):
+    """
+    Class for Release index discovery unit tests
+    """
+    BODY = gzip.compress(b"usr/bin/a\tpkg/a\n")
+
+    def release_text(self, body=None):
+        """
+        Release file listing BODY as main/Contents-arch1.gz
+        """
+        body = self.BODY if body is None else body
+        return RELEASE_TEXT.format(gz_sha=hashlib.sha256(body).hexdigest(), gz_size=len(body))
+
+    def test_parse_release(self):
+        """
+        Method to test fields and checksums are parsed from a signed Release file
+        """
+        release = parse_release(self.release_text())
+        self.assertEqual(release["Codename"], "bookworm")
+        self.assertEqual(release["SHA256"]["main/Contents-udeb-arch1.gz"]["size"], 30)
+        self.assertEqual(split_mirror_url("http://example.com/debian/dists/stable/main/"),
+                         ("http://example.com/debian/dists/stable/", "main"))
+        files = contents_files_from_release(
+            "http://example.com/dists/stable/", release, "main")
+        self.assertEqual([f["name"] for f in files["arch1"]],
+                         ["Contents-arch1.gz", "Contents-udeb-arch1.gz"])
+        self.assertEqual(files["arch1"][1]["udeb"], True)
+        self.assertEqual(filter_files(files, "arch1", False),
+                         ["http://example.com/dists/stable/main/Contents-arch1.gz"])
+
+    def test_release_fallback_notice_on_stderr(self):
+        """
+        Method to test the listing fallback notice stays out of the printed statistics
+        """
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with patch.object(helper_async, "get_release", side_effect=DownloadError("u", 404)), \
+                patch.object(helper_async, "get_contents_file_list", return_value=[]), \
+                contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            self.assertEqual(helper_async.discover_contents_files(
+                "http://example.com/dists/stable/main/"), {})
+        self.assertEqual(stdout.getvalue(), "")
+        self.assertIn("Release index unavailable", stderr.getvalue())
+
+    async def test_checksum_verified_download(self):
+        """
+        Method to test downloads are verified against the Release file
+        """
+        async def handler(_request):
+            return web.Response(body=self.BODY)
+
+        url = await self.start_mirror({"/main/Contents-arch1.gz": handler})
+        files = contents_files_from_release(url, parse_release(self.release_text()), "main")
+        checksums = file_checksums(files)
+        link = files["arch1"][0]["link"]
+        with tempfile.TemporaryDirectory() as tmp:
+            await helper_async.download_file(link, tmp, 0, expected=checksums[link])
+            bad = dict(checksums[link], sha256="0" * 64)
+            os.remove(os.path.join(tmp, "Contents-arch1.gz"))
+            with self.assertRaises(DownloadError):
+                await helper_async.download_file(link, tmp, 0, expected=bad)
+            self.assertFalse(os.path.exists(os.path.join(tmp, "Contents-arch1.gz")))
+
+
+class TestCountIndex(LocalContentsTestCase):
+    """
+    Class for persistent count index unit tests
+    """
+    def test_put_get_union(self):
+        """
+        Method to test counts are stored and summed by SHA256
+        """
+        with CountIndex(os.path.join(self.tmp.name, "index.sqlite3")) as index:
+            index.put("a" * 64, "Contents-arch1.gz", {"pkg/a": 2, "pkg/b": 1})
+            index.put("b" * 64, "Contents-arch2.gz", {"pkg/a": 3})
+            self.assertTrue(index.has("a" * 64))
+            self.assertIsNone(index.get("c" * 64))
+            self.assertEqual(index.get("b" * 64), {"pkg/a": 3})
+            self.assertEqual(index.union(["a" * 64, "b" * 64, "a" * 64]),
+                             {"pkg/a": 7, "pkg/b": 2})
+
+    async def test_indexed_files_are_not_parsed(self):
+        """
+        Method to test a second run loads counts from the index without parsing
+        """
+        with CountIndex(os.path.join(self.tmp.name, "index.sqlite3")) as index:
+            await helper_async.download_and_process_files(
+                self.urls, self.tmp.name, 10, count_index=index)
+            expected = dict(helper_async.package_stats_dict)
+            helper_async.package_stats_dict.clear()
+            with patch.object(helper_async, "count_file", side_effect=AssertionError):
+                await helper_async.download_and_process_files(
+                    self.urls, self.tmp.name, 10, count_index=index)
+        self.assertEqual(dict(helper_async.package_stats_dict), expected)
+
+    async def test_duplicate_files_indexed_as_parsed(self):
+        """
+        Method to test files with the same content count as often from the index as parsed
+        """
+        shutil.copy(os.path.join(self.tmp.name, "Contents-arch1.gz"),
+                    os.path.join(self.tmp.name, "Contents-copy.gz"))
+        urls = self.urls + ["http://mirror.invalid/Contents-copy.gz"]
+        with CountIndex(os.path.join(self.tmp.name, "index.sqlite3")) as index:
+            await helper_async.download_and_process_files(
+                urls, self.tmp.name, 10, count_index=index)
+            fresh = dict(helper_async.package_stats_dict)
+            helper_async.package_stats_dict.clear()
+            with patch.object(helper_async, "count_file", side_effect=AssertionError):
+                await helper_async.download_and_process_files(
+                    urls, self.tmp.name, 10, count_index=index)
+        self.assertEqual(fresh["arch1/own"], 400)
+        self.assertEqual(dict(helper_async.package_stats_dict), fresh)
+
+
+class TestPathIndex(LocalContentsTestCase):
+    """
+    Class for file to package path index unit tests
+    """
+    def test_exact_prefix_glob(self):
+        """
+        Method to test queries on a path index with unsorted input
+        """
+        path = os.path.join(self.tmp.name, "test.paths")
+        writer = PathIndexWriter(path, "f" * 64)
+        writer.add_block(b"usr/lib/x/y.so    libs/y\nusr/bin/tool  admin/tool,admin/extra\n")
+        writer.add_block(b"usr/lib/x/z.so\tlibs/z\nEMPTY_PACKAGE misc/empty\n")
+        writer.close()
+        with PathIndex(path) as index:
+            self.assertEqual(index.sha256, "f" * 64)
+            self.assertEqual(index.exact("/usr/bin/tool"), "admin/tool,admin/extra")
+            self.assertIsNone(index.exact("usr/bin/too"))
+            self.assertEqual([p for p, _ in index.prefix("usr/lib/x/")],
+                             ["usr/lib/x/y.so", "usr/lib/x/z.so"])
+            self.assertEqual(list(index.glob("usr/*/z.*")), [("usr/lib/x/z.so", "libs/z")])
+        self.assertTrue(is_current(path, "f" * 64))
+        self.assertFalse(is_current(path, "0" * 64))
+
+    def test_many_records(self):
+        """
+        Method to test lookups across restart points
+        """
+        path = os.path.join(self.tmp.name, "test.paths")
+        files = [f"usr/share/doc/pkg{i // 5}/file{i}" for i in range(1000)]
+        with building_path_index(path[:-len(".paths")]) as writer:
+            writer.add_block("".join(f"{f} doc/pkg{i}\n" for i, f in enumerate(files)).encode())
+        with PathIndex(path) as index:
+            for i, file in enumerate(files):
+                self.assertEqual(index.exact(file), f"doc/pkg{i}")
+            self.assertEqual([p for p, _ in index.prefix("")], sorted(files))
+
+    def test_unsorted_records_merged_from_runs(self):
+        """
+        Method to test out of order records are sorted through run files
+        """
+        path = os.path.join(self.tmp.name, "test.paths")
+        rng = random.Random(3)
+        files = [f"usr/share/doc/pkg{i}/file{i}" for i in range(5000)]
+        # A sorted start, then out of order records spilled 700 at a time
+        order = files[:1000] + rng.sample(files[1000:], 4000)
+        writer = PathIndexWriter(path, sort_buffer=700)
+        for start in range(0, len(order), 300):
+            writer.add_block("".join(f"{f} doc/{f[14:18]}\n"
+                                     for f in order[start:start + 300]).encode())
+        writer.add_block(b"EMPTY_PACKAGE misc/empty\n")
+        self.assertFalse(writer.is_sorted)
+        writer.close()
+        self.assertEqual(os.listdir(self.tmp.name).count("test.paths"), 1)
+        self.assertEqual(sorted(name for name in os.listdir(self.tmp.name)
+                                if name.startswith(".")), [])
+        with PathIndex(path) as index:
+            self.assertEqual(index.count, 5000)
+            self.assertEqual([p for p, _ in index.prefix("")], sorted(files))
+            self.assertEqual(index.exact(files[4321]), f"doc/{files[4321][14:18]}")
+            self.assertIsNone(index.exact("EMPTY_PACKAGE"))
+
+    async def test_build_during_parse_and_lookup(self):
+        """
+        Method to test path indexes are built in the parse pass and queried by lookup
+        """
+        await helper_async.download_and_process_files(
+            self.urls, self.tmp.name, 10, workers=2, build_path_index=True)
+        results = lookup_paths(self.tmp.name, "usr/lib/arch2/f7")
+        self.assertEqual(results, [("Contents-arch2.gz", "usr/lib/arch2/f7", "libs/pkg3,arch2/own")])
+        results = lookup_paths(self.tmp.name, "usr/lib/*/f19?", "glob", "arch3")
+        self.assertEqual([r[1] for r in results], [f"usr/lib/arch3/f19{i}" for i in range(10)])
+        with patch("builtins.print") as mock_print:
+            cli(["lookup", "--prefix", "usr/lib/arch1/f19", "-o", self.tmp.name])
+        self.assertEqual(mock_print.call_count, 11)
+
+
+class TestPackageMatrix(LocalContentsTestCase):
+    """
+    Class for interned count matrix unit tests
+    """
+    def test_columns_and_serialization(self):
+        """
+        Method to test counts per column, totals and a serialization round trip
+        """
+        matrix = PackageMatrix(["amd64"])
+        matrix.add("amd64", {"libs/a": 3, "libs/b": 1})
+        matrix.add("arm64", {"libs/a": 2, "libs/c": 5})
+        self.assertEqual(matrix.row("libs/a"), {"amd64": 3, "arm64": 2})
+        self.assertEqual(matrix.column_counts("amd64"), {"libs/a": 3, "libs/b": 1})
+        self.assertEqual(dict(matrix.items()), {"libs/a": 5, "libs/b": 1, "libs/c": 5})
+        self.assertIn("libs/a   ", return_stats(matrix, True, 1))
+        loaded = PackageMatrix.from_bytes(matrix.to_bytes())
+        self.assertEqual(loaded.columns, ["amd64", "arm64"])
+        self.assertEqual(dict(loaded.items()), dict(matrix.items()))
+        self.assertEqual(loaded["libs/c"], 5)
+
+    def test_smaller_than_dicts(self):
+        """
+        Method to test the matrix uses less memory than one dict per architecture
+        """
+        archs = [f"arch{i}" for i in range(8)]
+        matrix = PackageMatrix(archs)
+        dicts = {}
+        for arch in archs:
+            counts = {f"section/package{i}": i + 1000 for i in range(2000)}
+            matrix.add(arch, counts)
+            dicts[arch] = counts
+        self.assertLess(matrix.nbytes(), sum(map(dict_memory, dicts.values())))
+
+    async def test_all_architecture_run(self):
+        """
+        Method to test a run with an index fills the matrix like the global dict
+        """
+        with CountIndex(os.path.join(self.tmp.name, "counts.sqlite3")) as index:
+            await helper_async.download_and_process_files(self.urls, self.tmp.name, 10)
+            expected = dict(helper_async.package_stats_dict)
+            for _ in range(2):
+                # Parsed, then loaded from the index
+                matrix = PackageMatrix()
+                await helper_async.download_and_process_files(
+                    self.urls, self.tmp.name, 10, count_index=index, matrix=matrix)
+                self.assertEqual(dict(matrix.items()), expected)
+                self.assertEqual(matrix.row("libs/pkg0"), {"arch1": 50, "arch2": 50, "arch3": 50})
+        self.assertEqual(dict(helper_async.package_stats_dict), expected)
+
+
+class TestSpaceSaving(LocalContentsTestCase):
+    """
+    Class for approximate counting unit tests
+    """
+    @staticmethod
+    def skewed_counts(seed):
+        """
+        Generate a Zipf like partial count
+        """
+        rng = random.Random(seed)
+        return Counter(f"libs/pkg{int(rng.paretovariate(1.1)) % 3000}" for _ in range(20000))
+
+    def assert_bounds(self, sketch, exact):
+        """
+        Check every estimate is within its error bound of the exact count
+        """
+        for package, estimate in sketch.items():
+            self.assertLessEqual(exact[package], estimate)
+            self.assertLessEqual(estimate - sketch.error(package), exact[package])
+
+    def test_bounds_and_merge(self):
+        """
+        Method to test estimates bound the true counts, also after merging sketches
+        """
+        exact = Counter()
+        sketches = []
+        for seed in range(3):
+            partial = self.skewed_counts(seed)
+            exact.update(partial)
+            sketch = SpaceSaving(50)
+            sketch.update(partial)
+            self.assert_bounds(sketch, exact if seed == 0 else partial)
+            self.assertLessEqual(len(sketch), 100)
+            sketches.append(sketch)
+        merged = sketches[0]
+        for sketch in sketches[1:]:
+            merged.merge(sketch)
+        self.assert_bounds(merged, exact)
+        self.assertEqual(merged.total, sum(exact.values()))
+        top = [package for package, _ in top_packages(merged, True, 3)]
+        self.assertEqual(top, [package for package, _ in exact.most_common(3)])
+
+    def test_exact_within_capacity(self):
+        """
+        Method to test a sketch larger than the data counts exactly
+        """
+        sketch = SpaceSaving.for_budget(1 << 20)
+        sketch.update({"libs/a": 3, "libs/b": 2})
+        sketch.update({"libs/a": 1})
+        self.assertEqual(dict(sketch.items()), {"libs/a": 4, "libs/b": 2})
+        self.assertEqual(sketch.error("libs/a"), 0)
+        stats = return_stats(sketch, True, 1, errors=sketch.error)
+        self.assertIn("\t Error", stats)
+        self.assertTrue(stats.endswith("\t 4 \t +0/-0"))
+
+    async def test_approximate_run(self):
+        """
+        Method to test a run into a sketch leaves the global dict empty
+        """
+        sketch = SpaceSaving(2)
+        await helper_async.download_and_process_files(
+            self.urls, self.tmp.name, 10, sketch=sketch)
+        self.assertEqual(helper_async.package_stats_dict, {})
+        self.assertEqual(sketch.total, 1200)
+        self.assertLessEqual(len(sketch), 4)
+        self.assertGreaterEqual(sketch["libs/pkg0"], 150)
+
+    async def test_approximate_run_is_bounded(self):
+        """
+        Method to test files are sketched block by block and not indexed exactly
+        """
+        def small_blocks(f):
+            return read_line_blocks(f, 256)
+
+        updates = []
+        update = SpaceSaving.update
+
+        def recording_update(sketch, partial):
+            updates.append(len(partial))
+            update(sketch, partial)
+
+        path = os.path.join(self.tmp.name, "Contents-arch1.gz")
+        with patch.object(helper_async, "read_line_blocks", small_blocks), \
+                patch.object(SpaceSaving, "update", recording_update):
+            partial = helper_async.count_file(path, capacity=2)
+        self.assertIsInstance(partial, SpaceSaving)
+        self.assertEqual(partial.total, 400)
+        self.assertLessEqual(len(partial), 4)
+        # Every update holds the exact counts of one small block only
+        self.assertGreater(len(updates), 1)
+        self.assertLessEqual(max(updates), 5)
+        sketch = SpaceSaving(2)
+        with CountIndex(os.path.join(self.tmp.name, "index.sqlite3")) as index:
+            await helper_async.download_and_process_files(
+                self.urls, self.tmp.name, 10, sketch=sketch, count_index=index, workers=2)
+            self.assertFalse(index.has(file_sha256(path)))
+            # Indexed counts are read into the sketch row by row
+            await helper_async.download_and_process_files(
+                self.urls, self.tmp.name, 10, count_index=index)
+            self.assertTrue(index.has(file_sha256(path)))
+            indexed = SpaceSaving(2)
+            await helper_async.download_and_process_files(
+                self.urls, self.tmp.name, 10, sketch=indexed, count_index=index)
+        self.assertEqual(sketch.total, 1200)
+        self.assertLessEqual(len(sketch), 4)
+        self.assertEqual(indexed.total, 1200)
+
+
+class ThreadedMirrorTestCase(unittest.TestCase):
+    """
+    Base class for tests of synchronous entry points that need a local mirror
+    """
+    def start_mirror(self, routes):
+        """
+        Serve the given {path: bytes} routes from a thread and return the base URL
+        """
+        loop = asyncio.new_event_loop()
+        self.hits = Counter()
+        started = threading.Event()
+        base = {}
+
+        async def handler(request):
+            self.hits[request.path] += 1
+            if request.path not in routes:
+                raise web.HTTPNotFound()
+            return web.Response(body=routes[request.path])
+
+        async def start():
+            app = web.Application()
+            app.router.add_get("/{path:.*}", handler)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            base["runner"] = runner
+            port = site._server.sockets[0].getsockname()[1]  # pylint: disable=protected-access
+            base["url"] = f"http://127.0.0.1:{port}/"
+            started.set()
+
+        def stop():
+            asyncio.run_coroutine_threadsafe(base["runner"].cleanup(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        asyncio.run_coroutine_threadsafe(start(), loop)
+        started.wait(5)
+        self.addCleanup(stop)
+        return base["url"]
+
+
+class TestBatch(ThreadedMirrorTestCase):
+    """
+    Class for batch subcommand unit tests
+    """
+    @staticmethod
+    def contents(packages):
+        """
+        Build a gzipped Contents file with one file per (package, count)
+        """
+        return gzip.compress("".join(
+            f"usr/share/{package}/f{i}\t{package}\n"
+            for package, count in packages for i in range(count)).encode())
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.tmp.cleanup)
+        shared = self.contents([("libs/shared", 5)])
+        udeb = self.contents([("debian-installer/udeb", 7)])
+        suites = {
+            "stable": {"Contents-arch1.gz": self.contents([("libs/old", 3)]),
+                       "Contents-arch2.gz": shared, "Contents-udeb-arch1.gz": udeb},
+            "testing": {"Contents-arch1.gz": self.contents([("libs/new", 4)]),
+                        "Contents-arch2.gz": shared, "Contents-udeb-arch1.gz": udeb},
+        }
+        self.routes = {}
+        for suite, files in suites.items():
+            release = ["Suite: " + suite, "SHA256:"]
+            for name, body in files.items():
+                self.routes[f"/dists/{suite}/main/{name}"] = body
+                release.append(f" {hashlib.sha256(body).hexdigest()} {len(body)} main/{name}")
+            self.routes[f"/dists/{suite}/Release"] = "\n".join(release).encode()
+
+    def test_batch_dedups_shared_files(self):
+        """
+        Method to test shared files are downloaded once and counted in every cell
+        """
+        archive = self.start_mirror(self.routes)
+        results = batch_stats(
+            archive, ["stable", "testing"], ["main"], ["arch1", "arch2"], True, 3,
+            self.tmp.name, 0)
+        self.assertEqual(self.hits["/dists/testing/main/Contents-arch2.gz"], 0)
+        self.assertEqual(self.hits["/dists/testing/main/Contents-udeb-arch1.gz"], 0)
+        self.assertEqual(self.hits["/dists/testing/main/Contents-arch1.gz"], 1)
+        cells = {(c["suite"], c["architecture"]): c["top"] for c in results["cells"]}
+        self.assertEqual(cells[("testing", "arch1")],
+                         [("debian-installer/udeb", 7), ("libs/new", 4)])
+        self.assertEqual(cells[("testing", "arch2")], [("libs/shared", 5)])
+        self.assertEqual(results["aggregate"]["files"], 4)
+        self.assertEqual(results["aggregate"]["top"],
+                         [("debian-installer/udeb", 7), ("libs/shared", 5), ("libs/new", 4)])
+        self.assertEqual(helper_async.package_stats_dict, {})
+        json_path = os.path.join(self.tmp.name, "batch.json")
+        with patch("builtins.print"):
+            cli(["batch", "--suites", "stable", "testing", "-a", "arch1",
+                 "-m", archive, "-o", self.tmp.name, "-s", "10", "--json", json_path])
+        with open(json_path, encoding="utf-8") as f:
+            self.assertEqual(len(json.load(f)["cells"]), 2)
+
+    def test_batch_client_options(self):
+        """
+        Method to test the batch subcommand passes the download client options on
+        """
+        with patch.object(batch, "batch_stats") as mock_stats, patch("builtins.print"):
+            mock_stats.return_value = {"cells": [], "aggregate": {"files": 0, "top": []}}
+            cli(["batch", "-a", "arch1", "--connections", "2", "--retries", "0"])
+        options = mock_stats.call_args.kwargs["client_options"]
+        self.assertEqual((options["connections"], options["retries"]), (2, 0))
+
+    def test_batch_reports_failed_files(self):
+        """
+        Method to test a file that could not be downloaded fails the batch instead
+        of undercounting its cells
+        """
+        routes = dict(self.routes)
+        # Listed in the Release index but missing on the mirror
+        del routes["/dists/testing/main/Contents-arch1.gz"]
+        archive = self.start_mirror(routes)
+        with contextlib.redirect_stderr(io.StringIO()), \
+                self.assertRaisesRegex(DownloadError, "testing/main/Contents-arch1.gz"):
+            batch_stats(archive, ["stable", "testing"], ["main"], ["arch1"], False, 3,
+                        self.tmp.name, 0)
+
+
+class TestDiff(ThreadedMirrorTestCase):
+    """
+    Class for diff subcommand unit tests
+    """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.tmp.cleanup)
+        suites = {
+            "stable": {"Contents-arch1.gz": [("libs/old", 3), ("libs/same", 5),
+                                             ("libs/grow", 2), ("libs/shrink", 9)]},
+            "testing": {"Contents-arch1.gz": [("libs/new", 4), ("libs/same", 5),
+                                              ("libs/grow", 6), ("libs/shrink", 4)],
+                        "Contents-arch2.gz": [("libs/same", 1)],
+                        "Contents-udeb-arch1.gz": [("debian-installer/udeb", 7)]},
+        }
+        self.routes = {}
+        for suite, files in suites.items():
+            release = ["Suite: " + suite, "SHA256:"]
+            for name, packages in files.items():
+                body = TestBatch.contents(packages)
+                self.routes[f"/dists/{suite}/main/{name}"] = body
+                release.append(f" {hashlib.sha256(body).hexdigest()} {len(body)} main/{name}")
+            self.routes[f"/dists/{suite}/Release"] = "\n".join(release).encode()
+
+    def test_diff_counts(self):
+        """
+        Method to test packages are aligned and ranked by absolute and relative change
+        """
+        comparisons = diff_counts({
+            "a": {"same": 5, "grow": 2, "shrink": 9, "old": 3},
+            "b": {"same": 5, "grow": 6, "shrink": 4, "new": 4},
+            "c": {"same": 5},
+        }, limit=1)
+        first = comparisons[0]
+        self.assertEqual((first["base"], first["other"]), ("a", "b"))
+        self.assertEqual(first["packages"],
+                         {"base": 4, "other": 4, "added": 1, "removed": 1, "changed": 2})
+        self.assertEqual(first["absolute"], [("shrink", 9, 4, -5)])
+        self.assertEqual(first["relative"], [("grow", 2, 6, 4)])
+        self.assertEqual((first["added"], first["removed"]), ([("new", 4)], [("old", 3)]))
+        self.assertEqual(comparisons[1]["removed"], [("shrink", 9)])
+        self.assertIn("+200.0%", format_diff(first))
+        with self.assertRaises(ValueError):
+            diff_counts({"a": {}})
+
+    def test_diff_reuses_cached_counts(self):
+        """
+        Method to test sources are compared and a repeated diff sends no request
+        """
+        archive = self.start_mirror(self.routes)
+        sources = [("stable", "arch1"), ("testing", "arch1"), ("testing", "arch2")]
+        results = diff_stats(archive, sources, "main", False, 2, self.tmp.name, 10)
+        first, second = results["comparisons"]
+        self.assertEqual((first["base"], first["other"]), ("stable/arch1", "testing/arch1"))
+        self.assertEqual(first["absolute"],
+                         [("libs/shrink", 9, 4, -5), ("libs/grow", 2, 6, 4)])
+        self.assertEqual(first["added"], [("libs/new", 4)])
+        self.assertEqual(second["packages"]["removed"], 3)
+        self.assertFalse(any(source["cached"] for source in results["sources"]))
+        hits = sum(self.hits.values())
+        json_path = os.path.join(self.tmp.name, "diff.json")
+        with patch("builtins.print"):
+            cli(["diff", "stable/arch1", "testing/arch1", "-m", archive,
+                 "-o", self.tmp.name, "-s", "10", "--json", json_path])
+        self.assertEqual(sum(self.hits.values()), hits)
+        with open(json_path, encoding="utf-8") as f:
+            results = json.load(f)
+        self.assertTrue(all(source["cached"] for source in results["sources"]))
+        self.assertEqual(results["comparisons"][0]["added"], [["libs/new", 4]])
+        with self.assertRaises(ValueError):
+            diff_stats(archive, [("stable", "arch1"), ("stable", "mips")],
+                       "main", False, 2, self.tmp.name, 0)
+
+
+    def test_diff_cached_without_udeb(self):
+        """
+        Method to test a source cached without udeb files is counted again with them
+        """
+        archive = self.start_mirror(self.routes)
+        sources = [("testing", "arch1"), ("stable", "arch1")]
+        diff_stats(archive, sources, "main", False, 2, self.tmp.name, 10)
+        results = diff_stats(archive, sources, "main", True, 2, self.tmp.name, 10)
+        self.assertFalse(results["sources"][0]["cached"])
+        self.assertEqual(results["comparisons"][0]["removed"],
+                         [("debian-installer/udeb", 7), ("libs/new", 4)])
+        self.assertEqual(self.hits["/dists/testing/main/Contents-udeb-arch1.gz"], 1)
+
+PDIFF_FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "pdiff")
+
+
+class TestPdiff(LocalMirrorTestCase):
+    """
+    Class for incremental pdiff update unit tests, on patches written by diff --ed
+    """
+    @staticmethod
+    def fixture(name):
+        """
+        Read a fixture file
+        """
+        with open(os.path.join(PDIFF_FIXTURES, name), "rb") as f:
+            return f.read()
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.tmp.cleanup)
+        self.old = self.fixture("Contents-arch1.v0")
+        self.new = self.fixture("Contents-arch1.v2")
+        self.index = self.fixture("Contents-arch1.diff/Index").decode()
+        helper_async.package_stats_dict.clear()
+        self.addCleanup(helper_async.package_stats_dict.clear)
+
+    def test_patch_file_and_counts(self):
+        """
+        Method to test patches since the cached version give the current file and counts
+        """
+        index = parse_diff_index(self.index)
+        selected = patches_to_apply(index, hashlib.sha256(self.old).hexdigest())
+        self.assertEqual([name for name, _, _ in selected],
+                         ["2026-10-15-0800.00.gz", "2026-10-16-0800.00.gz"])
+        self.assertEqual(patches_to_apply(index, index["current"][0]), [])
+        self.assertIsNone(patches_to_apply(index, "0" * 64))
+        path = os.path.join(self.tmp.name, "Contents-arch1.gz")
+        with gzip.open(path, "wb") as f:
+            f.write(self.old)
+        patches = [gzip.decompress(self.fixture("Contents-arch1.diff/" + name))
+                   for name, _, _ in selected]
+        added, removed = patch_file(path, patches, index["current"][0])
+        with gzip.open(path, "rb") as f:
+            self.assertEqual(f.read(), self.new)
+        counts = apply_count_deltas(count_bytes(self.old), added, removed)
+        self.assertEqual(counts, dict(count_bytes(self.new)))
+        with self.assertRaises(PatchError):
+            patch_file(path, patches, index["current"][0])
+
+    def test_ed_dot_line(self):
+        """
+        Method to test a text line of a single dot escaped by diff --ed
+        """
+        commands = parse_ed_patch(b"3c\nx a\n..\n.\ns/.//\na\ny b\n.\n1d\n")
+        self.assertEqual(commands, [(1, 1, "d", []), (3, 3, "c", [b"x a\n", b".\n", b"y b\n"])])
+
+    async def test_incremental_run(self):
+        """
+        Method to test a run downloads only the pdiffs of a cached file
+        """
+        hits = Counter()
+        current = {"body": gzip.compress(self.old)}
+
+        async def contents(request):
+            hits[request.path] += 1
+            return web.Response(body=current["body"])
+
+        async def diff(request):
+            hits[request.path] += 1
+            return web.Response(body=self.fixture(
+                "Contents-arch1.diff/" + request.match_info["name"]))
+
+        base = await self.start_mirror({
+            "/main/Contents-arch1.gz": contents,
+            "/main/Contents-arch1.diff/{name}": diff,
+        })
+        url = base + "main/Contents-arch1.gz"
+
+        def checksums():
+            return {url: {"size": len(current["body"]),
+                          "sha256": hashlib.sha256(current["body"]).hexdigest()}}
+
+        with CountIndex(os.path.join(self.tmp.name, "counts.sqlite3")) as index:
+            await helper_async.download_and_process_files(
+                [url], self.tmp.name, 0, count_index=index, incremental=True)
+            self.assertEqual(helper_async.package_stats_dict, count_bytes(self.old))
+            current["body"] = gzip.compress(self.new, mtime=0)
+            for pipeline in (False, True):
+                helper_async.package_stats_dict.clear()
+                await helper_async.download_and_process_files(
+                    [url], self.tmp.name, 0, count_index=index, incremental=True,
+                    pipeline=pipeline, checksums=checksums())
+                self.assertEqual(helper_async.package_stats_dict, count_bytes(self.new))
+            # The patched file is not the mirror's bytes but matches its Release SHA256,
+            # later runs use its indexed counts or the cached file without downloading it
+            self.assertNotEqual(file_sha256(os.path.join(self.tmp.name, "Contents-arch1.gz")),
+                                checksums()[url]["sha256"])
+            for count_index in (index, None):
+                helper_async.package_stats_dict.clear()
+                await helper_async.download_and_process_files(
+                    [url], self.tmp.name, 0, count_index=count_index, checksums=checksums())
+                self.assertEqual(helper_async.package_stats_dict, count_bytes(self.new))
+        self.assertEqual(hits["/main/Contents-arch1.gz"], 1)
+        self.assertEqual(hits["/main/Contents-arch1.diff/2026-10-15-0800.00.gz"], 1)
+        with gzip.open(os.path.join(self.tmp.name, "Contents-arch1.gz"), "rb") as f:
+            self.assertEqual(f.read(), self.new)
+
+
+class TestRangeDownload(LocalMirrorTestCase):
+    """
+    Class for parallel range download unit tests
+    """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.tmp.cleanup)
+        self.data = random.Random(0).randbytes(100000)
+        self.expected = {"size": len(self.data), "sha256": hashlib.sha256(self.data).hexdigest()}
+        self.ranges = Counter()
+        # Ranges cut mid-body, the number of times each is cut
+        self.failures = Counter()
+        for name, value in (("RANGE_THRESHOLD", 50000),):
+            patcher = patch.object(helper_async, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for name, value in (("SEGMENT_SIZE", 16384), ("PARALLEL_SEGMENTS", 3)):
+            patcher = patch.object(range_download, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def handler(self, request):
+        """
+        Serve the data with HEAD, Range and If-Range support
+        """
+        headers = {"Accept-Ranges": "bytes", "ETag": '"v1"'}
+        if "Range" not in request.headers or request.headers.get("If-Range") != '"v1"':
+            return web.Response(body=self.data, headers=headers)
+        spec = request.headers["Range"]
+        self.ranges[spec] += 1
+        start, end = (int(x) for x in spec[len("bytes="):].split("-"))
+        body = self.data[start:end + 1]
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(self.data)}"
+        if self.failures[spec]:
+            self.failures[spec] -= 1
+            response = web.StreamResponse(status=206, headers=headers)
+            response.content_length = len(body)
+            await response.prepare(request)
+            await response.write(body[:100])
+            request.transport.close()
+            return response
+        return web.Response(status=206, body=body, headers=headers)
+
+    async def download(self, url):
+        """
+        Download url into the temporary directory with a fast retrying client
+        """
+        async with DownloadClient(retries=2, backoff=0) as client:
+            return await helper_async.download_file(
+                url, self.tmp.name, 0, client, expected=self.expected)
+
+    async def test_segments_retried_alone(self):
+        """
+        Method to test a cut segment is requested again without restarting the others
+        """
+        url = await self.start_mirror({"/Contents-big.gz": self.handler}) + "Contents-big.gz"
+        self.failures["bytes=16384-32767"] = 1
+        path = await self.download(url)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(len(self.ranges), 7)
+        self.assertEqual(self.ranges["bytes=16384-32767"], 2)
+        self.assertEqual(sum(self.ranges.values()), 8)
+        self.assertEqual(CacheManifest.load(self.tmp.name).get("Contents-big.gz")["sha256"],
+                         self.expected["sha256"])
+        self.assertEqual(sorted(os.listdir(self.tmp.name)),
+                         [".contents-manifest.json", "Contents-big.gz"])
+
+    async def test_resume_from_state(self):
+        """
+        Method to test an interrupted download only fetches its missing segments
+        """
+        url = await self.start_mirror({"/Contents-big.gz": self.handler}) + "Contents-big.gz"
+        self.failures["bytes=81920-98303"] = 3
+        with self.assertRaises(DownloadError):
+            await self.download(url)
+        part_path, state_path = range_download.segment_paths(
+            os.path.join(self.tmp.name, "Contents-big.gz"))
+        self.assertTrue(os.path.exists(part_path) and os.path.exists(state_path))
+        self.ranges.clear()
+        path = await self.download(url)
+        self.assertEqual(list(self.ranges), ["bytes=81920-98303"])
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertFalse(os.path.exists(part_path) or os.path.exists(state_path))
+
+
+class TestMirrors(LocalMirrorTestCase):
+    """
+    Class for mirror ranking, hedging and failover unit tests
+    """
+    async def start_mirrors(self, behaviours):
+        """
+        Start one local mirror per behaviour and return their component URLs
+        """
+        self.data = gzip.compress(b"usr/bin/a\tutils/a\nusr/bin/b\tutils/b\n" * 50)
+        self.requests = Counter()
+        mirrors = []
+        for index, behaviour in enumerate(behaviours):
+            async def handler(request, index=index, behaviour=behaviour):
+                self.requests[index, request.method] += 1
+                if behaviour == "slow":
+                    await asyncio.sleep(0.5)
+                if behaviour == "corrupt" and request.method == "GET":
+                    return web.Response(body=self.data[:-1] + b"x")
+                if behaviour == "cut" and request.method == "GET":
+                    response = web.StreamResponse(headers={"Content-Length": str(len(self.data))})
+                    await response.prepare(request)
+                    await response.write(self.data[:50])
+                    request.transport.close()
+                    return response
+                return web.Response(body=self.data)
+            base = await self.start_mirror({
+                "/debian/dists/stable/Release": handler,
+                "/debian/dists/stable/main/Contents-arch1.gz": handler,
+            })
+            mirrors.append(base + "debian/dists/stable/main/")
+        return mirrors
+
+    async def run_files(self, mirrors, **kwargs):
+        """
+        Download and count Contents-arch1.gz from the first mirror with failover
+        """
+        tmp = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(tmp.cleanup)
+        url = mirrors[0] + "Contents-arch1.gz"
+        expected = {"size": len(self.data), "sha256": hashlib.sha256(self.data).hexdigest()}
+        counts = {}
+        async with DownloadClient(retries=0) as client:
+            mirror_set = MirrorSet(mirrors)
+            with patch("builtins.print"):
+                await helper_async.download_and_process_files(
+                    [url], tmp.name, 0, client=client, checksums={url: expected},
+                    counts=counts, mirrors=mirror_set, **kwargs)
+        return counts, CacheManifest.load(tmp.name).get("Contents-arch1.gz")
+
+    async def test_probe_ranks_by_latency(self):
+        """
+        Method to test mirrors are ranked fastest first
+        """
+        slow, fast = await self.start_mirrors(["slow", "ok"])
+        mirror_set = MirrorSet([slow, fast.rstrip("/")])
+        async with DownloadClient() as client:
+            latencies = await mirror_set.probe(client)
+        self.assertEqual(mirror_set.mirrors, [fast, slow])
+        self.assertLess(latencies[fast], latencies[slow])
+        self.assertEqual(mirror_set.alternatives(slow + "Contents-arch1.gz"),
+                         [fast + "Contents-arch1.gz", slow + "Contents-arch1.gz"])
+
+    async def test_hedged_request_cancels_loser(self):
+        """
+        Method to test a slow mirror is raced by the next one and cancelled
+        """
+        mirrors = await self.start_mirrors(["slow", "ok"])
+        counts, entry = await self.run_files(mirrors, hedge_delay=0.05)
+        self.assertEqual(counts, {"utils/a": 50, "utils/b": 50})
+        self.assertEqual(entry["url"], mirrors[1] + "Contents-arch1.gz")
+        self.assertEqual(self.requests[0, "GET"], 1)
+
+    async def test_failover_and_checksums(self):
+        """
+        Method to test cut and corrupt downloads fail over to the next mirror
+        """
+        mirrors = await self.start_mirrors(["cut", "corrupt", "ok"])
+        for pipeline in (False, True):
+            counts, entry = await self.run_files(mirrors, hedge_delay=None, pipeline=pipeline)
+            self.assertEqual(counts, {"utils/a": 50, "utils/b": 50})
+            self.assertEqual(entry["url"], mirrors[2] + "Contents-arch1.gz")
+
+    async def test_hedged_raises_last_error(self):
+        """
+        Method to test hedged raises when every candidate fails
+        """
+        async def attempt(candidate):
+            raise DownloadError(candidate, 500)
+        with patch("builtins.print"), self.assertRaises(DownloadError) as error:
+            await hedged(["a", "b"], attempt, hedge_delay=0)
+        self.assertEqual(error.exception.url, "b")
+
+
+class TestBenchmarkHarness(unittest.TestCase):
+    """
+    Class for synthetic Contents generator and local benchmark mirror unit tests
+    """
+    def test_generate_contents(self):
+        """
+        Method to test generated files are reproducible and have every kind of line
+        """
+        data = generate_contents(5000, packages=200, seed=3, multi_package_ratio=0.1,
+                                 empty_package_ratio=0.01)
+        self.assertEqual(data, generate_contents(5000, packages=200, seed=3,
+                                                 multi_package_ratio=0.1,
+                                                 empty_package_ratio=0.01))
+        lines = data.decode().splitlines()
+        self.assertEqual(len(lines), 5000)
+        self.assertTrue(any(line.startswith("EMPTY_PACKAGE") for line in lines))
+        self.assertTrue(any("," in line.rsplit(None, 1)[1] for line in lines))
+        # Every parser agrees on the generated data
+        counts = Counter()
+        count_lines_bytes(data, counts)
+        self.assertEqual(count_bytes(data), decode_counts(counts))
+
+    def test_local_mirror_discovery(self):
+        """
+        Method to test both discovery modes find the files of the local mirror
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            write_contents_files(tmp, ["amd64", "arm64"], udeb=True, lines=500)
+            with BenchmarkMirror(tmp) as mirror:
+                release = helper_async.discover_contents_files(mirror.mirror_url)
+                html = helper_async.discover_contents_files(mirror.mirror_url, "html")
+                self.assertEqual(filter_files(release, "arm64", True),
+                                 filter_files(html, "arm64", True))
+                self.assertEqual(release["amd64"][0]["sha256"],
+                                 file_sha256(os.path.join(tmp, "Contents-amd64.gz")))
+                urls = filter_files(release, "amd64", False)
+                response = requests.get(urls[0], timeout=10)
+                # Served as data, not transparently decompressed
+                self.assertEqual(response.content[:2], b"\x1f\x8b")
+
+
+class TestEngine(unittest.IsolatedAsyncioTestCase):
+    """
+    Class for library API unit tests
+    """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.tmp.cleanup)
+        self.mirror_dir = os.path.join(self.tmp.name, "mirror")
+        self.output_dir = os.path.join(self.tmp.name, "downloads")
+        write_contents_files(self.mirror_dir, ["amd64", "arm64"], udeb=True, lines=2000,
+                             packages=100)
+        self.expected = {
+            arch: helper_async.count_file(os.path.join(self.mirror_dir, f"Contents-{arch}.gz"))
+            for arch in ("amd64", "arm64")}
+
+    async def test_concurrent_runs(self):
+        """
+        Method to test concurrent runs of one engine count into their own results
+        """
+        with BenchmarkMirror(self.mirror_dir) as mirror:
+            async with PackageStatsEngine(mirror.mirror_url, self.output_dir) as engine:
+                results = await engine.stats_many(["amd64", "arm64"], limit=3)
+                again, every = await asyncio.gather(
+                    engine.stats("amd64", limit=3), engine.stats("any"))
+                with_udeb = await engine.stats("any", include_udeb=True)
+        self.assertEqual(results["amd64"].counts, self.expected["amd64"])
+        self.assertEqual(results["arm64"].counts, self.expected["arm64"])
+        self.assertEqual(again.counts, self.expected["amd64"])
+        self.assertEqual(again.top, top_packages(self.expected["amd64"], True, 3))
+        self.assertEqual(again.files[0].source, "index")
+        self.assertEqual(helper_async.package_stats_dict, {})
+        result = results["amd64"]
+        self.assertEqual([stats.name for stats in result.files], ["Contents-amd64.gz"])
+        self.assertEqual(result.files[0].source, "download")
+        self.assertEqual(result.files[0].lines, 2000)
+        self.assertIsNone(result.files[0].error)
+        self.assertIn("parse", result.timings)
+        self.assertGreater(result.wall_time, 0)
+        self.assertEqual(json.loads(json.dumps(result.to_dict()))["top"],
+                         [list(row) for row in result.top])
+        # Every architecture, udeb files only with include_udeb
+        self.assertEqual(sorted(stats.name for stats in every.files),
+                         ["Contents-amd64.gz", "Contents-arm64.gz"])
+        self.assertEqual(dict(every.counts.items()),
+                         dict(Counter(self.expected["amd64"]) + Counter(self.expected["arm64"])))
+        self.assertEqual(sorted(stats.source for stats in with_udeb.files),
+                         ["download", "download", "index", "index"])
+        self.assertGreaterEqual(every.matrix.row(result.top[0][0])["amd64"], result.top[0][1])
+
+    def test_sync_engine(self):
+        """
+        Method to test the blocking engine and an unknown architecture
+        """
+        with BenchmarkMirror(self.mirror_dir) as mirror:
+            with SyncPackageStatsEngine(mirror=mirror.mirror_url, output_dir=self.output_dir,
+                                        workers=2) as engine:
+                result = engine.stats("arm64")
+                missing = engine.stats("mips")
+        self.assertEqual(result.counts, self.expected["arm64"])
+        self.assertEqual(result.format(), return_stats(self.expected["arm64"]))
+        self.assertEqual((missing.counts, missing.files), ({}, []))
+        with self.assertRaises(ValueError):
+            PackageStatsEngine(decompressor="bzip2")
+
+
+class TestServer(unittest.IsolatedAsyncioTestCase):
+    """
+    Class for serve subcommand unit tests
+    """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.tmp.cleanup)
+        self.mirror_dir = os.path.join(self.tmp.name, "mirror")
+        self.output_dir = os.path.join(self.tmp.name, "downloads")
+        write_contents_files(self.mirror_dir, ["amd64"], lines=1000, packages=50)
+        self.path = os.path.join(self.mirror_dir, "Contents-amd64.gz")
+
+    async def test_queries_and_refresh(self):
+        """
+        Method to test queries are answered from memory and refreshed on Release changes
+        """
+        with BenchmarkMirror(self.mirror_dir) as mirror:
+            service = StatsService(mirror.archive_url, ["stable"], ["amd64"], self.output_dir,
+                                   refresh_interval=None, build_path_index=True)
+            async with service, test_utils.TestClient(
+                    test_utils.TestServer(create_app(service))) as client:
+                expected = helper_async.count_file(self.path)
+                package, count = top_packages(expected, True, 1)[0]
+                response = await client.get("/top/stable/amd64", params={"limit": "3"})
+                body = await response.json()
+                self.assertEqual(body["top"], [list(row) for row in top_packages(expected)][:3])
+                response = await client.get(f"/count/stable/amd64/{package}")
+                self.assertEqual((await response.json())["count"], count)
+                response = await client.get("/top/stable/mips")
+                self.assertEqual(response.status, 404)
+                with gzip.open(self.path, "rt") as f:
+                    first_path, owners = f.readline().split()
+                response = await client.get("/lookup/stable", params={"path": first_path})
+                self.assertEqual((await response.json())["results"],
+                                 [["Contents-amd64.gz", first_path, owners]])
+                response = await client.post("/refresh/stable")
+                self.assertFalse((await response.json())["refreshed"])
+                # A new Release file is picked up and recounted
+                write_contents_files(self.mirror_dir, ["amd64"], lines=500, packages=20, seed=9)
+                response = await client.post("/refresh/stable")
+                self.assertTrue((await response.json())["refreshed"])
+                response = await client.get("/top/stable/amd64", params={"limit": "3"})
+                self.assertEqual((await response.json())["top"], [
+                    list(row) for row in top_packages(helper_async.count_file(self.path), True, 3)])
+
+    async def test_refresh_keeps_counts_of_failed_files(self):
+        """
+        Method to test a refresh missing a file keeps the previous snapshots and Release
+        """
+        with BenchmarkMirror(self.mirror_dir) as mirror:
+            service = StatsService(mirror.archive_url, ["stable"], ["amd64"], self.output_dir,
+                                   refresh_interval=None)
+            async with service, test_utils.TestClient(
+                    test_utils.TestServer(create_app(service))) as client:
+                engine = service.engines["stable"]
+                stats_many = engine.stats_many
+
+                async def failing_stats_many(archs, **options):
+                    results = await stats_many(archs, **options)
+                    results["amd64"].files[0].error = "connection reset"
+                    return results
+
+                snapshot, release = service.snapshot("stable", "amd64"), service.releases["stable"]
+                write_contents_files(self.mirror_dir, ["amd64"], lines=500, packages=20, seed=9)
+                with patch.object(engine, "stats_many", failing_stats_many):
+                    response = await client.post("/refresh/stable")
+                self.assertEqual(response.status, 502)
+                self.assertIn("Contents-amd64.gz", (await response.json())["error"])
+                self.assertIs(service.snapshot("stable", "amd64"), snapshot)
+                self.assertEqual(service.releases["stable"], release)
+                response = await client.post("/refresh/stable")
+                self.assertTrue((await response.json())["refreshed"])
+
+    async def test_release_sha256_of_inrelease(self):
+        """
+        Method to test the Release index hashed is the InRelease file discovery reads first
+        """
+        inrelease = b"Suite: stable\nSHA256:\n"
+
+        async def handler(_request):
+            return web.Response(body=inrelease)
+
+        app = web.Application()
+        app.router.add_get("/debian/dists/stable/InRelease", handler)
+        async with test_utils.TestServer(app) as server:
+            service = StatsService(str(server.make_url("/debian/")), ["stable"], ["amd64"],
+                                   self.output_dir, refresh_interval=None)
+            async with service.engines["stable"]:
+                self.assertEqual(await service.release_sha256("stable"),
+                                 hashlib.sha256(inrelease).hexdigest())
+
+    async def test_refresh_failures(self):
+        """
+        Method to test the refresher outlives any error and close survives a dead refresher
+        """
+        with BenchmarkMirror(self.mirror_dir) as mirror:
+            service = StatsService(mirror.archive_url, ["stable"], ["amd64"], self.output_dir,
+                                   refresh_interval=0.01)
+            calls = []
+
+            async def failing_refresh(suite, force=False):
+                calls.append((suite, force))
+                raise ValueError("corrupt file")
+
+            async with service:
+                engine = service.engines["stable"]
+                self.assertEqual(service.snapshot("stable", "amd64").files,
+                                 ["Contents-amd64.gz"])
+                with patch.object(service, "refresh", failing_refresh), \
+                        contextlib.redirect_stderr(io.StringIO()) as stderr:
+                    for _ in range(500):
+                        if len(calls) >= 3:
+                            break
+                        await asyncio.sleep(0.01)
+                self.assertGreaterEqual(len(calls), 3)
+                self.assertFalse(service._refresher.done())  # pylint: disable=protected-access
+                self.assertIn("corrupt file", stderr.getvalue())
+
+                async def dead():
+                    raise RuntimeError("refresher bug")
+
+                service._refresher.cancel()  # pylint: disable=protected-access
+                service._refresher = asyncio.create_task(dead())  # pylint: disable=protected-access
+                await asyncio.sleep(0)
+                with contextlib.redirect_stderr(io.StringIO()):
+                    await service.close()
+                self.assertIsNone(engine.client)
+                self.assertIsNone(engine.executor)
+
+    async def test_unix_socket(self):
+        """
+        Method to test the server answers on a Unix socket
+        """
+        socket_path = os.path.join(self.tmp.name, "stats.sock")
+        with BenchmarkMirror(self.mirror_dir) as mirror:
+            service = StatsService(mirror.archive_url, ["stable"], ["amd64"], self.output_dir)
+            with patch("builtins.print"):
+                server = asyncio.create_task(run_server(service, unix_socket=socket_path))
+                for _ in range(100):
+                    if os.path.exists(socket_path):
+                        break
+                    await asyncio.sleep(0.05)
+            try:
+                async with aiohttp.ClientSession(
+                        connector=aiohttp.UnixConnector(path=socket_path)) as session:
+                    async with session.get("http://localhost/health") as response:
+                        body = await response.json()
+            finally:
+                server.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await server
+        self.assertEqual(body["snapshots"][0]["files"], ["Contents-amd64.gz"])
+        self.assertEqual(body["releases"]["stable"], hashlib.sha256(mirror.release()).hexdigest())
+
+
+class TestStartup(unittest.TestCase):
+    """
+    Class for startup time unit tests
+    """
+    def test_import_is_light(self):
+        """
+        Method to test importing the command line loads no network library
+        """
+        modules, _output = import_times(["-c", "import helpers.package_stats_helper_async"])
+        self.assertIn("helpers.package_stats_helper_async", modules)
+        self.assertEqual([name for name in NETWORK_MODULES if name in modules], [])
+
+    def test_help_is_light(self):
+        """
+        Method to test --help loads no network library, executor, event loop or SQLite
+        """
+        modules, _output = import_times([ENTRY_POINT, "--help"])
+        self.assertEqual([name for name in NETWORK_MODULES + RUN_MODULES + INDEX_MODULES
+                          if name in modules], [])
+
+    def test_cached_fast_path(self):
+        """
+        Method to test a cached run is answered without the mirror or network libraries
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            command = cached_command(tmp)
+            modules, output = import_times(command)
+            expected = helper_async.count_file(os.path.join(tmp, "mirror", "Contents-amd64.gz"))
+            output_dir = os.path.join(tmp, "downloads")
+            mirror_url = command[command.index("-m") + 1]
+            self.assertIsNone(cached_stats(
+                "amd64", mirror_url, False, 10, output_dir, 0))
+            self.assertIsNone(cached_stats(
+                "amd64", "http://other.invalid/debian/dists/stable/main/", False, 10,
+                output_dir, 10))
+        self.assertEqual(output, return_stats(expected) + "\n")
+        self.assertEqual([name for name in NETWORK_MODULES + RUN_MODULES if name in modules], [])
+
+    def test_cached_files_never_discovered(self):
+        """
+        Method to test cached counts are not answered for udeb files a run never downloaded
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            mirror_dir = os.path.join(tmp, "mirror")
+            output_dir = os.path.join(tmp, "downloads")
+            write_contents_files(mirror_dir, ["amd64"], udeb=True, lines=200)
+            expected = helper_async.count_file(os.path.join(mirror_dir, "Contents-amd64.gz"))
+            with BenchmarkMirror(mirror_dir) as mirror:
+                with patch("builtins.print"):
+                    cli(["amd64", "-m", mirror.mirror_url, "-o", output_dir, "-s", "10"])
+                self.assertEqual(cached_counts(
+                    "amd64", mirror.mirror_url, False, output_dir, 1), expected)
+                self.assertIsNone(cached_counts(
+                    "amd64", mirror.mirror_url, True, output_dir, 1))
+                with patch("builtins.print"):
+                    cli(["amd64", "-u", "-m", mirror.mirror_url, "-o", output_dir, "-s", "10"])
+            expected.update(helper_async.count_file(
+                os.path.join(mirror_dir, "Contents-udeb-amd64.gz")))
+            self.assertEqual(cached_counts(
+                "amd64", mirror.mirror_url, True, output_dir, 1), expected)
+
+
+class TestShards(unittest.TestCase):
+    """
+    Class for map and reduce subcommand unit tests
+    """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.tmp.cleanup)
+
+    def shard(self, name, counts, urls=()):
+        """
+        Write a shard of counts covering urls and return its path
+        """
+        path = os.path.join(self.tmp.name, name + SHARD_SUFFIX)
+        write_shard(path, counts, {"files": [{"url": url} for url in urls]})
+        return path
+
+    def test_round_trip_and_merge(self):
+        """
+        Method to test shards are merged into exact global counts
+        """
+        rng = random.Random(1)
+        parts = [{f"libs/pkg{rng.randrange(3000)}": rng.randrange(1, 500)
+                  for _ in range(2000)} for _ in range(3)]
+        paths = [self.shard(f"part{i}", part, [f"http://m/dists/stable/main/C-{i}.gz"])
+                 for i, part in enumerate(parts)]
+        self.assertEqual(dict(ShardReader(paths[0])), parts[0])
+        expected = Counter()
+        for part in parts:
+            expected.update(part)
+        merged = os.path.join(self.tmp.name, "merged.bin")
+        result = reduce_shards(paths, 5, merged)
+        self.assertEqual(result["top"], top_packages(expected, True, 5))
+        self.assertEqual((result["packages"], result["total"], result["files"]),
+                         (len(expected), sum(expected.values()), 3))
+        with ShardReader(merged) as reader:
+            self.assertEqual(len(reader.metadata["files"]), 3)
+            self.assertEqual(dict(reader), dict(expected))
+        with self.assertRaises(ValueError):
+            with ShardWriter(os.path.join(self.tmp.name, "bad"), {}) as writer:
+                writer.add("b", 1)
+                writer.add("a", 1)
+        self.assertEqual(os.listdir(self.tmp.name).count("bad"), 0)
+
+    def test_corrupt_and_duplicate_shards(self):
+        """
+        Method to test damaged shards and files counted twice are rejected
+        """
+        path = self.shard("part", {f"pkg{i}": i + 1 for i in range(500)},
+                          ["http://a/debian/dists/stable/main/Contents-x.gz"])
+        with open(path, "r+b") as f:
+            f.seek(os.path.getsize(path) // 2)
+            byte = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(bytes([byte[0] ^ 0x40]))
+        with self.assertRaises(ShardError):
+            reduce_shards([path])
+        first = self.shard("first", {"pkg": 1}, ["http://a/debian/dists/stable/main/C-x.gz"])
+        second = self.shard("second", {"pkg": 1}, ["http://b/dists/stable/main/C-x.gz"])
+        with self.assertRaises(ShardError):
+            reduce_shards([first, second])
+
+    def test_assign_files(self):
+        """
+        Method to test files are split by size, the same way on every node
+        """
+        urls = [f"http://m/C-{i}.gz" for i in range(5)]
+        checksums = {url: {"size": size} for url, size in zip(urls, (50, 40, 30, 20, 10))}
+        self.assertEqual(assign_files(urls, checksums, 2),
+                         [[urls[0], urls[3], urls[4]], [urls[1], urls[2]]])
+        self.assertEqual(assign_files(list(reversed(urls)), checksums, 2),
+                         assign_files(urls, checksums, 2))
+        self.assertEqual(sorted(map(len, assign_files(urls, {}, 3))), [1, 2, 2])
+
+    def test_map_reduce_cli(self):
+        """
+        Method to test two map nodes and a reduce give the counts of a single run
+        """
+        mirror_dir = os.path.join(self.tmp.name, "mirror")
+        write_contents_files(mirror_dir, ["amd64", "arm64", "i386"], lines=500, packages=40)
+        expected = Counter()
+        for name in os.listdir(mirror_dir):
+            expected.update(helper_async.count_file(os.path.join(mirror_dir, name)))
+        shard_dir = os.path.join(self.tmp.name, "shards")
+        os.makedirs(shard_dir)
+        with BenchmarkMirror(mirror_dir) as mirror, patch("builtins.print"):
+            for node in range(2):
+                cli([
+                    "map", "any", "--node", str(node), "--nodes", "2", "-m", mirror.mirror_url,
+                    "-o", os.path.join(self.tmp.name, f"node{node}"),
+                    "--shard", os.path.join(shard_dir, f"any-{node}{SHARD_SUFFIX}")])
+        json_path = os.path.join(self.tmp.name, "reduce.json")
+        with patch("builtins.print"):
+            cli(["reduce", shard_dir, "-l", "3", "--json", json_path])
+        with open(json_path, encoding="utf-8") as f:
+            result = json.load(f)
+        self.assertEqual(result["files"], 3)
+        self.assertEqual(result["top"], [list(row) for row in top_packages(expected, True, 3)])
+        self.assertEqual(result["total"], sum(expected.values()))
@@ -3,34 +3,115 @@
 Main entry point for the debian package stats module
 
 $ python3 package_statistics.py --help
-usage: package_statistics.py [-h] [-m MIRROR_URL] [-u] [-l LIMIT]
-                             [-o OUTPUT_DIR] [-s SKIP_DOWNLOAD]
+usage: package_statistics.py [-h] [-o OUTPUT_DIR] [-s SKIP_DOWNLOAD]
+                             [-w WORKERS] [--discovery {release,html}]
+                             [--no-index] [--connections CONNECTIONS]
+                             [--connections-per-host CONNECTIONS_PER_HOST]
+                             [--max-downloads MAX_DOWNLOADS]
+                             [--retries RETRIES]
+                             [-m MIRROR_URL [MIRROR_URL ...]] [-u] [-l LIMIT]
+                             [--report-memory] [-p] [--no-cache]
+                             [--split-files] [--build-path-index]
+                             [--save-matrix SAVE_MATRIX] [--approximate [MB]]
+                             [--incremental] [--hedge-delay HEDGE_DELAY]
+                             [--profile] [--profile-json PROFILE_JSON]
+                             [--profile-capture {cprofile,tracemalloc}]
+                             [--decompressor {auto,isal,zlib-ng,pigz,gzip}]
                              architecture
 
 CLI tool to get the package statistics of debian packages given architecture.
+Runs whose files are all skipped with -s and indexed are answered without
+contacting the mirror.
 
 positional arguments:
-  architecture          Architecture of the packages to parse.
+  architecture          Architecture of the packages to parse, 'any' for every
+                        architecture.
 
 options:
   -h, --help            show this help message and exit
-  -m MIRROR_URL, --mirror_url MIRROR_URL
-                        Mirror URL for contents files. DEFAULT:
+  -o OUTPUT_DIR, --output-dir OUTPUT_DIR
+                        Download location for content files. DEFAULT: current-
+                        working-directory/downloads
+  -s SKIP_DOWNLOAD, --skip-download SKIP_DOWNLOAD
+                        Skip download if files are already present and newer
+                        than 's' days, otherwise cached files are revalidated
+                        with a conditional request. DEFAULT: 0
+  -w WORKERS, --workers WORKERS
+                        Number of worker processes parsing files in parallel,
+                        0 parses in a thread of the main process. DEFAULT: 0
+  --discovery {release,html}
+                        Find Contents files from the suite's Release index, or
+                        by scraping the mirror's directory listing. DEFAULT:
+                        release
+  --no-index            Do not reuse or store parsed package counts in the
+                        count index in output-dir. DEFAULT: False
+  --connections CONNECTIONS
+                        Maximum number of open connections, 0 for no limit.
+                        DEFAULT: 8
+  --connections-per-host CONNECTIONS_PER_HOST
+                        Maximum number of open connections to one mirror, 0
+                        for no limit. DEFAULT: 4
+  --max-downloads MAX_DOWNLOADS
+                        Maximum number of downloads in flight. DEFAULT: 8
+  --retries RETRIES     Number of retries with backoff on transient download
+                        errors. DEFAULT: 3
+  -m MIRROR_URL [MIRROR_URL ...], --mirror_url MIRROR_URL [MIRROR_URL ...]
+                        Mirror URL for contents files. Several mirrors of the
+                        same component are ranked by latency, downloads are
+                        hedged and fail over between them. DEFAULT:
                         http://ftp.uk.debian.org/debian/dists/stable/main/
   -u, --udeb            Include udeb file for architecture. DEFAULT: False
   -l LIMIT, --limit LIMIT
                         Top 'l' number of packages with maximum count of
                         files. DEFAULT: 10
-  -o OUTPUT_DIR, --output-dir OUTPUT_DIR
-                        Download location for content files DEFAULT: current-
-                        working-directory/downloads
-  -s SKIP_DOWNLOAD, --skip-download SKIP_DOWNLOAD
-                        Skip download if files are already present and newer
-                        than 's' days. DEFAULT: 10
+  --report-memory       Print peak resident memory after the run. DEFAULT:
+                        False
+  -p, --pipeline        Decompress and parse files while they are downloading,
+                        in threads of the main process, so it cannot be
+                        combined with --workers. DEFAULT: False
+  --no-cache            Do not store downloaded files in output-dir when
+                        pipelining. DEFAULT: False
+  --split-files         Split each file into blocks parsed by all workers,
+                        speeds up single architecture runs. DEFAULT: False
+  --build-path-index    Build the file to package index used by the lookup
+                        subcommand while parsing. DEFAULT: False
+  --save-matrix SAVE_MATRIX
+                        With architecture 'any', write the package by
+                        architecture count matrix to this file. DEFAULT: None
+  --approximate [MB]    Count with bounded memory Space-Saving sketches of
+                        about MB megabytes, one for the run and one per file
+                        being parsed, and print the error bound of each count.
+                        DEFAULT: exact counts, 8 MB without a value
+  --incremental         Update cached Contents files and their indexed counts
+                        from the mirror's pdiffs instead of downloading them
+                        again. DEFAULT: False
+  --hedge-delay HEDGE_DELAY
+                        With several mirrors, seconds before a download is
+                        also started on the next mirror, a negative value only
+                        fails over. DEFAULT: 2.0
+  --profile             Print the time, bytes, lines per second and executor
+                        queue wait of every stage and file after the run.
+                        DEFAULT: False
+  --profile-json PROFILE_JSON
+                        Also write the profile report to this JSON file,
+                        implies --profile. DEFAULT: None
+  --profile-capture {cprofile,tracemalloc}
+                        Capture the parse of every file with cProfile or
+                        tracemalloc, implies --profile. DEFAULT: None
+  --decompressor {auto,isal,zlib-ng,pigz,gzip}
+                        Decompression backend of gzipped files: the isal or
+                        zlib-ng bindings, a pigz subprocess or the stdlib gzip
+                        module. DEFAULT: auto, the fastest installed
+
+Subcommands: 'lookup' finds the packages shipping a file, 'batch' counts
+several suites, components and architectures in one run, 'serve' answers
+queries over HTTP from counts kept in memory, 'map' and 'reduce' split a count
+across machines, 'diff' compares suites and architectures, see
+'package_statistics.py <subcommand> --help'.
 """
 ###################################################################
 
-from helpers.package_stats_helper_async import cli
+from helpers.cli import cli
 
 if __name__ == "__main__":
     cli()